@@ -0,0 +1,27 @@
+# Run the BigQuery function's row building for one request, without
+# BigQuery: python bigquery_dry_run.py <request_id>
+#
+# Started by run_pipeline.py with BQ_DRY_RUN=true, GCS_BUCKET_NAME and
+# PYTHONPATH pointing at the bigquery and common directories.
+import sys
+
+import main
+
+
+class Request:
+    """
+    Stand-in for the flask request the function is called with.
+    """
+
+    def __init__(self, request_id):
+        self.request_id = request_id
+
+    def get_json(self):
+        return {'request_id': self.request_id}
+
+
+if __name__ == '__main__':
+    result = main.write_to_bigquery(Request(sys.argv[1]))
+    print(result)
+    status_code = result[1] if isinstance(result, tuple) else 500
+    sys.exit(0 if status_code == 200 else 1)
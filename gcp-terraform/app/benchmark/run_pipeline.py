@@ -0,0 +1,516 @@
+# End-to-end pipeline benchmark against local file:// buckets
+#
+# Generates a synthetic traffic video and runs every stage the way the
+# workflow does, each as its own process on this machine: split, the
+# tracking job per chunk (detection, tracking and annotation), track
+# stitching when chunks overlap, merge and the BigQuery row building
+# (BQ_DRY_RUN). In 'services' mode the YOLO service is started locally
+# under gunicorn; 'fused' mode runs the model inside the tracking job.
+#
+# Reports latency, frames/sec and peak RSS per stage, together with the
+# per-stage timing summary the jobs write to manifest.json and the YOLO
+# service's /metrics, as one JSON file tagged with the git commit:
+#
+#   python run_pipeline.py --duration 30 --density 8 --output new.json \
+#       --compare baseline.json
+#
+# Needs the requirements of every stage and ffmpeg/ffprobe on PATH.
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timezone
+
+import requests
+
+from synthetic_video import generate_video
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.dirname(BENCHMARK_DIR)
+COMMON_DIR = os.path.join(APP_DIR, 'common')
+
+VIDEO_NAME = 'synthetic.mp4'
+YOLO_STAGES = ('decode', 'inference', 'postprocess')
+
+
+class StageFailed(Exception):
+    """Raised when a pipeline stage exits with an error."""
+
+
+def stage_env(python_path=(), **overrides):
+    """
+    Environment of a stage process: this process's environment with the
+    shared modules on PYTHONPATH and overrides applied. Completion markers
+    are ignored so every run measures the full work.
+    """
+    env = dict(os.environ, RESUME='false')
+    paths = [*python_path, COMMON_DIR]
+    if env.get('PYTHONPATH'):
+        paths.append(env['PYTHONPATH'])
+    env['PYTHONPATH'] = os.pathsep.join(paths)
+    env.update({key: str(value) for key, value in overrides.items()})
+    return env
+
+
+def run_stage(command, cwd, env, log_path):
+    """
+    Run one stage process to completion.
+
+    Returns:
+        dict: Wall-clock seconds, exit code and peak RSS of the process
+    """
+    start = time.perf_counter()
+    with open(log_path, 'w') as log:
+        process = subprocess.Popen(command,
+                                   cwd=cwd,
+                                   env=env,
+                                   stdout=log,
+                                   stderr=subprocess.STDOUT)
+        # wait4 reports the resource usage of exactly this child
+        _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return {
+        'seconds': round(time.perf_counter() - start, 4),
+        'exit_code': process.returncode,
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss_mb': round(usage.ru_maxrss / 1024, 1),
+        'log': log_path
+    }
+
+
+def check_stage(name, result, expected_path=None):
+    """
+    Raise StageFailed if a stage exited with an error or did not write its
+    output (some jobs report errors without a failing exit code).
+    """
+    if result['exit_code'] != 0:
+        raise StageFailed(f"{name} exited with {result['exit_code']}, "
+                          f"see {result['log']}")
+    if expected_path and not os.path.exists(expected_path):
+        raise StageFailed(f"{name} did not write {expected_path}, "
+                          f"see {result['log']}")
+
+
+def with_throughput(result, frame_count):
+    result['frames_per_second'] = round(
+        frame_count / result['seconds'] if result['seconds'] else 0.0, 2)
+    return result
+
+
+def tree_peak_rss_mb(pid):
+    """
+    Sum of the peak RSS of a process and its descendants, from /proc.
+    """
+    total = 0
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    total += int(line.split()[1])
+        children = []
+        for task in os.listdir(f'/proc/{pid}/task'):
+            with open(f'/proc/{pid}/task/{task}/children') as f:
+                children.extend(int(child) for child in f.read().split())
+    except (FileNotFoundError, ProcessLookupError):
+        return 0.0
+    return total / 1024 + sum(tree_peak_rss_mb(child) for child in children)
+
+
+@contextmanager
+def yolo_service(port, work_dir, log_path, startup_timeout):
+    """
+    Run the YOLO service under gunicorn until the block exits.
+
+    Yields:
+        dict: The service endpoint and, once the block exits, its peak RSS
+    """
+    yolo_dir = os.path.join(APP_DIR, 'yolo')
+    env = stage_env(PORT=port,
+                    PROMETHEUS_MULTIPROC_DIR=os.path.join(
+                        work_dir, 'yolo-metrics'))
+    service = {'endpoint': f'http://127.0.0.1:{port}'}
+    with open(log_path, 'w') as log:
+        process = subprocess.Popen([
+            sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py',
+            'yolov8_service:app'
+        ],
+                                   cwd=yolo_dir,
+                                   env=env,
+                                   stdout=log,
+                                   stderr=subprocess.STDOUT)
+        try:
+            deadline = time.monotonic() + startup_timeout
+            while True:
+                if process.poll() is not None:
+                    raise StageFailed(
+                        f"YOLO service exited, see {log_path}")
+                try:
+                    if requests.get(service['endpoint'],
+                                    timeout=1).status_code == 200:
+                        break
+                except requests.exceptions.ConnectionError:
+                    pass
+                if time.monotonic() > deadline:
+                    raise StageFailed(
+                        f"YOLO service did not start, see {log_path}")
+                time.sleep(0.5)
+            yield service
+            service['peak_rss_mb'] = round(tree_peak_rss_mb(process.pid), 1)
+        finally:
+            process.terminate()
+            try:
+                process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+
+
+def parse_metrics(text):
+    """
+    Samples of a Prometheus text exposition, keyed by name and labels.
+    """
+    samples = {}
+    for line in text.splitlines():
+        if not line or line.startswith('#'):
+            continue
+        key, value = line.rsplit(' ', 1)
+        samples[key] = float(value)
+    return samples
+
+
+def yolo_metrics(endpoint):
+    """
+    Scrape the YOLO service's /metrics and summarize the per-frame stage
+    latencies, frame counts and batch sizes.
+    """
+    samples = parse_metrics(
+        requests.get(f'{endpoint}/metrics', timeout=10).text)
+    stages = {}
+    for stage in YOLO_STAGES:
+        labels = f'{{stage="{stage}"}}'
+        count = samples.get(f'yolo_frame_stage_seconds_count{labels}', 0)
+        seconds = samples.get(f'yolo_frame_stage_seconds_sum{labels}', 0)
+        stages[stage] = {
+            'frames': int(count),
+            'mean_ms': round(seconds / count * 1000, 3) if count else None
+        }
+    batches = samples.get('yolo_inference_batch_frames_count', 0)
+    return {
+        'frame_stages': stages,
+        'frames_inferred':
+        int(samples.get('yolo_frames_total{result="inferred"}', 0)),
+        'frames_skipped':
+        int(samples.get('yolo_frames_total{result="skipped"}', 0)),
+        'mean_batch_frames':
+        round(samples.get('yolo_inference_batch_frames_sum', 0) / batches, 2)
+        if batches else None,
+        'frames_per_second': samples.get('yolo_frames_per_second')
+    }
+
+
+def run_tracking(segments, request_id, tracking_bucket, work_dir, endpoint,
+                 args):
+    """
+    Run the tracking job for every chunk, args.tracking_workers at a time
+    as the workflow's parallel branch does.
+
+    Returns:
+        dict: Wall-clock seconds of the whole phase, the largest peak RSS
+        and each chunk's result
+    """
+    tracking_dir = os.path.join(APP_DIR, 'tracking-job')
+    bucket_dir = tracking_bucket[len('file://'):]
+
+    def track(segment):
+        stem = os.path.splitext(segment['segment_file'])[0]
+        temp_dir = os.path.join(work_dir, 'tmp', stem)
+        os.makedirs(temp_dir, exist_ok=True)
+        env = stage_env(
+            INPUT_BUCKET=tracking_bucket,
+            INPUT_VIDEO=f"{request_id}/split_chunks/{segment['segment_file']}",
+            INPUT_METADATA=f"{stem}.json",
+            REQUEST_ID=request_id,
+            GCS_BUCKET_NAME=tracking_bucket,
+            YOLO_SERVICE_ENDPOINT=endpoint or 'http://127.0.0.1',
+            PIPELINE_MODE=args.pipeline_mode,
+            TRACKING_ENGINE='local',
+            DETECTION_FORMAT=args.detection_format,
+            TEMP_DIR=temp_dir)
+        result = run_stage([sys.executable, 'main.py'], tracking_dir, env,
+                           os.path.join(work_dir, 'logs', f'track_{stem}.log'))
+        check_stage(
+            f"tracking {segment['segment_file']}", result,
+            os.path.join(bucket_dir, request_id, 'processed_chunks',
+                         f'{stem}.json'))
+        result['segment'] = segment['segment_file']
+        result['frames'] = segment.get('frame_count', 0)
+        return with_throughput(result, result['frames'])
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.tracking_workers) as executor:
+        chunks = list(executor.map(track, segments))
+    return {
+        'seconds': round(time.perf_counter() - start, 4),
+        'peak_rss_mb': max(chunk['peak_rss_mb'] for chunk in chunks),
+        'workers': args.tracking_workers,
+        'chunks': chunks
+    }
+
+
+def git_revision():
+    """
+    Commit of the benchmarked tree and whether it has local changes.
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'],
+                                cwd=APP_DIR,
+                                check=True,
+                                capture_output=True,
+                                text=True).stdout.strip()
+        status = subprocess.run(['git', 'status', '--porcelain', '.'],
+                                cwd=APP_DIR,
+                                check=True,
+                                capture_output=True,
+                                text=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, bool(status.strip())
+
+
+def run_benchmark(args):
+    """
+    Run every pipeline stage once on a fresh synthetic video.
+
+    Returns:
+        dict: Benchmark results
+    """
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='pipeline-benchmark-')
+    upload_bucket = f"file://{os.path.join(work_dir, 'upload')}"
+    tracking_bucket = f"file://{os.path.join(work_dir, 'tracking')}"
+    tracking_dir = os.path.join(work_dir, 'tracking')
+    request_id = args.request_id or f"benchmark-{int(time.time())}"
+    os.makedirs(os.path.join(work_dir, 'upload'), exist_ok=True)
+    os.makedirs(os.path.join(work_dir, 'logs'), exist_ok=True)
+
+    def log_path(name):
+        return os.path.join(work_dir, 'logs', f'{name}.log')
+
+    print(f"Generating a {args.width}x{args.height} video of "
+          f"{args.duration}s with {args.density} cars in {work_dir}")
+    start = time.perf_counter()
+    frame_count = generate_video(
+        os.path.join(work_dir, 'upload', VIDEO_NAME), args.duration,
+        args.fps, args.width, args.height, args.density, seed=args.seed)
+    generate_seconds = time.perf_counter() - start
+
+    stages = {}
+    print("Running split")
+    stages['split'] = run_stage(
+        [sys.executable, 'video-split.py'], os.path.join(APP_DIR,
+                                                         'video-split'),
+        stage_env(INPUT_BUCKET=upload_bucket,
+                  INPUT_VIDEO=VIDEO_NAME,
+                  OUTPUT_BUCKET=tracking_bucket,
+                  REQUEST_ID=request_id,
+                  SEGMENT_DURATION=args.segment_duration,
+                  OVERLAP_FRAMES=args.overlap_frames), log_path('split'))
+    manifest_path = os.path.join(tracking_dir, request_id, 'manifest.json')
+    check_stage('split', stages['split'], manifest_path)
+    with open(manifest_path) as f:
+        segments = json.load(f)['segments']
+
+    print(f"Running tracking on {len(segments)} chunks "
+          f"({args.pipeline_mode} mode)")
+    service_context = (yolo_service(args.yolo_port, work_dir,
+                                    log_path('yolo'),
+                                    args.service_timeout)
+                       if args.pipeline_mode == 'services' else
+                       nullcontext(None))
+    metrics = None
+    with service_context as service:
+        stages['track'] = run_tracking(segments, request_id, tracking_bucket,
+                                       work_dir,
+                                       service and service['endpoint'], args)
+        if service:
+            metrics = yolo_metrics(service['endpoint'])
+    if service:
+        metrics['peak_rss_mb'] = service.get('peak_rss_mb')
+
+    if args.overlap_frames > 0:
+        print("Running track stitching")
+        stages['stitch'] = run_stage(
+            [sys.executable, 'track-stitch.py'],
+            os.path.join(APP_DIR, 'video-merge'),
+            stage_env(INPUT_BUCKET=tracking_bucket, REQUEST_ID=request_id),
+            log_path('stitch'))
+        check_stage('stitch', stages['stitch'])
+
+    # The workflow runs merge and BigQuery concurrently on separate
+    # instances; here they run one after the other so neither slows the
+    # other down
+    print("Running merge")
+    stages['merge'] = run_stage(
+        [sys.executable, 'video-merge.py'],
+        os.path.join(APP_DIR, 'video-merge'),
+        stage_env(INPUT_BUCKET=tracking_bucket,
+                  OUTPUT_BUCKET=tracking_bucket,
+                  REQUEST_ID=request_id), log_path('merge'))
+    check_stage('merge', stages['merge'],
+                os.path.join(tracking_dir, request_id, 'merged_video.mp4'))
+
+    print("Running BigQuery row building")
+    bigquery_dir = os.path.join(APP_DIR, 'bigquery')
+    stages['bigquery'] = run_stage(
+        [
+            sys.executable,
+            os.path.join(BENCHMARK_DIR, 'bigquery_dry_run.py'), request_id
+        ], bigquery_dir,
+        stage_env([bigquery_dir],
+                  BQ_DRY_RUN='true',
+                  GCS_BUCKET_NAME=tracking_bucket,
+                  LOAD_FILE_FORMAT=args.load_file_format),
+        log_path('bigquery'))
+    check_stage('bigquery', stages['bigquery'])
+
+    for result in stages.values():
+        with_throughput(result, frame_count)
+    with open(manifest_path) as f:
+        timings = json.load(f).get('timings')
+
+    commit, dirty = git_revision()
+    total_seconds = sum(result['seconds'] for result in stages.values())
+    return {
+        'commit': commit,
+        'dirty': dirty,
+        'created_at': datetime.now(timezone.utc).isoformat(),
+        'config': {
+            key: value
+            for key, value in vars(args).items()
+            if key not in ('output', 'compare', 'max_regression', 'work_dir',
+                           'request_id')
+        },
+        'request_id': request_id,
+        'work_dir': work_dir,
+        'video': {
+            'frames': frame_count,
+            'segments': len(segments),
+            'generate_seconds': round(generate_seconds, 4)
+        },
+        'stages': stages,
+        'total_seconds': round(total_seconds, 4),
+        'frames_per_second': round(frame_count / total_seconds, 2),
+        'timings': timings,
+        'yolo_metrics': metrics
+    }
+
+
+def compare(results, baseline, max_regression):
+    """
+    Print stage latencies against a baseline run.
+
+    Returns:
+        list: Stages that got slower by more than max_regression, a
+        fraction (any slowdown if it is None)
+    """
+    if results['config'] != baseline.get('config'):
+        print("Warning: the baseline was run with a different configuration")
+    print(f"Baseline {baseline.get('commit')} -> current "
+          f"{results.get('commit')}")
+    print(f"{'stage':<10}{'baseline s':>12}{'current s':>12}{'change':>10}")
+    regressions = []
+    rows = [(name, result['seconds'])
+            for name, result in results['stages'].items()]
+    rows.append(('total', results['total_seconds']))
+    baseline_seconds = {
+        name: result['seconds']
+        for name, result in baseline.get('stages', {}).items()
+    }
+    baseline_seconds['total'] = baseline.get('total_seconds')
+    for name, seconds in rows:
+        before = baseline_seconds.get(name)
+        if not before:
+            print(f"{name:<10}{'-':>12}{seconds:>12.3f}{'-':>10}")
+            continue
+        change = (seconds - before) / before
+        print(f"{name:<10}{before:>12.3f}{seconds:>12.3f}{change:>+10.1%}")
+        if change > (max_regression or 0) and name != 'total':
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the whole pipeline offline on a synthetic '
+        'traffic video')
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--fps', type=int, default=25)
+    parser.add_argument('--width', type=int, default=1280)
+    parser.add_argument('--height', type=int, default=720)
+    parser.add_argument('--density',
+                        type=int,
+                        default=8,
+                        help='Cars on the road at any time')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--segment-duration', type=float, default=3)
+    parser.add_argument('--overlap-frames', type=int, default=0)
+    parser.add_argument('--pipeline-mode',
+                        choices=['services', 'fused'],
+                        default='services')
+    parser.add_argument('--detection-format',
+                        choices=['json', 'ndjson', 'columnar'],
+                        default='json')
+    parser.add_argument('--load-file-format',
+                        choices=['json', 'parquet'],
+                        default='json')
+    parser.add_argument('--tracking-workers',
+                        type=int,
+                        default=os.cpu_count() or 1,
+                        help='Chunks tracked concurrently')
+    parser.add_argument('--yolo-port', type=int, default=5055)
+    parser.add_argument('--service-timeout',
+                        type=float,
+                        default=120,
+                        help='Seconds to wait for the YOLO service to start')
+    parser.add_argument('--work-dir',
+                        help='Directory for the buckets and logs (default: '
+                        'a new temporary directory)')
+    parser.add_argument('--request-id')
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--compare',
+                        help='Results JSON of an earlier run to compare with')
+    parser.add_argument('--max-regression',
+                        type=float,
+                        help='Exit with an error if a stage is slower than '
+                        'the baseline by more than this fraction, e.g. 0.1')
+    args = parser.parse_args()
+
+    try:
+        results = run_benchmark(args)
+    except StageFailed as e:
+        print(f"Benchmark failed: {str(e)}")
+        sys.exit(1)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    for name, result in results['stages'].items():
+        print(f"{name:<10}{result['seconds']:>10.3f}s "
+              f"{result['frames_per_second']:>10.1f} frames/s "
+              f"{result['peak_rss_mb']:>8.1f} MB peak RSS")
+    print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.max_regression)
+        if args.max_regression is not None and regressions:
+            print(f"Regressed stages: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
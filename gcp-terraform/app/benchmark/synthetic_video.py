@@ -0,0 +1,148 @@
+# Synthetic traffic video for benchmarking the pipeline offline
+#
+# Draws a multi-lane road with car-like boxes driving across it. The number
+# of cars on screen (density), the resolution and the length are
+# configurable, and the same seed always gives the same video, so runs on
+# different commits process identical input.
+import argparse
+
+import cv2
+import numpy as np
+
+ROAD_COLOR = (70, 70, 70)
+VERGE_COLOR = (60, 110, 60)
+MARKING_COLOR = (230, 230, 230)
+
+
+def car_color(rng):
+    return tuple(int(channel) for channel in rng.integers(40, 255, size=3))
+
+
+class Car:
+    """
+    Box driving along a lane at a constant speed, wrapping around at the
+    frame edge.
+    """
+
+    def __init__(self, rng, lane_top, lane_height, width):
+        self.height = int(lane_height * rng.uniform(0.55, 0.8))
+        self.length = int(self.height * rng.uniform(1.6, 2.4))
+        self.y = lane_top + (lane_height - self.height) // 2
+        self.x = float(rng.uniform(-self.length, width))
+        # Pixels per frame; alternate lanes drive in opposite directions
+        self.speed = float(rng.uniform(0.004, 0.012) * width)
+        self.color = car_color(rng)
+        self.width = width
+
+    def step(self, direction):
+        self.x += direction * self.speed
+        if direction > 0 and self.x > self.width:
+            self.x = -self.length
+        elif direction < 0 and self.x < -self.length:
+            self.x = self.width
+
+    def draw(self, frame):
+        x1, y1 = int(self.x), self.y
+        x2, y2 = x1 + self.length, y1 + self.height
+        cv2.rectangle(frame, (x1, y1), (x2, y2), self.color, -1)
+        # Windscreen and wheels so the boxes are not flat blocks
+        window = (x1 + self.length // 4, y1 + self.height // 5,
+                  x1 + self.length // 2, y2 - self.height // 5)
+        cv2.rectangle(frame, window[:2], window[2:], (40, 40, 40), -1)
+        wheel = max(2, self.height // 6)
+        for wheel_x in (x1 + self.length // 5, x2 - self.length // 5):
+            cv2.circle(frame, (wheel_x, y2), wheel, (20, 20, 20), -1)
+
+
+def road_background(width, height, lanes):
+    """
+    Static road with lane markings, shared by every frame.
+
+    Returns:
+        tuple: Background image and the (top, height) of each lane
+    """
+    background = np.full((height, width, 3), VERGE_COLOR, dtype=np.uint8)
+    road_top = height // 6
+    road_height = height - 2 * road_top
+    lane_height = road_height // lanes
+    cv2.rectangle(background, (0, road_top),
+                  (width, road_top + lane_height * lanes), ROAD_COLOR, -1)
+    dash = max(10, width // 32)
+    for lane in range(1, lanes):
+        y = road_top + lane * lane_height
+        for x in range(0, width, dash * 2):
+            cv2.line(background, (x, y), (x + dash, y), MARKING_COLOR,
+                     max(1, height // 240))
+    return background, [(road_top + lane * lane_height, lane_height)
+                        for lane in range(lanes)]
+
+
+def generate_video(path,
+                   duration=30,
+                   fps=25,
+                   width=1280,
+                   height=720,
+                   density=8,
+                   lanes=4,
+                   seed=0):
+    """
+    Write a synthetic traffic video.
+
+    Args:
+        path (str): Output .mp4 path
+        duration (float): Length in seconds
+        fps (int): Frames per second
+        width (int): Frame width in pixels
+        height (int): Frame height in pixels
+        density (int): Cars on the road at any time
+        lanes (int): Number of lanes
+        seed (int): Random seed for car sizes, colors and speeds
+
+    Returns:
+        int: Number of frames written
+    """
+    rng = np.random.default_rng(seed)
+    background, lane_rows = road_background(width, height, lanes)
+    cars = []
+    for index in range(density):
+        lane = index % lanes
+        cars.append((lane, Car(rng, *lane_rows[lane], width)))
+
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), fps,
+                             (width, height))
+    if not writer.isOpened():
+        raise RuntimeError(f"Cannot open video writer for {path}")
+    frame_count = int(duration * fps)
+    try:
+        for _ in range(frame_count):
+            frame = background.copy()
+            for lane, car in cars:
+                car.step(1 if lane % 2 == 0 else -1)
+                car.draw(frame)
+            writer.write(frame)
+    finally:
+        writer.release()
+    return frame_count
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Generate a synthetic traffic video')
+    parser.add_argument('output', help='Path of the .mp4 to write')
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--fps', type=int, default=25)
+    parser.add_argument('--width', type=int, default=1280)
+    parser.add_argument('--height', type=int, default=720)
+    parser.add_argument('--density', type=int, default=8)
+    parser.add_argument('--lanes', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    frame_count = generate_video(args.output, args.duration, args.fps,
+                                 args.width, args.height, args.density,
+                                 args.lanes, args.seed)
+    print(f"Wrote {frame_count} frames to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+# Parquet load files for the BigQuery writer
+#
+# Streams processed chunk rows straight into column buffers and writes them
+# to a Parquet file one bounded row group at a time, so a request never has
+# a Python dict per detection or the whole request in memory. The columns
+# match the tracking results table schema.
+import os
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Rows buffered before a row group is written to the load file
+LOAD_ROW_GROUP_SIZE = int(os.environ.get('LOAD_ROW_GROUP_SIZE', 50000))
+
+BOX_TYPE = pa.struct([('x1', pa.int64()), ('y1', pa.int64()),
+                      ('x2', pa.int64()), ('y2', pa.int64())])
+LOAD_SCHEMA = pa.schema([
+    ('request_id', pa.string()),
+    ('track_id', pa.int64()),
+    ('frame_id', pa.int64()),
+    ('class_name', pa.string()),
+    ('class_id', pa.int64()),
+    ('confidence', pa.float64()),
+    ('timestamp', pa.float64()),
+    ('box', BOX_TYPE),
+    ('segment_file', pa.string()),
+])
+INTEGER_COLUMNS = ('track_id', 'frame_id', 'class_id')
+BOX_FIELDS = ('x1', 'y1', 'x2', 'y2')
+
+
+def as_int(value):
+    return None if value is None else int(value)
+
+
+class ParquetRowWriter:
+    """
+    Writes processed chunk rows to a Parquet file in row groups of at most
+    row_group_size rows.
+    """
+
+    def __init__(self, path, row_group_size=LOAD_ROW_GROUP_SIZE):
+        self.path = path
+        self.row_group_size = row_group_size
+        self.writer = pq.ParquetWriter(path, LOAD_SCHEMA, compression='snappy')
+        self.rows = 0
+        self._reset()
+
+    def _reset(self):
+        self.columns = {name: [] for name in LOAD_SCHEMA.names if name != 'box'}
+        self.box = {field: [] for field in BOX_FIELDS}
+        self.box_valid = []
+
+    def add_chunk(self, segment_data, segment_file):
+        """
+        Append the rows of one processed_chunks JSON file.
+        """
+        for item in segment_data:
+            # Overlap rows duplicate the start of the next chunk
+            if item.get('overlap'):
+                continue
+            columns = self.columns
+            for name in INTEGER_COLUMNS:
+                columns[name].append(as_int(item.get(name)))
+            columns['request_id'].append(item.get('request_id'))
+            columns['class_name'].append(item.get('class_name'))
+            columns['confidence'].append(item.get('confidence'))
+            columns['timestamp'].append(item.get('timestamp'))
+            columns['segment_file'].append(segment_file)
+
+            box = item.get('box') or [None]
+            box = box[0] if isinstance(box[0], dict) else None
+            self.box_valid.append(box is not None)
+            for field in BOX_FIELDS:
+                self.box[field].append(as_int(box.get(field)) if box else None)
+
+            if len(self.box_valid) >= self.row_group_size:
+                self.flush()
+
+    def flush(self):
+        """
+        Write the buffered rows as one row group.
+        """
+        if not self.box_valid:
+            return
+        arrays = []
+        for field in LOAD_SCHEMA:
+            if field.name == 'box':
+                box = pa.StructArray.from_arrays(
+                    [pa.array(self.box[name], pa.int64()) for name in BOX_FIELDS],
+                    fields=list(BOX_TYPE),
+                    mask=pa.array([not valid for valid in self.box_valid]))
+                arrays.append(box)
+            else:
+                arrays.append(pa.array(self.columns[field.name], field.type))
+        self.writer.write_table(pa.Table.from_arrays(arrays,
+                                                     schema=LOAD_SCHEMA))
+        self.rows += len(self.box_valid)
+        self._reset()
+
+    def close(self):
+        """
+        Flush the last row group and close the file.
+
+        Returns:
+            int: Number of rows written
+        """
+        self.flush()
+        self.writer.close()
+        return self.rows
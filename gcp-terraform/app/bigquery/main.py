@@ -1,12 +1,18 @@
 # Deployed to Cloud function - function triggered by new output.json file uploaded and write to BigQuery
 import os
+import hashlib
 import json
 import traceback
+from datetime import datetime, timezone
 import functions_framework
+from google.api_core.exceptions import Conflict
 from google.cloud import bigquery
-from google.cloud import storage
 from google.cloud.exceptions import NotFound
 import logging
+from load_files import ParquetRowWriter
+import checkpoint
+import object_store
+from stage_timing import StageTimer, record_timings
 
 # Set up logging
 logging.basicConfig(level=logging.INFO)
@@ -21,19 +27,395 @@ PROJECT_ID = os.environ.get('PROJECT_ID')
 DATASET_ID = os.environ.get('DATASET_ID', 'tracking_results')
 TABLE_ID = os.environ.get('TABLE_ID', 'tracking_results-table')
 
+# 'batch' loads every chunk when the workflow calls write_to_bigquery after
+# tracking; 'event' loads each chunk from load_chunk_to_bigquery as soon as
+# its processed JSON lands, and write_to_bigquery only reports the ledger
+BQ_LOAD_MODE = os.environ.get('BQ_LOAD_MODE', 'batch')
+
+# Load file format: 'json' (rows serialized by the client) or 'parquet'
+# (columns streamed into a Parquet file with bounded row groups)
+LOAD_FILE_FORMAT = os.environ.get('LOAD_FILE_FORMAT', 'json')
+
+# Build the rows of a batch load (JSON rows or the Parquet file) without
+# loading them, e.g. to benchmark the pipeline offline
+BQ_DRY_RUN = os.environ.get('BQ_DRY_RUN', 'false').lower() == 'true'
+
 # Initialize clients
-bq_client = bigquery.Client(project=PROJECT_ID)
-storage_client = storage.Client()
+bq_client = None if BQ_DRY_RUN else bigquery.Client(project=PROJECT_ID)
 
 
-def download_blob(bucket_name, source_blob_name, destination_file_name):
+def read_json_object(object_name):
+    """
+    Read a JSON object from the tracking bucket in memory.
+    """
     try:
-        bucket = storage_client.bucket(bucket_name)
-        blob = bucket.blob(source_blob_name)
-        blob.download_to_filename(destination_file_name)
-        logger.info(f"Successfully downloaded blob: {source_blob_name}")
+        data = object_store.read_json(GCS_BUCKET_NAME, object_name)
+        logger.info(f"Successfully read object: {object_name}")
+        return data
     except Exception as e:
-        logger.error(f"Error downloading blob {source_blob_name}: {str(e)}")
+        logger.error(f"Error reading object {object_name}: {str(e)}")
+        raise
+
+
+def chunk_rows(segment_data, segment_file):
+    """
+    Convert the processed rows of one chunk to BigQuery rows.
+
+    Args:
+        segment_data (list): Rows of a processed_chunks JSON file
+        segment_file (str): Name of the chunk, stored with every row so a
+            chunk can be replaced without touching the rest of the request
+
+    Returns:
+        list: Rows matching the tracking results table schema
+    """
+    rows = []
+    for item in segment_data:
+        # Overlap rows duplicate the start of the next chunk
+        if item.get('overlap'):
+            continue
+        try:
+            box_data = item.get('box', [{}])[0]  # Get the box object
+            row = {
+                'track_id': item.get('track_id'),
+                'frame_id': item.get('frame_id'),
+                'class_name': item.get('class_name'),
+                'class_id': item.get('class_id'),
+                'confidence': item.get('confidence'),
+                'box': {
+                    'x1': box_data.get('x1'),
+                    'y1': box_data.get('y1'),
+                    'x2': box_data.get('x2'),
+                    'y2': box_data.get('y2')
+                },
+                'timestamp': item.get('timestamp'),
+                'request_id': item.get('request_id'),
+                'segment_file': segment_file
+            }
+            # Handle the 'box' field
+            if row['box'] is None:
+                row['box'] = [
+                    None, None, None, None
+                ]  # This will be inserted as [null, null, null, null] in JSON
+            rows.append(row)
+
+        except Exception as e:
+            logger.error(f"Error processing item: {item}")
+            logger.error(f"Error details: {str(e)}")
+    return rows
+
+
+def ensure_table():
+    """
+    Return the tracking results table reference, creating the table if it
+    does not exist yet.
+    """
+    table_ref = bq_client.dataset(DATASET_ID).table(TABLE_ID)
+
+    # Check if the table exists, if not create it
+    try:
+        bq_client.get_table(table_ref)
+    except NotFound:
+        schema = [
+            bigquery.SchemaField("request_id", "STRING", mode="NULLABLE"),
+            bigquery.SchemaField("track_id", "INTEGER", mode="NULLABLE"),
+            bigquery.SchemaField("frame_id", "INTEGER", mode="NULLABLE"),
+            bigquery.SchemaField("class_name", "STRING", mode="NULLABLE"),
+            bigquery.SchemaField("class_id", "INTEGER", mode="NULLABLE"),
+            bigquery.SchemaField("confidence", "FLOAT", mode="NULLABLE"),
+            bigquery.SchemaField("timestamp", "FLOAT", mode="NULLABLE"),
+            bigquery.SchemaField("box",
+                                 "RECORD",
+                                 mode="NULLABLE",
+                                 fields=[
+                                     bigquery.SchemaField("x1",
+                                                          "INTEGER",
+                                                          mode="NULLABLE"),
+                                     bigquery.SchemaField("y1",
+                                                          "INTEGER",
+                                                          mode="NULLABLE"),
+                                     bigquery.SchemaField("x2",
+                                                          "INTEGER",
+                                                          mode="NULLABLE"),
+                                     bigquery.SchemaField("y2",
+                                                          "INTEGER",
+                                                          mode="NULLABLE")
+                                 ]),
+            bigquery.SchemaField("segment_file", "STRING", mode="NULLABLE")
+        ]
+        table = bigquery.Table(table_ref, schema=schema)
+        bq_client.create_table(table)
+        logger.info(f"Created table {DATASET_ID}.{TABLE_ID}")
+    return table_ref
+
+
+def load_job_config(source_format):
+    job_config = bigquery.LoadJobConfig()
+    job_config.source_format = source_format
+
+    job_config.schema_update_options = [
+        bigquery.SchemaUpdateOption.ALLOW_FIELD_ADDITION
+    ]
+    if source_format == bigquery.SourceFormat.NEWLINE_DELIMITED_JSON:
+        job_config.ignore_unknown_values = True
+    return job_config
+
+
+def collect_rows(request_id, json_files):
+    """
+    Read processed chunks and convert them to BigQuery rows.
+
+    Returns:
+        list: Rows of every chunk, in json_files order
+    """
+    rows = []
+    for json_file in json_files:
+        segment_data = read_json_object(
+            f"{request_id}/processed_chunks/{json_file}")
+        rows.extend(chunk_rows(segment_data,
+                               json_file.replace('.json', '.mp4')))
+    return rows
+
+
+def write_parquet_file(request_id, json_files, parquet_path):
+    """
+    Stream processed chunks into a Parquet file one chunk at a time.
+
+    Returns:
+        int: Number of rows written
+    """
+    writer = ParquetRowWriter(parquet_path)
+    for json_file in json_files:
+        writer.add_chunk(
+            read_json_object(f"{request_id}/processed_chunks/{json_file}"),
+            json_file.replace('.json', '.mp4'))
+    row_count = writer.close()
+    logger.info(f"Wrote {row_count} rows to {parquet_path}")
+    return row_count
+
+
+def load_json_rows(request_id, json_files, table_ref, job_id=None):
+    """
+    Load processed chunks by collecting their rows and letting the client
+    serialize them as newline-delimited JSON.
+
+    Returns:
+        LoadJob: The started load job, or None if there were no rows
+    """
+    rows_to_insert = collect_rows(request_id, json_files)
+    if not rows_to_insert:
+        return None
+    return bq_client.load_table_from_json(
+        rows_to_insert,
+        table_ref,
+        job_config=load_job_config(
+            bigquery.SourceFormat.NEWLINE_DELIMITED_JSON),
+        job_id=job_id)
+
+
+def load_parquet_file(request_id, json_files, table_ref, job_id=None):
+    """
+    Load processed chunks by streaming them into a Parquet file one chunk
+    at a time and loading the file.
+
+    Returns:
+        LoadJob: The started load job, or None if there were no rows
+    """
+    parquet_path = f'/tmp/{request_id}_load.parquet'
+    try:
+        row_count = write_parquet_file(request_id, json_files, parquet_path)
+        if not row_count:
+            return None
+
+        with open(parquet_path, 'rb') as f:
+            return bq_client.load_table_from_file(
+                f,
+                table_ref,
+                job_config=load_job_config(bigquery.SourceFormat.PARQUET),
+                job_id=job_id)
+    finally:
+        if os.path.exists(parquet_path):
+            os.remove(parquet_path)
+
+
+def load_chunks(request_id, json_files, table_ref, job_id=None):
+    """
+    Start a load job for processed chunks in the LOAD_FILE_FORMAT format.
+    """
+    if LOAD_FILE_FORMAT == 'parquet':
+        return load_parquet_file(request_id, json_files, table_ref, job_id)
+    return load_json_rows(request_id, json_files, table_ref, job_id)
+
+
+def build_rows(request_id, json_files):
+    """
+    Build the rows of a load in the LOAD_FILE_FORMAT format without
+    starting it (BQ_DRY_RUN).
+
+    Returns:
+        int: Number of rows built
+    """
+    if LOAD_FILE_FORMAT == 'parquet':
+        parquet_path = f'/tmp/{request_id}_dry_run.parquet'
+        try:
+            return write_parquet_file(request_id, json_files, parquet_path)
+        finally:
+            if os.path.exists(parquet_path):
+                os.remove(parquet_path)
+    return len(collect_rows(request_id, json_files))
+
+
+def ledger_object(request_id, json_file):
+    return f"{request_id}/bq_ledger/{json_file}"
+
+
+def write_ledger_entry(request_id, json_file, entry):
+    object_store.write_json(GCS_BUCKET_NAME,
+                            ledger_object(request_id, json_file), entry)
+
+
+def read_ledger(request_id):
+    """
+    Completion ledger of a request: one entry per chunk that has been
+    (or is being) loaded into BigQuery.
+
+    Returns:
+        dict: {json_file: ledger entry}
+    """
+    object_names = object_store.list_objects(GCS_BUCKET_NAME,
+                                             f"{request_id}/bq_ledger/")
+    entries = object_store.read_json_many(GCS_BUCKET_NAME, object_names)
+    return {
+        os.path.basename(object_name): entry
+        for object_name, entry in zip(object_names, entries)
+    }
+
+
+def stale_chunks(request_id, json_files):
+    """
+    Chunks whose current processed JSON is not loaded yet, according to the
+    ledger (all of them when RESUME is off).
+
+    Returns:
+        list: (json_file, generation, previous ledger entry or None) of
+        every chunk to load
+    """
+    generations = object_store.generation_many(
+        GCS_BUCKET_NAME,
+        [f"{request_id}/processed_chunks/{json_file}" for json_file in json_files])
+    ledger = read_ledger(request_id)
+    stale = []
+    for json_file, generation in zip(json_files, generations):
+        entry = ledger.get(json_file)
+        if (checkpoint.RESUME and entry and entry.get('state') == 'loaded'
+                and entry['generation'] == generation):
+            continue
+        stale.append((json_file, generation, entry))
+    return stale
+
+
+def delete_chunk_rows(table_ref, request_id, segment_file):
+    """
+    Remove the rows of an earlier load of the same chunk.
+    """
+    query = (f"DELETE FROM `{table_ref.project}.{table_ref.dataset_id}."
+             f"{table_ref.table_id}` "
+             "WHERE request_id = @request_id AND segment_file = @segment_file")
+    job_config = bigquery.QueryJobConfig(query_parameters=[
+        bigquery.ScalarQueryParameter("request_id", "STRING", request_id),
+        bigquery.ScalarQueryParameter("segment_file", "STRING", segment_file)
+    ])
+    bq_client.query(query, job_config=job_config).result()
+
+
+def chunk_job_id(request_id, json_file, generation):
+    """
+    Load job ID of one generation of a chunk. Job IDs only allow letters,
+    digits, '_' and '-', which request IDs, object names and event
+    generations need not keep to, so the parts are hashed.
+    """
+    key = json.dumps([request_id, json_file, str(generation)])
+    return f"chunk_{hashlib.sha256(key.encode()).hexdigest()}"
+
+
+def load_chunk(request_id, json_file, generation):
+    """
+    Load one processed chunk into BigQuery, at most once per object
+    generation.
+
+    The load job ID is derived from (request_id, chunk, generation), so a
+    retried event finds the job it already started instead of loading the
+    rows again. A new generation of the same chunk (e.g. rewritten by track
+    stitching) replaces the rows of the previous one.
+
+    Returns:
+        dict: The chunk's ledger entry
+    """
+    try:
+        entry = object_store.read_json(GCS_BUCKET_NAME,
+                                       ledger_object(request_id, json_file))
+    except FileNotFoundError:
+        entry = None
+    if entry and entry['generation'] == str(generation) and entry.get(
+            'state') == 'loaded':
+        logger.info(f"{json_file} generation {generation} already loaded")
+        return entry
+
+    segment_file = json_file.replace('.json', '.mp4')
+    table_ref = ensure_table()
+    if entry and entry['generation'] != str(generation):
+        logger.info(f"Replacing rows of {json_file} generation "
+                    f"{entry['generation']}")
+        delete_chunk_rows(table_ref, request_id, segment_file)
+
+    job_id = chunk_job_id(request_id, json_file, generation)
+    entry = {
+        'generation': str(generation),
+        'job_id': job_id,
+        'state': 'loading'
+    }
+    write_ledger_entry(request_id, json_file, entry)
+
+    # Only this chunk's rows are held in memory
+    try:
+        load_job = load_chunks(request_id, [json_file], table_ref, job_id)
+    except Conflict:
+        logger.info(f"Load job {job_id} already exists, waiting for it")
+        load_job = bq_client.get_job(job_id)
+    if load_job:
+        load_job.result()
+        entry['rows'] = load_job.output_rows
+    else:
+        entry['rows'] = 0
+
+    entry['state'] = 'loaded'
+    entry['loaded_at'] = datetime.now(timezone.utc).isoformat()
+    write_ledger_entry(request_id, json_file, entry)
+    logger.info(f"Loaded {entry['rows']} rows of {json_file} into: "
+                f"{DATASET_ID}.{TABLE_ID}")
+    return entry
+
+
+@functions_framework.cloud_event
+def load_chunk_to_bigquery(cloud_event):
+    """
+    Load a processed chunk as soon as the tracking job uploads its JSON.
+    Triggered by object finalize events on the tracking bucket.
+    """
+    data = cloud_event.data
+    object_name = data.get('name', '')
+    parts = object_name.split('/')
+    if (len(parts) != 3 or parts[1] != 'processed_chunks'
+            or not parts[2].endswith('.json')):
+        return
+
+    request_id, _, json_file = parts
+    try:
+        load_chunk(request_id, json_file, data.get('generation'))
+    except Exception as e:
+        logger.error(f"Error loading {object_name}: {str(e)}")
+        logger.error(f"Traceback: {traceback.format_exc()}")
+        # Re-raise so the event is retried
         raise
 
 
@@ -48,118 +430,93 @@ def write_to_bigquery(request):
 
         request_id = request_json['request_id']
         logger.info(f"Processing request ID: {request_id}")
+        timer = StageTimer('bigquery', request_id)
 
-        # Download and read manifest.json
-        manifest_path = f'/tmp/manifest.json'
-        download_blob(GCS_BUCKET_NAME, f"{request_id}/manifest.json",
-                      manifest_path)
-
-        with open(manifest_path, 'r') as f:
-            manifest_data = json.load(f)
-
-        # Prepare rows for BigQuery insertion
-        rows_to_insert = []
-        for segment in manifest_data.get('segments', []):
-            json_file = segment['segment_file'].replace('.mp4', '.json')
-            json_path = f'/tmp/{json_file}'
-            download_blob(GCS_BUCKET_NAME,
-                          f"{request_id}/processed_chunks/{json_file}",
-                          json_path)
-
-            with open(json_path, 'r') as f:
-                segment_data = json.load(f)
-
-            for item in segment_data:
-                try:
-                    box_data = item.get('box', [{}])[0]  # Get the box object
-                    row = {
-                        'track_id': item.get('track_id'),
-                        'frame_id': item.get('frame_id'),
-                        'class_name': item.get('class_name'),
-                        'class_id': item.get('class_id'),
-                        'confidence': item.get('confidence'),
-                        'box': {
-                            'x1': box_data.get('x1'),
-                            'y1': box_data.get('y1'),
-                            'x2': box_data.get('x2'),
-                            'y2': box_data.get('y2')
-                        },
-                        'timestamp': item.get('timestamp'),
-                        'request_id': item.get('request_id')
-                    }
-                    # Handle the 'box' field
-                    if row['box'] is None:
-                        row['box'] = [
-                            None, None, None, None
-                        ]  # This will be inserted as [null, null, null, null] in JSON
-                    rows_to_insert.append(row)
-
-                except Exception as e:
-                    logger.error(f"Error processing item: {item}")
-                    logger.error(f"Error details: {str(e)}")
-
-            os.remove(json_path)
-
-        if not rows_to_insert:
-            logger.warning("No valid data found in processed chunks")
-            return
-
-        # Continue with BigQuery insertion if there are valid rows
-        # Define the table reference
-        table_ref = bq_client.dataset(DATASET_ID).table(TABLE_ID)
-
-        # Check if the table exists, if not create it
-        try:
-            bq_client.get_table(table_ref)
-        except NotFound:
-            schema = [
-                bigquery.SchemaField("request_id", "STRING", mode="NULLABLE"),
-                bigquery.SchemaField("track_id", "INTEGER", mode="NULLABLE"),
-                bigquery.SchemaField("frame_id", "INTEGER", mode="NULLABLE"),
-                bigquery.SchemaField("class_name", "STRING", mode="NULLABLE"),
-                bigquery.SchemaField("class_id", "INTEGER", mode="NULLABLE"),
-                bigquery.SchemaField("confidence", "FLOAT", mode="NULLABLE"),
-                bigquery.SchemaField("timestamp", "FLOAT", mode="NULLABLE"),
-                bigquery.SchemaField("box",
-                                     "RECORD",
-                                     mode="NULLABLE",
-                                     fields=[
-                                         bigquery.SchemaField("x1",
-                                                              "INTEGER",
-                                                              mode="NULLABLE"),
-                                         bigquery.SchemaField("y1",
-                                                              "INTEGER",
-                                                              mode="NULLABLE"),
-                                         bigquery.SchemaField("x2",
-                                                              "INTEGER",
-                                                              mode="NULLABLE"),
-                                         bigquery.SchemaField("y2",
-                                                              "INTEGER",
-                                                              mode="NULLABLE")
-                                     ])
-            ]
-            table = bigquery.Table(table_ref, schema=schema)
-            bq_client.create_table(table)
-            logger.info(f"Created table {DATASET_ID}.{TABLE_ID}")
+        # Read manifest.json
+        with timer.stage('manifest'):
+            manifest_data = read_json_object(f"{request_id}/manifest.json")
 
-        # Load the data
-        job_config = bigquery.LoadJobConfig()
-        job_config.source_format = bigquery.SourceFormat.NEWLINE_DELIMITED_JSON
+        # Chunks were loaded as they landed; report the completion ledger
+        if BQ_LOAD_MODE == 'event':
+            json_files = [
+                segment['segment_file'].replace('.mp4', '.json')
+                for segment in manifest_data.get('segments', [])
+            ]
+            with timer.stage('ledger'):
+                ledger = read_ledger(request_id)
+            loaded = [
+                json_file for json_file in json_files
+                if ledger.get(json_file, {}).get('state') == 'loaded'
+            ]
+            status = {
+                'request_id': request_id,
+                'segment_count': len(json_files),
+                'loaded_segments': len(loaded),
+                'rows': sum(ledger[json_file].get('rows', 0)
+                            for json_file in loaded),
+                'pending': sorted(set(json_files) - set(loaded))
+            }
+            logger.info(f"BigQuery ledger: {json.dumps(status)}")
+            record_timings(timer, GCS_BUCKET_NAME, summarize_manifest=True)
+            return json.dumps(status), 200 if not status['pending'] else 202
 
-        job_config.schema_update_options = [
-            bigquery.SchemaUpdateOption.ALLOW_FIELD_ADDITION
+        json_files = [
+            segment['segment_file'].replace('.mp4', '.json')
+            for segment in manifest_data.get('segments', [])
         ]
-        job_config.ignore_unknown_values = True
+        if BQ_DRY_RUN:
+            with timer.stage('rows'):
+                row_count = build_rows(request_id, json_files)
+            logger.info(f"Dry run built {row_count} rows")
+            record_timings(timer, GCS_BUCKET_NAME, summarize_manifest=True)
+            return f"Dry run built {row_count} rows", 200
+
+        table_ref = ensure_table()
 
+        # Only chunks that are new or changed since their last load are
+        # loaded; the ledger records what is in the table
+        with timer.stage('ledger'):
+            stale = stale_chunks(request_id, json_files)
+        if not stale:
+            logger.info("Every chunk is already loaded")
+            record_timings(timer, GCS_BUCKET_NAME, summarize_manifest=True)
+            return f"All {len(json_files)} chunks already loaded", 200
+        logger.info(f"Loading {len(stale)} of {len(json_files)} chunks")
+
+        # Load the data
         try:
-            load_job = bq_client.load_table_from_json(rows_to_insert,
-                                                      table_ref,
-                                                      job_config=job_config)
-            # Wait for the job to complete
-            load_job.result()
+            with timer.stage('load'):
+                for json_file, generation, entry in stale:
+                    # An earlier load of the chunk may have landed rows
+                    if entry:
+                        delete_chunk_rows(table_ref, request_id,
+                                          json_file.replace('.json', '.mp4'))
+                    write_ledger_entry(request_id, json_file, {
+                        'generation': generation,
+                        'state': 'loading'
+                    })
+                load_job = load_chunks(
+                    request_id, [json_file for json_file, _, _ in stale],
+                    table_ref)
+                if load_job is not None:
+                    # Wait for the job to complete
+                    load_job.result()
+            loaded_at = datetime.now(timezone.utc).isoformat()
+            for json_file, generation, _ in stale:
+                write_ledger_entry(
+                    request_id, json_file, {
+                        'generation': generation,
+                        'job_id': load_job.job_id if load_job else None,
+                        'state': 'loaded',
+                        'loaded_at': loaded_at
+                    })
+            if load_job is None:
+                logger.warning("No valid data found in processed chunks")
+                return
             logger.info(
                 f"Loaded {load_job.output_rows} rows into: {DATASET_ID}.{TABLE_ID}"
             )
+            record_timings(timer, GCS_BUCKET_NAME, summarize_manifest=True)
             return f"Successfully loaded {load_job.output_rows} rows", 200
         except Exception as e:
             logger.error(f"Error inserting data into BigQuery: {str(e)}")
@@ -0,0 +1,104 @@
+# Completion markers for resumable processing
+#
+# When a stage finishes a unit of work (splitting a request, tracking a
+# chunk, stitching, merging) it writes a marker under {request_id}/markers/
+# holding a fingerprint of what the output was built from: the generations
+# of the input objects and a hash of the configuration that shapes the
+# output. A re-run skips the unit while its marker still matches and its
+# outputs still exist, so only missing or stale work is redone. A unit that
+# is redone rewrites its outputs with new generations, which makes the
+# markers of the units downstream of it stale in turn.
+import hashlib
+import json
+import os
+import time
+
+import object_store
+
+MARKERS_PREFIX = 'markers'
+# RESUME=false redoes every unit whatever its marker says
+RESUME = os.environ.get('RESUME', 'true').lower() == 'true'
+# Read size when hashing local files
+HASH_BLOCK_SIZE = 1 << 20
+
+
+def config_hash(config):
+    """
+    Stable short hash of a JSON-serializable configuration.
+    """
+    return hashlib.sha256(
+        json.dumps(config, sort_keys=True,
+                   default=str).encode()).hexdigest()[:16]
+
+
+def file_digest(path):
+    """
+    SHA-256 of a local file, e.g. model weights, read in blocks. A
+    directory (e.g. an OpenVINO model) is hashed over its files in name
+    order.
+    """
+    digest = hashlib.sha256()
+    if os.path.isdir(path):
+        paths = sorted(
+            os.path.join(root, name) for root, _, names in os.walk(path)
+            for name in names)
+    else:
+        paths = [path]
+    for file_path in paths:
+        with open(file_path, 'rb') as f:
+            for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def fingerprint(bucket_name, object_names, config):
+    """
+    Fingerprint of a unit of work built from object_names in bucket_name
+    with config.
+
+    Raises:
+        FileNotFoundError: If an input object does not exist
+    """
+    object_names = list(object_names)
+    generations = object_store.generation_many(bucket_name, object_names)
+    return {
+        'inputs': dict(zip(object_names, generations)),
+        'config': config_hash(config)
+    }
+
+
+def marker_object(request_id, unit):
+    return f"{request_id}/{MARKERS_PREFIX}/{unit}.json"
+
+
+def is_complete(bucket_name, request_id, unit, unit_fingerprint):
+    """
+    Whether unit was completed from the same inputs and configuration and
+    the outputs its marker lists are all still in bucket_name.
+    """
+    if not RESUME:
+        return False
+    try:
+        marker = object_store.read_json(bucket_name,
+                                        marker_object(request_id, unit))
+        if marker.get('fingerprint') != unit_fingerprint:
+            return False
+        # Raises FileNotFoundError for a missing output
+        object_store.generation_many(bucket_name, marker.get('outputs', []))
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def mark_complete(bucket_name, request_id, unit, unit_fingerprint, outputs=()):
+    """
+    Record that unit built outputs (object names in bucket_name); written
+    after the outputs so a run that fails part way leaves no marker.
+    """
+    object_store.write_json(
+        bucket_name, marker_object(request_id, unit), {
+            'unit': unit,
+            'fingerprint': unit_fingerprint,
+            'outputs': list(outputs),
+            'completed_at': time.time()
+        })
@@ -0,0 +1,171 @@
+# Per-request detection options shared by the YOLO service and the fused
+# tracking pipeline
+#
+# - imgsz: inference size passed to model.predict (None = model default)
+# - classes: allow-list of class IDs or names, applied by the model's NMS so
+#   other classes never leave the model call
+# - regions of interest: a list of rectangles [x1, y1, x2, y2] and/or
+#   polygons [[x, y], [x, y], ...] in full-frame pixels. Frames are cropped
+#   to the bounding box of the regions and the pixels outside them are
+#   masked, so the model sees only the road; shift_boxes() maps the
+#   detections back to full-frame coordinates.
+import json
+
+import cv2
+import numpy as np
+
+# Letterbox grey, which the model already sees as padding
+MASK_COLOR = (114, 114, 114)
+
+
+def parse_imgsz(value):
+    """
+    Parse an inference size; None, '' and 0 mean the model default.
+
+    Raises:
+        ValueError: If the size is not a positive integer
+    """
+    if value in (None, ''):
+        return None
+    imgsz = int(value)
+    if imgsz < 0:
+        raise ValueError(f"Invalid imgsz {value!r}")
+    return imgsz or None
+
+
+def parse_classes(value, names):
+    """
+    Parse a class allow-list.
+
+    Args:
+        value: List of class IDs and/or names, or a comma-separated string
+            of them; None or '' allows every class
+        names (dict): Class ID to name mapping of the model
+
+    Returns:
+        list: Sorted class IDs, or None for every class
+
+    Raises:
+        ValueError: If a class is not known to the model
+    """
+    if value in (None, '', []):
+        return None
+    if isinstance(value, str):
+        value = [item.strip() for item in value.split(',') if item.strip()]
+    ids_by_name = {name: class_id for class_id, name in names.items()}
+    class_ids = set()
+    for item in value:
+        if isinstance(item, str) and not item.isdigit():
+            if item not in ids_by_name:
+                raise ValueError(f"Unknown class {item!r}")
+            class_ids.add(int(ids_by_name[item]))
+        elif int(item) in names:
+            class_ids.add(int(item))
+        else:
+            raise ValueError(f"Unknown class ID {item!r}")
+    return sorted(class_ids)
+
+
+def parse_regions(value):
+    """
+    Parse regions of interest.
+
+    Args:
+        value: List of regions, or its JSON encoding; None or '' for the
+            whole frame
+
+    Returns:
+        list: One (N, 2) int32 array of polygon vertices per region, or
+        None for the whole frame
+
+    Raises:
+        ValueError: If a region is neither a rectangle nor a polygon
+    """
+    if value in (None, '', []):
+        return None
+    if isinstance(value, str):
+        value = json.loads(value)
+    if not isinstance(value, list):
+        raise ValueError('Regions of interest must be a list of regions')
+    regions = []
+    for region in value:
+        if (isinstance(region, list) and len(region) == 4 and
+                all(isinstance(v, (int, float)) for v in region)):
+            x1, y1, x2, y2 = (int(round(v)) for v in region)
+            if x2 <= x1 or y2 <= y1:
+                raise ValueError(f"Empty rectangle {region!r}")
+            # Rectangles exclude their right and bottom edges
+            points = [[x1, y1], [x2 - 1, y1], [x2 - 1, y2 - 1],
+                      [x1, y2 - 1]]
+        elif (isinstance(region, list) and len(region) >= 3 and
+              all(isinstance(p, list) and len(p) == 2 for p in region)):
+            points = region
+        else:
+            raise ValueError(
+                f"Region {region!r} is neither a rectangle [x1, y1, x2, y2] "
+                "nor a polygon [[x, y], ...]")
+        regions.append(np.round(np.array(points, np.float64)).astype(
+            np.int32))
+    return regions
+
+
+def regions_to_list(regions):
+    """
+    JSON-serializable form of parsed regions, e.g. for cache keys.
+    """
+    return [region.tolist() for region in regions] if regions else None
+
+
+class RegionCrop:
+    """
+    Crops frames of one size to the bounding box of the regions of
+    interest and masks the pixels outside them.
+
+    Args:
+        regions (list): Parsed regions, see parse_regions
+        frame_shape (tuple): (height, width, ...) of the frames
+
+    Raises:
+        ValueError: If the regions lie outside the frame
+    """
+
+    def __init__(self, regions, frame_shape):
+        height, width = frame_shape[:2]
+        points = np.concatenate(regions)
+        x1, y1 = np.maximum(points.min(axis=0), 0)
+        x2, y2 = np.minimum(points.max(axis=0) + 1, [width, height])
+        if x2 <= x1 or y2 <= y1:
+            raise ValueError('Regions of interest lie outside the frame')
+        self.offset = (int(x1), int(y1))
+        self.window = (slice(int(y1), int(y2)), slice(int(x1), int(x2)))
+        mask = np.zeros((int(y2 - y1), int(x2 - x1)), np.uint8)
+        cv2.fillPoly(mask, [region - self.offset for region in regions], 255)
+        # A single rectangle fills its crop and needs no masking
+        self.outside = None if mask.all() else mask == 0
+
+    def apply(self, frame):
+        """
+        The cropped and masked copy of a frame the model runs on.
+        """
+        crop = np.ascontiguousarray(frame[self.window])
+        if self.outside is not None:
+            crop[self.outside] = MASK_COLOR
+        return crop
+
+
+def shift_boxes(result, offset):
+    """
+    Move the boxes of an ultralytics result on a crop to full-frame
+    coordinates.
+    """
+    x, y = offset
+    if not (x or y):
+        return result
+    # Copied rather than updated in place: results created under
+    # torch.inference_mode cannot be modified outside of it
+    data = result.boxes.data
+    data = data.clone() if hasattr(data, 'clone') else data.copy()
+    data[:, 0:4:2] += x
+    data[:, 1:4:2] += y
+    result.boxes.data = data
+    return result
@@ -0,0 +1,381 @@
+# Object storage shared by every pipeline stage
+#
+# Buckets are named as before ('my-bucket' or 'gs://my-bucket') or point at a
+# local directory with 'file:///data/my-bucket', so the whole pipeline can run
+# and be benchmarked offline with the same object names. Every GCS call goes
+# through one storage.Client per process, created on first use, whose HTTP
+# connection pool is sized for STORAGE_WORKERS parallel transfers.
+#
+# The module is copied next to each stage's entry point when its image is
+# built (see the Dockerfiles); run locally with PYTHONPATH=../common.
+import json
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from google.api_core.exceptions import NotFound
+    from google.cloud import storage
+    import requests.adapters
+except ImportError:
+    # Only the local filesystem backend is available
+    storage = None
+    NotFound = FileNotFoundError
+
+# Transfers run concurrently by the *_many helpers
+STORAGE_WORKERS = int(os.environ.get('STORAGE_WORKERS', 8))
+
+GCS_SCHEME = 'gs://'
+FILE_SCHEME = 'file://'
+
+_client = None
+_client_lock = threading.Lock()
+_buckets = {}
+
+
+def get_client():
+    """
+    Process-wide storage.Client, created on first use.
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            if storage is None:
+                raise ImportError(
+                    "google-cloud-storage is needed for GCS buckets")
+            _client = storage.Client()
+            # One pooled connection per parallel transfer instead of the
+            # requests default of 10
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=STORAGE_WORKERS,
+                pool_maxsize=STORAGE_WORKERS)
+            _client._http.mount('https://', adapter)
+        return _client
+
+
+class GcsBucket:
+    """
+    Objects in a Cloud Storage bucket. Missing objects raise
+    FileNotFoundError, as with LocalBucket.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.bucket = get_client().bucket(name)
+
+    def uri(self, object_name):
+        return f'{GCS_SCHEME}{self.name}/{object_name}'
+
+    def download(self, object_name, path):
+        try:
+            self.bucket.blob(object_name).download_to_filename(path)
+        except NotFound:
+            # The client leaves an empty file behind
+            if os.path.exists(path):
+                os.remove(path)
+            raise FileNotFoundError(self.uri(object_name))
+
+    def upload(self, path, object_name, content_type=None):
+        self.bucket.blob(object_name).upload_from_filename(
+            path, content_type=content_type)
+
+    def read(self, object_name):
+        try:
+            return self.bucket.blob(object_name).download_as_bytes()
+        except NotFound:
+            raise FileNotFoundError(self.uri(object_name))
+
+    def read_range(self, object_name, start, end):
+        try:
+            # download_as_bytes takes an inclusive end
+            return self.bucket.blob(object_name).download_as_bytes(
+                start=start, end=end - 1)
+        except NotFound:
+            raise FileNotFoundError(self.uri(object_name))
+
+    def write(self, object_name, data, content_type=None):
+        self.bucket.blob(object_name).upload_from_string(
+            data, content_type=content_type)
+
+    def open(self, object_name):
+        # Fetches the object in chunks as the caller reads it; a missing
+        # object surfaces as NotFound on the first read
+        return self.bucket.blob(object_name).open('rb')
+
+    def exists(self, object_name):
+        return self.bucket.blob(object_name).exists()
+
+    def generation(self, object_name):
+        blob = self.bucket.get_blob(object_name)
+        if blob is None:
+            raise FileNotFoundError(self.uri(object_name))
+        return str(blob.generation)
+
+    def size(self, object_name):
+        blob = self.bucket.get_blob(object_name)
+        if blob is None:
+            raise FileNotFoundError(self.uri(object_name))
+        return blob.size
+
+    def list(self, prefix=''):
+        return [
+            blob.name
+            for blob in get_client().list_blobs(self.name, prefix=prefix)
+        ]
+
+    def delete(self, object_name):
+        try:
+            self.bucket.blob(object_name).delete()
+        except NotFound:
+            pass
+
+
+class LocalBucket:
+    """
+    Objects stored as files under a directory, named by their object path.
+    Writes go through a temporary file so readers never see partial objects.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def uri(self, object_name):
+        return f'{FILE_SCHEME}{self._path(object_name)}'
+
+    def _path(self, object_name):
+        return os.path.join(self.root, object_name)
+
+    def _replace(self, object_name, write):
+        path = self._path(object_name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f'{path}.{threading.get_ident()}.tmp'
+        write(temp_path)
+        os.replace(temp_path, path)
+
+    def download(self, object_name, path):
+        shutil.copyfile(self._path(object_name), path)
+
+    def upload(self, path, object_name, content_type=None):
+        self._replace(object_name,
+                      lambda temp_path: shutil.copyfile(path, temp_path))
+
+    def read(self, object_name):
+        with open(self._path(object_name), 'rb') as f:
+            return f.read()
+
+    def read_range(self, object_name, start, end):
+        with open(self._path(object_name), 'rb') as f:
+            f.seek(start)
+            return f.read(end - start)
+
+    def write(self, object_name, data, content_type=None):
+        if isinstance(data, str):
+            data = data.encode()
+
+        def write_data(temp_path):
+            with open(temp_path, 'wb') as f:
+                f.write(data)
+
+        self._replace(object_name, write_data)
+
+    def open(self, object_name):
+        return open(self._path(object_name), 'rb')
+
+    def exists(self, object_name):
+        return os.path.isfile(self._path(object_name))
+
+    def generation(self, object_name):
+        # Every write replaces the file, so its mtime and size identify
+        # the version like a GCS generation
+        stat = os.stat(self._path(object_name))
+        return f'{stat.st_mtime_ns}-{stat.st_size}'
+
+    def size(self, object_name):
+        return os.path.getsize(self._path(object_name))
+
+    def list(self, prefix=''):
+        names = []
+        for root, _, files in os.walk(self.root):
+            for file_name in files:
+                name = os.path.relpath(os.path.join(root, file_name),
+                                       self.root).replace(os.sep, '/')
+                if name.startswith(prefix) and not name.endswith('.tmp'):
+                    names.append(name)
+        return sorted(names)
+
+    def delete(self, object_name):
+        try:
+            os.remove(self._path(object_name))
+        except FileNotFoundError:
+            pass
+
+
+def get_bucket(bucket_name):
+    """
+    Storage backend for a bucket name: 'file://<dir>' is a local directory,
+    anything else ('name' or 'gs://name') a Cloud Storage bucket.
+    """
+    with _client_lock:
+        bucket = _buckets.get(bucket_name)
+    if bucket is not None:
+        return bucket
+    if bucket_name.startswith(FILE_SCHEME):
+        bucket = LocalBucket(bucket_name[len(FILE_SCHEME):])
+    elif bucket_name.startswith(GCS_SCHEME):
+        bucket = GcsBucket(bucket_name[len(GCS_SCHEME):].rstrip('/'))
+    else:
+        bucket = GcsBucket(bucket_name)
+    with _client_lock:
+        return _buckets.setdefault(bucket_name, bucket)
+
+
+def download(bucket_name, object_name, path):
+    get_bucket(bucket_name).download(object_name, path)
+
+
+def upload(bucket_name, path, object_name, content_type=None):
+    get_bucket(bucket_name).upload(path, object_name, content_type)
+
+
+def read_bytes(bucket_name, object_name):
+    """
+    Read a whole object into memory.
+    """
+    return get_bucket(bucket_name).read(object_name)
+
+
+def read_json(bucket_name, object_name):
+    """
+    Parse a JSON object while it is streamed, without a local copy.
+    """
+    bucket = get_bucket(bucket_name)
+    try:
+        with bucket.open(object_name) as f:
+            return json.load(f)
+    except NotFound:
+        raise FileNotFoundError(bucket.uri(object_name))
+
+
+def read_range(bucket_name, object_name, start, end):
+    """
+    Bytes [start, end) of an object, fetched with a ranged read.
+    """
+    return get_bucket(bucket_name).read_range(object_name, start, end)
+
+
+def size(bucket_name, object_name):
+    """
+    Size of an object in bytes.
+
+    Raises:
+        FileNotFoundError: If the object does not exist
+    """
+    return get_bucket(bucket_name).size(object_name)
+
+
+def write_bytes(bucket_name, object_name, data, content_type=None):
+    get_bucket(bucket_name).write(object_name, data, content_type)
+
+
+def write_json(bucket_name, object_name, value, indent=None):
+    separators = None if indent else (',', ':')
+    write_bytes(bucket_name,
+                object_name,
+                json.dumps(value, indent=indent, separators=separators),
+                content_type='application/json')
+
+
+def open_object(bucket_name, object_name):
+    """
+    Binary file-like object that streams the object's bytes on read.
+    """
+    return get_bucket(bucket_name).open(object_name)
+
+
+def exists(bucket_name, object_name):
+    return get_bucket(bucket_name).exists(object_name)
+
+
+def generation(bucket_name, object_name):
+    """
+    Identifier of the object's current version; changes whenever the object
+    is rewritten.
+    """
+    return get_bucket(bucket_name).generation(object_name)
+
+
+def list_objects(bucket_name, prefix=''):
+    """
+    Names of the objects under prefix.
+    """
+    return get_bucket(bucket_name).list(prefix)
+
+
+def delete(bucket_name, object_name):
+    get_bucket(bucket_name).delete(object_name)
+
+
+def _run_many(function, argument_lists, workers):
+    """
+    Call function with each argument tuple concurrently.
+
+    Returns:
+        list: Results in argument order; the first failure is re-raised
+    """
+    argument_lists = list(argument_lists)
+    if not argument_lists:
+        return []
+    with ThreadPoolExecutor(
+            max_workers=min(workers, len(argument_lists))) as executor:
+        futures = [
+            executor.submit(function, *arguments)
+            for arguments in argument_lists
+        ]
+        return [future.result() for future in futures]
+
+
+def download_many(bucket_name, transfers, workers=STORAGE_WORKERS):
+    """
+    Download (object_name, path) pairs in parallel.
+    """
+    bucket = get_bucket(bucket_name)
+    _run_many(bucket.download, transfers, workers)
+
+
+def upload_many(bucket_name, transfers, workers=STORAGE_WORKERS):
+    """
+    Upload (path, object_name) pairs in parallel.
+    """
+    bucket = get_bucket(bucket_name)
+    _run_many(bucket.upload, transfers, workers)
+
+
+def generation_many(bucket_name, object_names, workers=STORAGE_WORKERS):
+    """
+    Current generations of several objects, in object_names order.
+    """
+    bucket = get_bucket(bucket_name)
+    return _run_many(bucket.generation,
+                     ((object_name, ) for object_name in object_names),
+                     workers)
+
+
+def read_json_many(bucket_name, object_names, workers=STORAGE_WORKERS):
+    """
+    Parse several JSON objects in parallel, in memory.
+
+    Returns:
+        list: Parsed values in object_names order
+    """
+    return _run_many(read_json, ((bucket_name, object_name)
+                                 for object_name in object_names), workers)
+
+
+def write_json_many(bucket_name, values, workers=STORAGE_WORKERS):
+    """
+    Write (object_name, value) pairs as compact JSON objects in parallel.
+    """
+    _run_many(write_json, ((bucket_name, object_name, value)
+                           for object_name, value in values), workers)
@@ -0,0 +1,73 @@
+# Chunk frames followed by the head of the next chunk
+#
+# With OVERLAP_FRAMES the split job leaves every chunk as it was cut and
+# records the next chunk's name and the overlap in the chunk's metadata.
+# The stages that detect and track a chunk read its frames and then the
+# first overlap_frames frames of the next chunk through OverlapCapture,
+# which stands in for the cv2.VideoCapture they already use, so no chunk is
+# re-encoded to carry its overlap.
+import cv2
+
+
+class OverlapCapture:
+    """
+    cv2.VideoCapture over a video followed by up to overlap_frames frames
+    of the next video. Properties (size, frame rate) are those of the
+    first video.
+
+    Args:
+        video_path (str): Local path of the chunk
+        next_video_path (str): Local path of the next chunk
+        overlap_frames (int): Frames read from the next chunk
+    """
+
+    def __init__(self, video_path, next_video_path, overlap_frames):
+        self.capture = cv2.VideoCapture(video_path)
+        self.next_video_path = next_video_path
+        self.overlap_frames = overlap_frames
+        self.properties = {}
+        self.in_overlap = False
+        self.overlap_read = 0
+
+    def isOpened(self):
+        return self.capture.isOpened()
+
+    def get(self, prop):
+        if prop not in self.properties:
+            self.properties[prop] = self.capture.get(prop)
+        return self.properties[prop]
+
+    def read(self):
+        if not self.in_overlap:
+            ret, frame = self.capture.read()
+            if ret:
+                return ret, frame
+            # The chunk has ended; continue with the head of the next one
+            self.capture.release()
+            self.capture = cv2.VideoCapture(self.next_video_path)
+            self.in_overlap = True
+        if self.overlap_read >= self.overlap_frames:
+            return False, None
+        ret, frame = self.capture.read()
+        self.overlap_read += ret
+        return ret, frame
+
+    def release(self):
+        self.capture.release()
+
+
+def open_capture(video_path, overlap=None):
+    """
+    Open a chunk for reading, with its overlap if there is one.
+
+    Args:
+        video_path (str): Local path of the chunk
+        overlap (tuple): (next_video_path, overlap_frames), or None to read
+            the chunk alone
+
+    Returns:
+        cv2.VideoCapture or OverlapCapture
+    """
+    if overlap and overlap[1] > 0:
+        return OverlapCapture(video_path, *overlap)
+    return cv2.VideoCapture(video_path)
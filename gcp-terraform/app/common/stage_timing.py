@@ -0,0 +1,197 @@
+# Per-stage timing records for the pipeline jobs
+#
+# Each job run times its stages with a StageTimer and writes one JSON record
+# under {request_id}/timings/ in the tracking bucket, next to the request's
+# split and processed chunks. summarize_timings() folds every record of a
+# request into manifest.json under 'timings', including the critical path
+# through the workflow's phases, so where a request spent its time can be
+# read from one place.
+import json
+import resource
+import threading
+import time
+from contextlib import contextmanager
+
+import object_store
+
+TIMINGS_PREFIX = 'timings'
+# Workflow phases in order; jobs within a phase run concurrently, so a
+# phase takes as long as its slowest run
+PHASES = (('split', ), ('track', ), ('stitch', ), ('merge', 'bigquery'))
+# Times the summary is rewritten when records land while it is written
+SUMMARY_ATTEMPTS = 3
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+class StageTimer:
+    """
+    Wall-clock seconds, and optionally frames, of the named stages of one
+    job run.
+
+    Args:
+        job (str): Job name, one of the PHASES entries
+        request_id (str): Request the run belongs to
+        segment (str): Chunk the run processed, for per-chunk jobs
+    """
+
+    def __init__(self, job, request_id, segment=None):
+        self.job = job
+        self.request_id = request_id
+        self.segment = segment
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        self.stages = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name, frames=None):
+        """
+        Time the body of a with block as stage name.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start, frames)
+
+    def add(self, name, seconds, frames=None):
+        """
+        Add seconds (and frames) to a stage; repeated stages accumulate.
+        """
+        with self.lock:
+            entry = self.stages.setdefault(name, {'seconds': 0.0})
+            entry['seconds'] += seconds
+            if frames is not None:
+                entry['frames'] = entry.get('frames', 0) + frames
+
+    def record(self):
+        stages = {}
+        with self.lock:
+            for name, entry in self.stages.items():
+                stage = {'seconds': round(entry['seconds'], 4)}
+                if 'frames' in entry:
+                    stage['frames'] = entry['frames']
+                    stage['frames_per_second'] = (entry['frames'] /
+                                                  entry['seconds']
+                                                  if entry['seconds'] else 0.0)
+                stages[name] = stage
+        return {
+            'job': self.job,
+            'request_id': self.request_id,
+            'segment': self.segment,
+            'started_at': self.started_at,
+            'total_seconds': round(time.perf_counter() - self.start, 4),
+            'peak_rss_mb': round(peak_rss_mb(), 1),
+            'stages': stages
+        }
+
+    def write(self, bucket_name, name=None):
+        """
+        Log the record as one JSON line and store it under the request's
+        timings/ prefix.
+
+        Returns:
+            dict: The written record
+        """
+        record = self.record()
+        print(json.dumps({'message': f'{self.job} stage timings', **record}))
+        object_store.write_json(
+            bucket_name,
+            f"{self.request_id}/{TIMINGS_PREFIX}/{name or self.job}.json",
+            record)
+        return record
+
+
+def summarize(records):
+    """
+    Aggregate timing records per job and find the critical path.
+
+    Returns:
+        dict: Per-job totals and slowest runs, per-phase seconds and the
+        critical path through the phases
+    """
+    jobs = {}
+    for record in records:
+        job = jobs.setdefault(record['job'], {
+            'runs': 0,
+            'total_seconds': 0.0,
+            'max_seconds': 0.0,
+            'peak_rss_mb': 0.0,
+            'stages': {}
+        })
+        job['runs'] += 1
+        job['total_seconds'] += record['total_seconds']
+        job['peak_rss_mb'] = max(job['peak_rss_mb'], record['peak_rss_mb'])
+        if record['total_seconds'] >= job['max_seconds']:
+            job['max_seconds'] = record['total_seconds']
+            job['slowest_segment'] = record.get('segment')
+        for name, stage in record['stages'].items():
+            totals = job['stages'].setdefault(name, {
+                'seconds': 0.0,
+                'max_seconds': 0.0
+            })
+            totals['seconds'] += stage['seconds']
+            totals['max_seconds'] = max(totals['max_seconds'],
+                                        stage['seconds'])
+            if 'frames' in stage:
+                totals['frames'] = totals.get('frames', 0) + stage['frames']
+
+    phases = {}
+    critical_path = []
+    for phase in PHASES:
+        slowest = max(phase, key=lambda job: jobs.get(job, {}).get(
+            'max_seconds', 0.0))
+        if slowest not in jobs:
+            continue
+        phases['+'.join(phase)] = jobs[slowest]['max_seconds']
+        critical_path.append(slowest)
+    return {
+        'jobs': jobs,
+        'phase_seconds': phases,
+        'critical_path': critical_path,
+        'critical_path_seconds': round(sum(phases.values()), 4),
+        'record_count': len(records)
+    }
+
+
+def summarize_timings(bucket_name, request_id):
+    """
+    Fold every timing record of a request into its manifest.json.
+
+    Merge and BigQuery finish concurrently, so the records are listed again
+    after the manifest is written and the summary rewritten if one landed
+    in between; whichever job writes last sees every record.
+
+    Returns:
+        dict: The summary written to the manifest
+    """
+    prefix = f"{request_id}/{TIMINGS_PREFIX}/"
+    manifest_name = f"{request_id}/manifest.json"
+    record_names = object_store.list_objects(bucket_name, prefix)
+    for _ in range(SUMMARY_ATTEMPTS):
+        records = object_store.read_json_many(bucket_name, record_names)
+        manifest = object_store.read_json(bucket_name, manifest_name)
+        manifest['timings'] = summarize(records)
+        object_store.write_json(bucket_name, manifest_name, manifest, indent=2)
+        latest_names = object_store.list_objects(bucket_name, prefix)
+        if set(latest_names) == set(record_names):
+            break
+        record_names = latest_names
+    return manifest['timings']
+
+
+def record_timings(timer, bucket_name, name=None, summarize_manifest=False):
+    """
+    Write a job's timing record and optionally refresh the manifest
+    summary. Timing is best effort: a failure is logged, never raised.
+    """
+    try:
+        timer.write(bucket_name, name)
+        if summarize_manifest:
+            summarize_timings(bucket_name, timer.request_id)
+    except Exception as e:
+        print(f"Failed to record {timer.job} timings: {str(e)}")
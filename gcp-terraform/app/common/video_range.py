@@ -0,0 +1,195 @@
+# Virtual segments: time ranges of the original video read by byte range
+#
+# With SPLIT_MODE=virtual the split job never cuts or uploads segments. It
+# fetches only the container boxes of the original MP4/MOV object (ftyp,
+# moov, ...; everything but the media data), indexes the video packets with
+# ffprobe and describes each segment in its metadata as a keyframe-aligned
+# time range plus the byte range holding its packets. A stage that processes
+# the segment fetches the container boxes and that byte range into a sparse
+# local file laid out like the original, and ffmpeg stream-copies the
+# segment's frames out of it. Every stage reads only the bytes it needs and
+# the video bytes are stored once.
+import json
+import os
+import struct
+import subprocess
+
+import object_store
+
+# Top-level boxes holding the media data itself
+MEDIA_BOXES = (b'mdat', )
+# Boxes allowed at the start of an ISO base media (MP4/MOV) file
+LEADING_BOXES = (b'ftyp', b'moov', b'mdat', b'free', b'skip', b'wide',
+                 b'pnot', b'uuid', b'styp')
+
+
+def container_ranges(bucket_name, object_name):
+    """
+    Byte ranges of the top-level boxes of an MP4/MOV object other than its
+    media data, found by reading each box header with a ranged read. The
+    headers of the media data boxes are included, so demuxers can walk the
+    boxes of a sparse copy.
+
+    Returns:
+        tuple: Object size and a list of [start, end) byte ranges
+
+    Raises:
+        ValueError: If the object is not an MP4/MOV file
+    """
+    size = object_store.size(bucket_name, object_name)
+    ranges = []
+    offset = 0
+    while offset < size:
+        header = object_store.read_range(bucket_name, object_name, offset,
+                                         min(offset + 16, size))
+        if len(header) < 8:
+            raise ValueError(f"Truncated box header at byte {offset}")
+        box_size, box_type = struct.unpack('>I4s', header[:8])
+        if offset == 0 and box_type not in LEADING_BOXES:
+            raise ValueError(f"{object_name} is not an MP4/MOV file")
+        header_size = 8
+        if box_size == 1:
+            box_size = struct.unpack('>Q', header[8:16])[0]
+            header_size = 16
+        elif box_size == 0:
+            # The last box runs to the end of the file
+            box_size = size - offset
+        if box_size < 8:
+            raise ValueError(f"Invalid box size {box_size} at byte {offset}")
+        end = min(offset + box_size, size)
+        ranges.append([
+            offset, offset + header_size if box_type in MEDIA_BOXES else end
+        ])
+        offset = end
+    return size, ranges
+
+
+def write_sparse_copy(bucket_name, object_name, size, ranges, path):
+    """
+    Write a file of the object's size holding only the given byte ranges at
+    their original offsets; the rest is left as holes.
+    """
+    with open(path, 'wb') as f:
+        f.truncate(size)
+        for start, end in ranges:
+            f.seek(start)
+            f.write(object_store.read_range(bucket_name, object_name, start,
+                                            end))
+
+
+def packet_index(video_path):
+    """
+    Video packets of a file in decode order, according to ffprobe.
+
+    Returns:
+        list: (pts_time, pos, size, keyframe) per packet
+    """
+    ffprobe_command = [
+        'ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries',
+        'packet=pts_time,dts_time,pos,size,flags', '-of', 'json', video_path
+    ]
+    result = subprocess.run(ffprobe_command,
+                            check=True,
+                            capture_output=True,
+                            text=True)
+    packets = []
+    for packet in json.loads(result.stdout).get('packets', []):
+        pts_time = packet.get('pts_time', packet.get('dts_time'))
+        if pts_time in (None, 'N/A') or packet.get('pos') in (None, 'N/A'):
+            continue
+        packets.append((float(pts_time), int(packet['pos']),
+                        int(packet['size']), 'K' in packet.get('flags', '')))
+    return packets
+
+
+def plan_segments(packets, segment_duration, overlap_frames=0):
+    """
+    Cut the packet index into segments starting at the first keyframe at or
+    after every multiple of segment_duration, as ffmpeg's segment muxer
+    does.
+
+    Args:
+        packets (list): packet_index() of the original video
+        segment_duration (float): Target segment length in seconds
+        overlap_frames (int): Frames of the next segment each segment also
+            covers, for track stitching
+
+    Returns:
+        list: Per segment a dict with seek_time (keyframe pts in the
+        original), start_time (seconds from the first frame), duration,
+        frame_count, overlap_frames and byte_range ([start, end) of the
+        packets of the segment and its overlap)
+    """
+    if not packets:
+        return []
+    first_time = min(packet[0] for packet in packets)
+    last_time = max(packet[0] for packet in packets)
+    # Packets are in decode order, so the video ends one frame after the
+    # largest pts
+    end_time = last_time + (last_time - first_time) / max(1,
+                                                          len(packets) - 1)
+
+    starts = [0]
+    target = first_time + segment_duration
+    for index, (pts_time, _, _, keyframe) in enumerate(packets):
+        if index > 0 and keyframe and pts_time >= target - 1e-6:
+            starts.append(index)
+            while target <= pts_time + 1e-6:
+                target += segment_duration
+
+    segments = []
+    for number, start in enumerate(starts):
+        end = starts[number + 1] if number + 1 < len(starts) else len(packets)
+        overlap = min(overlap_frames, len(packets) - end)
+        covered = packets[start:end + overlap]
+        seek_time = packets[start][0]
+        next_time = packets[end][0] if end < len(packets) else end_time
+        segments.append({
+            'seek_time': seek_time,
+            'start_time': round(seek_time - first_time, 6),
+            'duration': round(next_time - seek_time, 6),
+            'frame_count': end - start,
+            'overlap_frames': overlap,
+            'byte_range': [
+                min(pos for _, pos, _, _ in covered),
+                max(pos + size for _, pos, size, _ in covered)
+            ]
+        })
+    return segments
+
+
+def extract_segment(metadata, path):
+    """
+    Fetch a virtual segment's bytes and write its frames, including any
+    overlap frames, to a local MP4 without re-encoding.
+
+    Args:
+        metadata (dict): Segment metadata written by the split job, with
+            the 'source' of a virtual segment
+        path (str): Local path of the segment video
+    """
+    source = metadata['source']
+    sparse_path = f'{path}.sparse'
+    try:
+        write_sparse_copy(source['bucket'], source['object'], source['size'],
+                          source['container_ranges'] + [source['byte_range']],
+                          sparse_path)
+        frame_count = metadata['frame_count'] + metadata.get(
+            'overlap_frames', 0)
+        # Input seeking lands on the segment's keyframe, so the copy starts
+        # exactly there. seek_time is the keyframe's pts as ffprobe reports
+        # it, so -seek_timestamp stops ffmpeg from adding the file's start
+        # time to it
+        ffmpeg_command = [
+            'ffmpeg', '-y', '-v', 'error', '-seek_timestamp', '1', '-ss',
+            str(source['seek_time']), '-i', sparse_path, '-map', '0:v:0',
+            '-c', 'copy', '-frames:v',
+            str(frame_count), '-avoid_negative_ts', 'make_zero', path
+        ]
+        subprocess.run(ffmpeg_command,
+                       check=True,
+                       capture_output=True,
+                       text=True)
+    finally:
+        if os.path.exists(sparse_path):
+            os.remove(sparse_path)
@@ -0,0 +1,374 @@
+# Local orchestrator for on-prem and test runs
+#
+# Runs what the Cloud Workflow runs -- split, tracking per chunk, track
+# stitching when chunks overlap, merge and BigQuery -- on one machine by
+# calling each stage's entry point in a process pool. Instead of polling
+# job status it reacts to task completion: a failed chunk is retried as
+# soon as it fails, merge starts the moment the last chunk is tracked and
+# BigQuery as soon as the chunk JSON is final (after stitching, which merge
+# only needs when it draws a deferred overlay, see OVERLAY_MODE).
+#
+# Buckets are object_store names as used by the jobs, a local directory
+# ('file:///data/tracking') or a GCS bucket:
+#
+#   python orchestrator.py --bucket file:///data/tracking --request-id r1
+#   python orchestrator.py --upload-bucket file:///data/upload \
+#       --input-video traffic.mp4 --bucket file:///data/tracking --workers 4
+#
+# In 'services' mode the tracking job calls the YOLO service at
+# YOLO_SERVICE_ENDPOINT (--yolo-endpoint); every other stage setting is
+# taken from the environment as in the Cloud Run jobs. Run with
+# PYTHONPATH=../common like the stages themselves.
+import argparse
+import importlib.util
+import json
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import object_store
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+COMMON_DIR = os.path.join(APP_DIR, 'common')
+
+# Directory, file and function of each stage's entry point
+ENTRY_POINTS = {
+    'split': ('video-split', 'video-split.py', 'split_video'),
+    'track': ('tracking-job', 'main.py', 'process_video'),
+    'track_fused': ('tracking-job', 'main.py', 'process_video_fused'),
+    'stitch': ('video-merge', 'track-stitch.py', 'stitch_tracks'),
+    'merge': ('video-merge', 'video-merge.py', 'merge_videos'),
+    'bigquery': ('bigquery', 'main.py', 'write_to_bigquery'),
+}
+
+
+class JsonRequest:
+    """
+    Stand-in for the flask request write_to_bigquery is called with.
+    """
+
+    def __init__(self, body):
+        self.body = body
+
+    def get_json(self):
+        return self.body
+
+
+def run_entry_point(stage, env, log_path=None, args=()):
+    """
+    Import a stage's module with env applied and call its entry point.
+
+    Runs in a fresh pool process per task, because the stage modules read
+    their configuration from the environment when they are imported.
+
+    Returns:
+        tuple: The entry point's return value, the wall-clock time the task
+        started and its duration in seconds
+    """
+    directory, file_name, function = ENTRY_POINTS[stage]
+    stage_dir = os.path.join(APP_DIR, directory)
+    if log_path:
+        log = os.open(log_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        os.dup2(log, 1)
+        os.dup2(log, 2)
+    os.environ.update(env)
+    sys.path[:0] = [stage_dir, COMMON_DIR]
+    os.chdir(stage_dir)
+
+    started_at = time.time()
+    start = time.perf_counter()
+    try:
+        spec = importlib.util.spec_from_file_location(
+            os.path.splitext(file_name)[0].replace('-', '_'),
+            os.path.join(stage_dir, file_name))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        result = getattr(module, function)(*args)
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+    return result, started_at, time.perf_counter() - start
+
+
+def entry_point_succeeded(stage, result):
+    """
+    Whether an entry point's return value reports success; the jobs report
+    most failures by returning an error instead of raising.
+    """
+    if stage in ('split', 'merge', 'bigquery'):
+        return isinstance(result, tuple) and result[1] == 200
+    if stage in ('track', 'track_fused'):
+        return isinstance(result, str) and result.startswith(
+            'Processing complete')
+    return True
+
+
+class Orchestrator:
+    """
+    Schedules the stages of one request over a process pool and advances
+    the pipeline as tasks complete.
+
+    Args:
+        args (argparse.Namespace): Parsed command line arguments
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.request_id = args.request_id
+        self.bucket = args.bucket
+        self.temp_dir = tempfile.mkdtemp(prefix=f'{self.request_id}-')
+        self.executor = ProcessPoolExecutor(
+            max_workers=args.workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            max_tasks_per_child=1)
+        # future -> (stage, key, env, args, attempt) of the running tasks
+        self.running = {}
+        # key -> summary of the task's last attempt
+        self.tasks = {}
+        self.failed = []
+        self.segments = None
+        self.tracking_left = None
+        self.started_at = time.time()
+
+    def log_path(self, key):
+        if not self.args.log_dir:
+            return None
+        return os.path.join(self.args.log_dir, f'{key}.log')
+
+    def submit(self, stage, key, env, args=(), attempt=1):
+        env = {'REQUEST_ID': self.request_id, **env}
+        future = self.executor.submit(run_entry_point, stage, env,
+                                      self.log_path(key), args)
+        self.running[future] = (stage, key, env, args, attempt)
+        print(f"Started {key}" +
+              (f" (attempt {attempt})" if attempt > 1 else ''))
+
+    def submit_split(self):
+        self.submit(
+            'split', 'split', {
+                'INPUT_BUCKET': self.args.upload_bucket,
+                'INPUT_VIDEO': self.args.input_video,
+                'OUTPUT_BUCKET': self.bucket
+            })
+
+    def submit_tracking(self):
+        manifest = object_store.read_json(self.bucket,
+                                          f"{self.request_id}/manifest.json")
+        self.segments = manifest.get('segments', [])
+        self.tracking_left = len(self.segments)
+        stage = ('track_fused'
+                 if self.args.pipeline_mode == 'fused' else 'track')
+        for segment in self.segments:
+            stem = os.path.splitext(segment['segment_file'])[0]
+            # Each chunk gets its own temporary files
+            temp_dir = os.path.join(self.temp_dir, stem)
+            os.makedirs(temp_dir, exist_ok=True)
+            self.submit(
+                stage, f"track_{stem}", {
+                    'INPUT_BUCKET': self.bucket,
+                    'INPUT_VIDEO':
+                    f"{self.request_id}/split_chunks/{segment['segment_file']}",
+                    'INPUT_METADATA': f"{stem}.json",
+                    'GCS_BUCKET_NAME': self.bucket,
+                    'PIPELINE_MODE': self.args.pipeline_mode,
+                    # Read at import even when the fused mode does not call it
+                    'YOLO_SERVICE_ENDPOINT': self.args.yolo_endpoint or '',
+                    'TEMP_DIR': temp_dir
+                })
+
+    def submit_merge(self):
+        self.submit(
+            'merge', 'merge', {
+                'INPUT_BUCKET': self.bucket,
+                'OUTPUT_BUCKET': self.args.output_bucket or self.bucket
+            })
+
+    def submit_bigquery(self):
+        if self.args.bigquery == 'skip':
+            return
+        env = {'GCS_BUCKET_NAME': self.bucket}
+        if self.args.bigquery == 'dry-run':
+            env['BQ_DRY_RUN'] = 'true'
+        self.submit('bigquery', 'bigquery', env,
+                    (JsonRequest({'request_id': self.request_id}), ))
+
+    def completed(self, future):
+        """
+        Record a finished task.
+
+        Returns:
+            tuple: The task's stage and whether it succeeded; None while a
+            retry is running
+        """
+        stage, key, env, args, attempt = self.running.pop(future)
+        summary = {'attempts': attempt}
+        try:
+            result, started_at, seconds = future.result()
+            succeeded = entry_point_succeeded(stage, result)
+            summary.update({
+                'start_offset': round(started_at - self.started_at, 4),
+                'seconds': round(seconds, 4)
+            })
+            if not succeeded:
+                summary['error'] = str(result)
+        except Exception as e:
+            succeeded = False
+            summary['error'] = f'{type(e).__name__}: {str(e)}'
+        summary['state'] = 'succeeded' if succeeded else 'failed'
+        self.tasks[key] = summary
+
+        if succeeded:
+            print(f"Finished {key} in {summary['seconds']:.2f}s")
+        elif stage.startswith('track') and attempt <= self.args.retries:
+            print(f"{key} failed ({summary['error']}), retrying")
+            self.submit(stage, key, env, args, attempt + 1)
+            return stage, None
+        else:
+            print(f"{key} failed: {summary['error']}")
+            self.failed.append(key)
+        return stage, succeeded
+
+    def run(self):
+        """
+        Run the request's pipeline to completion.
+
+        Returns:
+            dict: Wall-clock summary of every stage and task
+        """
+        try:
+            if self.args.input_video:
+                self.submit_split()
+            else:
+                self.submit_tracking()
+            while self.running:
+                done, _ = wait(self.running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage, succeeded = self.completed(future)
+                    if not succeeded:
+                        continue
+                    if stage == 'split':
+                        self.submit_tracking()
+                    elif stage.startswith('track'):
+                        self.tracking_left -= 1
+                        if self.tracking_left == 0 and not self.failed:
+                            self.tracking_finished()
+                    elif stage == 'stitch':
+                        if self.merge_reads_results():
+                            self.submit_merge()
+                        self.submit_bigquery()
+        finally:
+            self.executor.shutdown(cancel_futures=True)
+            shutil.rmtree(self.temp_dir, ignore_errors=True)
+        return self.summary()
+
+    @staticmethod
+    def merge_reads_results():
+        """
+        Whether merge draws the overlay from the chunk JSON instead of
+        concatenating annotated chunks.
+        """
+        return os.environ.get('OVERLAY_MODE', 'burned') != 'burned'
+
+    def tracking_finished(self):
+        stitch = any(
+            segment.get('overlap_frames') for segment in self.segments)
+        # Stitching only rewrites the chunk JSON, which merge only reads to
+        # draw a deferred overlay
+        if not (stitch and self.merge_reads_results()):
+            self.submit_merge()
+        if stitch:
+            self.submit('stitch', 'stitch', {'INPUT_BUCKET': self.bucket})
+        else:
+            self.submit_bigquery()
+
+    def summary(self):
+        stages = {}
+        for key, task in self.tasks.items():
+            if 'seconds' not in task:
+                continue
+            stage = 'track' if key.startswith('track_') else key
+            end = task['start_offset'] + task['seconds']
+            span = stages.setdefault(stage, {
+                'start_offset': task['start_offset'],
+                'end_offset': end,
+                'tasks': 0
+            })
+            span['start_offset'] = min(span['start_offset'],
+                                       task['start_offset'])
+            span['end_offset'] = max(span['end_offset'], end)
+            span['tasks'] += 1
+        for span in stages.values():
+            span['seconds'] = round(span['end_offset'] - span['start_offset'],
+                                    4)
+            span['end_offset'] = round(span['end_offset'], 4)
+        return {
+            'request_id': self.request_id,
+            'succeeded': not self.failed and not self.running,
+            'wall_seconds': round(time.time() - self.started_at, 4),
+            'workers': self.args.workers,
+            'stages': stages,
+            'tasks': self.tasks,
+            'failed': self.failed
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Run the video pipeline locally over a process pool')
+    parser.add_argument('--bucket',
+                        required=True,
+                        help='Tracking bucket holding the split chunks and '
+                        'outputs, e.g. file:///data/tracking')
+    parser.add_argument('--request-id',
+                        help='Request to process; new if --input-video is '
+                        'given without one')
+    parser.add_argument('--upload-bucket',
+                        help='Bucket of --input-video (split runs first)')
+    parser.add_argument('--input-video')
+    parser.add_argument('--output-bucket',
+                        help='Bucket for the merged video (default: --bucket)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--retries',
+                        type=int,
+                        default=2,
+                        help='Extra attempts for a failed chunk')
+    parser.add_argument('--pipeline-mode',
+                        choices=['services', 'fused'],
+                        default=os.environ.get('PIPELINE_MODE', 'services'))
+    parser.add_argument('--yolo-endpoint',
+                        default=os.environ.get('YOLO_SERVICE_ENDPOINT'))
+    parser.add_argument('--bigquery',
+                        choices=['load', 'dry-run', 'skip'],
+                        default='load')
+    parser.add_argument('--log-dir',
+                        help='Write each task\'s output to <log-dir>/<task>.log')
+    parser.add_argument('--summary', help='Also write the summary JSON here')
+    args = parser.parse_args()
+
+    if args.input_video:
+        if not args.upload_bucket:
+            parser.error('--input-video needs --upload-bucket')
+        args.request_id = args.request_id or str(uuid.uuid4())
+    elif not args.request_id:
+        parser.error('either --request-id or --input-video is required')
+    if args.pipeline_mode == 'services' and not args.yolo_endpoint:
+        parser.error('services mode needs --yolo-endpoint or '
+                     'YOLO_SERVICE_ENDPOINT')
+    if args.log_dir:
+        os.makedirs(args.log_dir, exist_ok=True)
+
+    summary = Orchestrator(args).run()
+    print(json.dumps(summary, indent=2))
+    if args.summary:
+        with open(args.summary, 'w') as f:
+            json.dump(summary, f, indent=2)
+    sys.exit(0 if summary['succeeded'] else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+# Benchmark the in-process ByteTrack engine on synthetic detections
+import argparse
+import time
+
+import numpy as np
+
+from bytetrack_engine import ByteTracker
+
+FRAME_COUNTS = [100, 500, 2000]
+DETECTIONS_PER_FRAME = [5, 20, 50, 100]
+
+
+def synthetic_detections(frame_count, detections_per_frame, seed=0):
+    """
+    Objects moving in straight lines with jittered boxes and scores.
+
+    Returns:
+        list: (boxes, scores, class_ids) per frame
+    """
+    rng = np.random.default_rng(seed)
+    start = rng.uniform(0, 1800, (detections_per_frame, 2))
+    velocity = rng.uniform(-4, 4, (detections_per_frame, 2))
+    size = rng.uniform(20, 120, (detections_per_frame, 2))
+    class_ids = rng.choice([2, 3, 5, 7], detections_per_frame)
+    frames = []
+    for frame_id in range(frame_count):
+        top_left = start + velocity * frame_id + rng.normal(
+            0, 1.5, (detections_per_frame, 2))
+        boxes = np.concatenate([top_left, top_left + size], axis=1)
+        scores = rng.uniform(0.2, 1.0, detections_per_frame)
+        frames.append((boxes, scores, class_ids))
+    return frames
+
+
+def run(frames):
+    """
+    Returns:
+        tuple: frames/sec and track outputs/sec
+    """
+    tracker = ByteTracker()
+    track_outputs = 0
+    start = time.perf_counter()
+    for boxes, scores, class_ids in frames:
+        track_ids, _, _, _ = tracker.update(boxes, scores, class_ids)
+        track_outputs += len(track_ids)
+    elapsed = time.perf_counter() - start
+    return len(frames) / elapsed, track_outputs / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measure ByteTracker throughput against frame count and '
+        'detections per frame')
+    parser.add_argument('--frame-counts',
+                        type=int,
+                        nargs='+',
+                        default=FRAME_COUNTS)
+    parser.add_argument('--detections-per-frame',
+                        type=int,
+                        nargs='+',
+                        default=DETECTIONS_PER_FRAME)
+    args = parser.parse_args()
+
+    print(f"{'frames':>7} {'dets/frame':>11} {'frames/sec':>11} "
+          f"{'tracks/sec':>11}")
+    for frame_count in args.frame_counts:
+        for detections_per_frame in args.detections_per_frame:
+            frames = synthetic_detections(frame_count, detections_per_frame)
+            fps, tps = run(frames)
+            print(f"{frame_count:>7} {detections_per_frame:>11} {fps:>11.1f} "
+                  f"{tps:>11.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,361 @@
+# In-process ByteTrack engine for the tracking job
+#
+# Follows the association scheme of ByteTrack
+# (https://github.com/ifzhang/ByteTrack) but keeps every track in struct-of-arrays form so Kalman prediction,
+# Kalman updates and IoU matrices run as NumPy operations over all tracks at
+# once instead of per-track Python objects.
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+
+# Track states
+NEW = 0
+TRACKED = 1
+LOST = 2
+
+# Kalman noise weights relative to the box height, as in ByteTrack
+STD_WEIGHT_POSITION = 1. / 20
+STD_WEIGHT_VELOCITY = 1. / 160
+
+# Constant velocity model over (cx, cy, aspect, height) and their velocities
+_MOTION = np.eye(8)
+_MOTION[:4, 4:] = np.eye(4)
+
+
+def iou_matrix(boxes_a, boxes_b):
+    """
+    Pairwise IoU between two sets of x1, y1, x2, y2 boxes.
+
+    Returns:
+        np.ndarray: (len(boxes_a), len(boxes_b)) IoU values
+    """
+    if len(boxes_a) == 0 or len(boxes_b) == 0:
+        return np.zeros((len(boxes_a), len(boxes_b)))
+    a = boxes_a[:, None, :]
+    b = boxes_b[None, :, :]
+    inter_w = np.clip(
+        np.minimum(a[..., 2], b[..., 2]) - np.maximum(a[..., 0], b[..., 0]),
+        0, None)
+    inter_h = np.clip(
+        np.minimum(a[..., 3], b[..., 3]) - np.maximum(a[..., 1], b[..., 1]),
+        0, None)
+    inter = inter_w * inter_h
+    area_a = (a[..., 2] - a[..., 0]) * (a[..., 3] - a[..., 1])
+    area_b = (b[..., 2] - b[..., 0]) * (b[..., 3] - b[..., 1])
+    return inter / np.maximum(area_a + area_b - inter, 1e-9)
+
+
+def xyxy_to_xyah(boxes):
+    width = boxes[:, 2] - boxes[:, 0]
+    height = boxes[:, 3] - boxes[:, 1]
+    return np.stack([
+        boxes[:, 0] + width / 2, boxes[:, 1] + height / 2,
+        width / np.maximum(height, 1e-9), height
+    ], axis=1)
+
+
+def xyah_to_xyxy(xyah):
+    width = xyah[:, 2] * xyah[:, 3]
+    height = xyah[:, 3]
+    return np.stack([
+        xyah[:, 0] - width / 2, xyah[:, 1] - height / 2,
+        xyah[:, 0] + width / 2, xyah[:, 1] + height / 2
+    ], axis=1)
+
+
+def match(cost, threshold):
+    """
+    Optimal assignment on a cost matrix, dropping pairs above threshold.
+
+    Returns:
+        tuple: matched (rows, cols), unmatched rows, unmatched cols
+    """
+    if cost.size == 0:
+        return (np.empty(0, int), np.empty(0, int)), np.arange(
+            cost.shape[0]), np.arange(cost.shape[1])
+    rows, cols = linear_sum_assignment(cost)
+    keep = cost[rows, cols] <= threshold
+    rows, cols = rows[keep], cols[keep]
+    unmatched_rows = np.setdiff1d(np.arange(cost.shape[0]), rows)
+    unmatched_cols = np.setdiff1d(np.arange(cost.shape[1]), cols)
+    return (rows, cols), unmatched_rows, unmatched_cols
+
+
+class ByteTracker:
+    """
+    Multi-object tracker with two-stage high/low confidence association.
+
+    Args:
+        track_thresh (float): Detections at or above this score are high
+            confidence
+        low_thresh (float): Detections below this score are ignored
+        match_thresh (float): Max IoU cost (1 - IoU) for first-stage matches
+        track_buffer (int): Frames a lost track is kept before removal
+        frame_rate (int): Video frame rate, scales track_buffer
+    """
+
+    def __init__(self,
+                 track_thresh=0.5,
+                 low_thresh=0.1,
+                 match_thresh=0.8,
+                 track_buffer=30,
+                 frame_rate=30):
+        self.track_thresh = track_thresh
+        self.low_thresh = low_thresh
+        self.match_thresh = match_thresh
+        self.new_track_thresh = track_thresh + 0.1
+        self.max_time_lost = int(frame_rate / 30.0 * track_buffer)
+        self.frame_id = 0
+        self.next_id = 1
+
+        self.mean = np.zeros((0, 8))
+        self.covariance = np.zeros((0, 8, 8))
+        self.track_ids = np.zeros(0, int)
+        self.state = np.zeros(0, int)
+        self.last_frame = np.zeros(0, int)
+        self.score = np.zeros(0)
+        self.class_id = np.zeros(0, int)
+
+    def _predict(self, idx):
+        mean = self.mean[idx]
+        # Lost tracks keep their position but stop growing
+        mean[self.state[idx] != TRACKED, 7] = 0
+        height = mean[:, 3]
+        std = np.stack([
+            STD_WEIGHT_POSITION * height, STD_WEIGHT_POSITION * height,
+            np.full_like(height, 1e-2), STD_WEIGHT_POSITION * height,
+            STD_WEIGHT_VELOCITY * height, STD_WEIGHT_VELOCITY * height,
+            np.full_like(height, 1e-5), STD_WEIGHT_VELOCITY * height
+        ], axis=1)
+        noise = np.einsum('ij,jk->ijk', std**2, np.eye(8))
+        self.mean[idx] = mean @ _MOTION.T
+        self.covariance[idx] = (_MOTION @ self.covariance[idx] @ _MOTION.T +
+                                noise)
+
+    def _update(self, idx, det_boxes, det_scores, det_classes):
+        if len(idx) == 0:
+            return
+        measurement = xyxy_to_xyah(det_boxes)
+        mean = self.mean[idx]
+        covariance = self.covariance[idx]
+        height = mean[:, 3]
+        std = np.stack([
+            STD_WEIGHT_POSITION * height, STD_WEIGHT_POSITION * height,
+            np.full_like(height, 1e-1), STD_WEIGHT_POSITION * height
+        ], axis=1)
+        innovation_cov = covariance[:, :4, :4] + np.einsum(
+            'ij,jk->ijk', std**2, np.eye(4))
+        # Kalman gain K = P H^T S^-1, solved for all tracks at once
+        gain = np.linalg.solve(innovation_cov,
+                               covariance[:, :4, :]).transpose(0, 2, 1)
+        innovation = measurement - mean[:, :4]
+        self.mean[idx] = mean + np.einsum('ijk,ik->ij', gain, innovation)
+        self.covariance[idx] = covariance - (
+            gain @ innovation_cov @ gain.transpose(0, 2, 1))
+        self.state[idx] = TRACKED
+        self.last_frame[idx] = self.frame_id
+        self.score[idx] = det_scores
+        self.class_id[idx] = det_classes
+
+    def _activate(self, idx):
+        count = len(idx)
+        self.track_ids[idx] = np.arange(self.next_id, self.next_id + count)
+        self.next_id += count
+
+    def _add_tracks(self, boxes, scores, classes, state):
+        measurement = xyxy_to_xyah(boxes)
+        count = len(boxes)
+        mean = np.zeros((count, 8))
+        mean[:, :4] = measurement
+        height = measurement[:, 3]
+        std = np.stack([
+            2 * STD_WEIGHT_POSITION * height, 2 * STD_WEIGHT_POSITION * height,
+            np.full_like(height, 1e-2), 2 * STD_WEIGHT_POSITION * height,
+            10 * STD_WEIGHT_VELOCITY * height,
+            10 * STD_WEIGHT_VELOCITY * height,
+            np.full_like(height, 1e-5), 10 * STD_WEIGHT_VELOCITY * height
+        ], axis=1)
+        start = len(self.mean)
+        self.mean = np.concatenate([self.mean, mean])
+        self.covariance = np.concatenate(
+            [self.covariance,
+             np.einsum('ij,jk->ijk', std**2, np.eye(8))])
+        self.track_ids = np.concatenate(
+            [self.track_ids, np.zeros(count, int)])
+        self.state = np.concatenate([self.state, np.full(count, state)])
+        self.last_frame = np.concatenate(
+            [self.last_frame, np.full(count, self.frame_id)])
+        self.score = np.concatenate([self.score, scores])
+        self.class_id = np.concatenate([self.class_id, classes])
+        if state == TRACKED:
+            self._activate(np.arange(start, start + count))
+
+    def _keep(self, mask):
+        self.mean = self.mean[mask]
+        self.covariance = self.covariance[mask]
+        self.track_ids = self.track_ids[mask]
+        self.state = self.state[mask]
+        self.last_frame = self.last_frame[mask]
+        self.score = self.score[mask]
+        self.class_id = self.class_id[mask]
+
+    def boxes(self, idx=None):
+        mean = self.mean if idx is None else self.mean[idx]
+        return xyah_to_xyxy(mean[:, :4])
+
+    def update(self, boxes, scores, class_ids):
+        """
+        Advance the tracker by one frame.
+
+        Args:
+            boxes (np.ndarray): (n, 4) x1, y1, x2, y2 detections
+            scores (np.ndarray): (n,) detection confidences
+            class_ids (np.ndarray): (n,) detection class ids
+
+        Returns:
+            tuple: track_ids, boxes, scores and class_ids of the tracks
+            that are active in this frame
+        """
+        self.frame_id += 1
+        boxes = np.asarray(boxes, dtype=float).reshape(-1, 4)
+        scores = np.asarray(scores, dtype=float)
+        class_ids = np.asarray(class_ids).astype(int)
+
+        high = np.flatnonzero(scores >= self.track_thresh)
+        low = np.flatnonzero((scores > self.low_thresh) &
+                             (scores < self.track_thresh))
+
+        confirmed = np.flatnonzero(self.state != NEW)
+        unconfirmed = np.flatnonzero(self.state == NEW)
+        self._predict(confirmed)
+
+        # Stage 1: confirmed and lost tracks against high confidence boxes
+        cost = 1 - iou_matrix(self.boxes(confirmed), boxes[high])
+        (rows, cols), unmatched_tracks, unmatched_high = match(
+            cost, self.match_thresh)
+        self._update(confirmed[rows], boxes[high[cols]], scores[high[cols]],
+                     class_ids[high[cols]])
+
+        # Stage 2: remaining tracked (not lost) tracks against low boxes
+        remaining = confirmed[unmatched_tracks]
+        remaining = remaining[self.state[remaining] == TRACKED]
+        cost = 1 - iou_matrix(self.boxes(remaining), boxes[low])
+        (rows, cols), unmatched_remaining, _ = match(cost, 0.5)
+        self._update(remaining[rows], boxes[low[cols]], scores[low[cols]],
+                     class_ids[low[cols]])
+        self.state[remaining[unmatched_remaining]] = LOST
+
+        # Stage 3: unconfirmed tracks against leftover high boxes
+        leftover = high[unmatched_high]
+        cost = 1 - iou_matrix(self.boxes(unconfirmed), boxes[leftover])
+        (rows, cols), unmatched_unconfirmed, unmatched_leftover = match(
+            cost, 0.7)
+        self._update(unconfirmed[rows], boxes[leftover[cols]],
+                     scores[leftover[cols]], class_ids[leftover[cols]])
+        self._activate(unconfirmed[rows])
+
+        # Drop unconfirmed tracks that were not matched and expired lost ones
+        keep = np.ones(len(self.state), bool)
+        keep[unconfirmed[unmatched_unconfirmed]] = False
+        keep &= ~((self.state == LOST) &
+                  (self.frame_id - self.last_frame > self.max_time_lost))
+        self._keep(keep)
+
+        # Start new tracks, confirmed straight away on the first frame
+        new = leftover[unmatched_leftover]
+        new = new[scores[new] >= self.new_track_thresh]
+        self._add_tracks(boxes[new], scores[new], class_ids[new],
+                         TRACKED if self.frame_id == 1 else NEW)
+
+        active = np.flatnonzero((self.state == TRACKED) &
+                                (self.last_frame == self.frame_id) &
+                                (self.track_ids > 0))
+        return (self.track_ids[active], self.boxes(active), self.score[active],
+                self.class_id[active])
+
+
+def track_rows(tracks, frame_id, timestamp, request_id, class_names):
+    """
+    Build result rows shaped like the ByteTrack service response from the
+    output of ByteTracker.update for one frame.
+    """
+    track_ids, track_boxes, track_scores, track_classes = tracks
+    track_boxes = np.rint(track_boxes).astype(int).tolist()
+    rows = []
+    for track_id, box, score, class_id in zip(track_ids.tolist(),
+                                              track_boxes,
+                                              track_scores.tolist(),
+                                              track_classes.tolist()):
+        rows.append({
+            'track_id': track_id,
+            'frame_id': frame_id,
+            'timestamp': timestamp,
+            'request_id': request_id,
+            'box': [{
+                'x1': box[0],
+                'y1': box[1],
+                'x2': box[2],
+                'y2': box[3]
+            }],
+            'confidence': score,
+            'class_id': class_id,
+            'class_name': class_names.get(class_id)
+        })
+    return rows
+
+
+def _track_frames(frames, class_names, request_id, frame_rate):
+    """
+    Run the tracker over (frame_id, timestamp, boxes, scores, class_ids)
+    tuples and build results shaped like the ByteTrack service response.
+    """
+    tracker = ByteTracker(frame_rate=frame_rate or 30)
+    final_results = []
+    for frame_id, timestamp, boxes, scores, class_ids in frames:
+        tracks = tracker.update(boxes, scores, class_ids)
+        final_results.extend(
+            track_rows(tracks, frame_id, timestamp, request_id, class_names))
+    return final_results
+
+
+def track_detections(detection_results, request_id=None, frame_rate=30):
+    """
+    Track per-frame detection results in the /detect JSON format.
+
+    detection_results may be any iterable, so streamed frames are tracked as
+    they arrive.
+    """
+    class_names = {}
+
+    def frames():
+        for frame_result in detection_results:
+            class_ids = [int(id) for id in frame_result.get('class_id', [])]
+            class_names.update(zip(class_ids,
+                                   frame_result.get('class_name', [])))
+            yield (frame_result['frame_id'], frame_result.get('timestamp'),
+                   frame_result.get('box', []),
+                   frame_result.get('confidence', []), class_ids)
+
+    return _track_frames(frames(), class_names, request_id, frame_rate)
+
+
+def track_columns(columns):
+    """
+    Track columnar detections as decoded by decode_columnar_detections,
+    slicing the arrays per frame without building per-detection dicts.
+    """
+    frame_count = len(columns['frame_skipped'])
+    fps = columns['fps']
+    bounds = np.searchsorted(columns['frame_id'], np.arange(frame_count + 1))
+
+    def frames():
+        for frame_id in range(frame_count):
+            start, end = bounds[frame_id], bounds[frame_id + 1]
+            yield (frame_id, frame_id / fps, columns['box'][start:end],
+                   columns['confidence'][start:end],
+                   columns['class_id'][start:end])
+
+    class_names = {
+        int(id): name
+        for id, name in columns['class_names'].items()
+    }
+    return _track_frames(frames(), class_names, columns['request_id'], fps)
@@ -1,11 +1,28 @@
 # Main tracking service with cloud hosting
 import cv2
+import gzip
 import requests
 import json
 import os
+import queue
+import threading
+import time
+import msgpack
+import numpy as np
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 from datetime import datetime
 import uuid
-from google.cloud import storage
+import checkpoint
+import detection_options
+import object_store
+from overlap_capture import open_capture
+from stage_timing import StageTimer, record_timings
+import bytetrack_engine
+import video_range
+from video_writer import open_video_writer
 
 # Environment variables set by the Cloud Run job
 INPUT_BUCKET = os.environ.get('INPUT_BUCKET')
@@ -18,42 +35,221 @@ GCS_BUCKET_NAME = os.environ.get('GCS_BUCKET_NAME')
 
 # Service endpoints
 YOLO_SERVICE_ENDPOINT = os.environ['YOLO_SERVICE_ENDPOINT']
-BYTETRACK_SERVICE_ENDPOINT = os.environ['BYTETRACK_SERVICE_ENDPOINT']
-
-# Temporary file paths
-TEMP_INPUT_VIDEO = '/tmp/input.mp4'
-TEMP_OUTPUT_VIDEO = '/tmp/output.mp4'
-TEMP_OUTPUT_JSON = '/tmp/output.json'
-
-
-def download_from_gcs(bucket_name, source_blob_name, destination_file_name):
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(source_blob_name)
-    blob.download_to_filename(destination_file_name)
-    print(f"Downloaded {source_blob_name} to {destination_file_name}")
+BYTETRACK_SERVICE_ENDPOINT = os.environ.get('BYTETRACK_SERVICE_ENDPOINT')
+
+# Tracking engine: 'service' (remote ByteTrack /track) or 'local' (in-process)
+TRACKING_ENGINE = os.environ.get('TRACKING_ENGINE', 'service')
+
+# Detection wire format: 'json' (default), 'ndjson' (streamed per frame) or
+# 'columnar' (msgpack arrays, optionally compressed with 'gzip' or 'zstd')
+DETECTION_FORMAT = os.environ.get('DETECTION_FORMAT', 'json')
+DETECTION_COMPRESSION = os.environ.get('DETECTION_COMPRESSION')
+COLUMNAR_MEDIA_TYPE = 'application/x-detections+msgpack'
+NDJSON_MEDIA_TYPE = 'application/x-ndjson'
+
+# Identifies the YOLO service's model in checkpoint fingerprints; change it
+# after deploying another model so that chunks are tracked again
+DETECTION_MODEL_VERSION = os.environ.get('DETECTION_MODEL_VERSION',
+                                         'yolov8n.pt')
+
+# Optional detection gating passed through to the YOLO service
+DETECT_STRIDE = os.environ.get('DETECT_STRIDE')
+MOTION_THRESHOLD = os.environ.get('MOTION_THRESHOLD')
+# Optional detection options, also applied in fused mode: inference size,
+# comma-separated class allow-list and JSON list of regions of interest
+# (see detection_options.py)
+DETECT_IMGSZ = os.environ.get('DETECT_IMGSZ')
+DETECT_CLASSES = os.environ.get('DETECT_CLASSES')
+DETECT_ROI = os.environ.get('DETECT_ROI')
+
+# Pipeline mode: 'services' sends the chunk to the YOLO service and tracks
+# the returned detections; 'fused' decodes each frame once and runs
+# detection (local model), tracking and annotation on it in this process
+PIPELINE_MODE = os.environ.get('PIPELINE_MODE', 'services')
+FUSED_MODEL_WEIGHTS = os.environ.get('FUSED_MODEL_WEIGHTS', 'yolov8n.pt')
+# Number of frames passed to a single model.predict call in fused mode
+FUSED_BATCH_SIZE = int(os.environ.get('FUSED_BATCH_SIZE', 4))
+# Same confidence threshold as the YOLO service
+DETECTION_THRESHOLD = 0.5
+# Decoded frames buffered ahead of detection in fused mode
+FUSED_QUEUE_SIZE = 16
+
+# 'burned' annotates the chunk video here; with 'render', 'subtitles' or
+# 'none' only the results JSON is written and the merge job draws the
+# overlay, if any, over the original video (see video-merge/overlay.py)
+OVERLAY_MODE = os.environ.get('OVERLAY_MODE', 'burned')
+ANNOTATE_CHUNKS = OVERLAY_MODE == 'burned'
+
+# Temporary file paths; give concurrent runs on one machine their own
+# TEMP_DIR
+TEMP_DIR = os.environ.get('TEMP_DIR', '/tmp')
+TEMP_INPUT_VIDEO = os.path.join(TEMP_DIR, 'input.mp4')
+TEMP_OUTPUT_VIDEO = os.path.join(TEMP_DIR, 'output.mp4')
+TEMP_OUTPUT_JSON = os.path.join(TEMP_DIR, 'output.json')
+TEMP_OVERLAP_VIDEO = os.path.join(TEMP_DIR, 'overlap.mp4')
+
+_segment_metadata = None
+
+
+def download_object(bucket_name, object_name, destination_file_name):
+    object_store.download(bucket_name, object_name, destination_file_name)
+    print(f"Downloaded {object_name} to {destination_file_name}")
+
+
+def detection_accept_header():
+    if DETECTION_FORMAT == 'ndjson':
+        return f'{NDJSON_MEDIA_TYPE}, application/json;q=0.5'
+    if DETECTION_FORMAT != 'columnar':
+        return 'application/json'
+    compression = DETECTION_COMPRESSION
+    if compression == 'zstd' and zstandard is None:
+        compression = 'gzip'
+    if compression:
+        return (f'{COLUMNAR_MEDIA_TYPE}; compression={compression}, '
+                'application/json;q=0.5')
+    return f'{COLUMNAR_MEDIA_TYPE}, application/json;q=0.5'
+
+
+def decode_columnar_detections(response):
+    """
+    Decode a columnar detection response from the YOLO service into NumPy
+    arrays (see yolo/wire_format.py for the layout).
 
+    Returns:
+        dict: frame_id (n,), box (n, 4), confidence (n,), class_id (n,),
+        frame_skipped (frame_count,) plus the scalar fields of the payload
+    """
+    payload = response.content
+    params = dict(
+        part.strip().split('=', 1)
+        for part in response.headers.get('Content-Type', '').split(';')[1:]
+        if '=' in part)
+    compression = params.get('compression')
+    if compression == 'zstd':
+        payload = zstandard.ZstdDecompressor().decompress(payload)
+    elif compression == 'gzip':
+        payload = gzip.decompress(payload)
+
+    data = msgpack.unpackb(payload, raw=False, strict_map_key=False)
+    columns = {
+        'request_id': data['request_id'],
+        'fps': data['fps'],
+        'shape': data['shape'],
+        'class_names': data['class_names'],
+        'frame_skipped': np.frombuffer(data['frame_skipped'], np.uint8),
+        'frame_id': np.frombuffer(data['frame_id'], '<i4'),
+        'box': np.frombuffer(data['box'], '<f4').reshape(-1, 4),
+        'confidence': np.frombuffer(data['confidence'], '<f4'),
+        'class_id': np.frombuffer(data['class_id'], '<i2')
+    }
+    return columns
 
-def upload_to_gcs(bucket_name, source_file_name, destination_blob_name):
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(destination_blob_name)
-    blob.upload_from_filename(source_file_name)
-    print(f"Uploaded {source_file_name} to {destination_blob_name}")
 
+def iter_ndjson_detections(response):
+    """
+    Yield per-frame detection results from a streamed NDJSON response as
+    each line arrives.
+    """
+    for line in response.iter_lines():
+        if not line:
+            continue
+        frame_result = json.loads(line)
+        if 'error' in frame_result:
+            raise Exception(
+                f"YOLO service failed mid-stream: {frame_result['error']}")
+        yield frame_result
 
-def read_metadata():
-    with open('/tmp/metadata.json', 'r') as f:
-        return json.load(f)
 
+def columns_to_track_request(columns):
+    """
+    Build the per-frame JSON payload expected by the ByteTrack service from
+    columnar detections, slicing the arrays once per frame.
+    """
+    frame_count = len(columns['frame_skipped'])
+    fps = columns['fps']
+    names = columns['class_names']
+    # Detections are stored in frame order, so each frame is one slice
+    bounds = np.searchsorted(columns['frame_id'], np.arange(frame_count + 1))
+    track_request = []
+    for frame_id in range(frame_count):
+        start, end = bounds[frame_id], bounds[frame_id + 1]
+        class_ids = columns['class_id'][start:end].astype(float).tolist()
+        frame_result = {
+            "request_id": columns['request_id'],
+            "frame_id": frame_id,
+            "timestamp": frame_id / fps,
+            'shape': columns['shape'],
+            'box': columns['box'][start:end].tolist(),
+            'confidence': columns['confidence'][start:end].tolist(),
+            'class_id': class_ids,
+            'class_name': [names[int(id)] for id in class_ids]
+        }
+        if columns['frame_skipped'][frame_id]:
+            frame_result['skipped'] = True
+        track_request.append(frame_result)
+    return track_request
+
+
+def draw_tracks(frame, frame_results, box_color):
+    """
+    Draw the tracked boxes and labels of one frame onto it in place.
 
-def annotate_video(input_video_path, final_results):
+    Args:
+        frame (np.ndarray): BGR frame
+        frame_results (list): Tracking results of this frame
+        box_color (tuple): BGR colour of the boxes
+    """
+    for final_result in frame_results:
+        # Extract and validate result data
+        track_id = final_result.get('track_id')
+        if track_id is None:
+            continue
+        box = final_result.get('box')
+        confidence = final_result.get('confidence')
+        class_name = final_result.get('class_name')
+
+        # Check if box is in the new format and not empty
+        if box and isinstance(box, list) and len(box) > 0 and isinstance(
+                box[0], dict):
+            # Extract coordinates from the new format
+            x1 = box[0].get('x1')
+            y1 = box[0].get('y1')
+            x2 = box[0].get('x2')
+            y2 = box[0].get('y2')
+        else:
+            # Handle case where box is not in the expected format
+            print(f"Unexpected box format for track_id {track_id}: {box}")
+            continue
+
+        # Ensure all coordinates are integers and not None
+        if all(coord is not None for coord in [x1, y1, x2, y2]):
+            x1, y1, x2, y2 = map(int, [x1, y1, x2, y2])
+        else:
+            print(f"Invalid coordinates for track_id {track_id}: {box}")
+            continue
+
+        # Draw bounding boxes and labels on the frame
+        cv2.rectangle(frame, (x1, y1), (x2, y2), box_color, 2)
+        label = f"#{track_id} {class_name} {confidence:.2f}"
+        cv2.putText(frame, label, (x1, y1 - 10), cv2.FONT_HERSHEY_SIMPLEX,
+                    0.5, (0, 0, 0), 2)
+
+
+def annotate_video(input_video_path,
+                   final_results,
+                   skipped_frames=None,
+                   max_frames=None):
     """
     Annotate the input video with detection and tracking results.
 
     Args:
         input_video_url (str): URL of the input video
         final_results (list): List of detection and tracking results
+        skipped_frames (set): Frame IDs the detector skipped and whose boxes
+            were carried over from an earlier frame; drawn in a different
+            colour
+        max_frames (int): Stop after this many frames, leaving out overlap
+            frames borrowed from the next chunk
 
     Returns:
         tuple: A message and status code
@@ -65,10 +261,8 @@ def annotate_video(input_video_path, final_results):
     cap = cv2.VideoCapture(input_video_path)
     width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
     height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-    fps = int(cap.get(cv2.CAP_PROP_FPS))
-    output_video = cv2.VideoWriter(TEMP_OUTPUT_VIDEO,
-                                   cv2.VideoWriter_fourcc(*'mp4v'), fps,
-                                   (width, height))
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    output_video = open_video_writer(TEMP_OUTPUT_VIDEO, fps, (width, height))
 
     # Group final_results by frame_id for efficient processing
     results_by_frame = {}
@@ -78,57 +272,21 @@ def annotate_video(input_video_path, final_results):
             results_by_frame[frame_id] = []
         results_by_frame[frame_id].append(result)
 
+    skipped_frames = skipped_frames or set()
+
     frame_count = 0
-    while cap.isOpened():
+    while cap.isOpened() and (max_frames is None or frame_count < max_frames):
         ret, frame = cap.read()
         if not ret:
             break
 
-        # Filter results for the current frame
-        frame_results = [
-            result for result in final_results
-            if result.get('frame_id') == frame_count
-        ]
-
-        # Get the full shape of the frame
-        height, width, channels = frame.shape
-
-        # Process detection and tracking results for current frame
-        frame_results = results_by_frame.get(frame_count, [])
-        for final_result in frame_results:
-            # Extract and validate result data
-            track_id = final_result.get('track_id')
-            if track_id is None:
-                continue
-            box = final_result.get('box')
-            confidence = final_result.get('confidence')
-            class_name = final_result.get('class_name')
-
-            # Check if box is in the new format and not empty
-            if box and isinstance(box, list) and len(box) > 0 and isinstance(
-                    box[0], dict):
-                # Extract coordinates from the new format
-                x1 = box[0].get('x1')
-                y1 = box[0].get('y1')
-                x2 = box[0].get('x2')
-                y2 = box[0].get('y2')
-            else:
-                # Handle case where box is not in the expected format
-                print(f"Unexpected box format for track_id {track_id}: {box}")
-                continue
-
-            # Ensure all coordinates are integers and not None
-            if all(coord is not None for coord in [x1, y1, x2, y2]):
-                x1, y1, x2, y2 = map(int, [x1, y1, x2, y2])
-            else:
-                print(f"Invalid coordinates for track_id {track_id}: {box}")
-                continue
+        # Carried-over boxes are drawn in yellow, fresh detections in green
+        if frame_count in skipped_frames:
+            box_color = (0, 255, 255)
+        else:
+            box_color = (0, 255, 0)
 
-            # Draw bounding boxes and labels on the frame
-            cv2.rectangle(frame, (x1, y1), (x2, y2), (0, 255, 0), 2)
-            label = f"#{track_id} {class_name} {confidence:.2f}"
-            cv2.putText(frame, label, (x1, y1 - 10), cv2.FONT_HERSHEY_SIMPLEX,
-                        0.5, (0, 0, 0), 2)
+        draw_tracks(frame, results_by_frame.get(frame_count, []), box_color)
 
         # Write the annotated frame to output video
         output_video.write(frame)
@@ -141,6 +299,375 @@ def annotate_video(input_video_path, final_results):
     return "Complete annotation", 200
 
 
+def load_detector():
+    """
+    Load the local detection model used in fused mode.
+    """
+    # Only the fused mode needs ultralytics and torch
+    import ultralytics
+    return ultralytics.YOLO(FUSED_MODEL_WEIGHTS)
+
+
+def decode_frames(cap, frame_queue, stop_event, errors, timings):
+    """
+    Read frames from the capture into frame_queue, ending with None.
+    """
+    try:
+        while cap.isOpened() and not stop_event.is_set():
+            start = time.perf_counter()
+            ret, frame = cap.read()
+            timings['decode'] += time.perf_counter() - start
+            if not ret:
+                break
+            while not stop_event.is_set():
+                try:
+                    frame_queue.put(frame, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+    except Exception as e:
+        errors.append(e)
+    finally:
+        cap.release()
+        # Nobody is reading any more once the pipeline has stopped
+        while not stop_event.is_set():
+            try:
+                frame_queue.put(None, timeout=0.1)
+                break
+            except queue.Full:
+                continue
+
+
+def run_fused_pipeline(input_video_path,
+                       own_frames=None,
+                       annotate=True,
+                       overlap=None):
+    """
+    Detect, track and annotate a chunk in a single pass over its frames.
+
+    Each frame is decoded once on a background thread. Batches of
+    FUSED_BATCH_SIZE frames go through the local model, and every frame is
+    then tracked, drawn and written while it is still in memory, so no
+    detections are serialized between the stages.
+
+    Args:
+        input_video_path (str): Local path of the video chunk
+        own_frames (int): Frames that belong to this chunk; later overlap
+            frames are tracked and marked but not written to the video
+        annotate (bool): Draw and encode the annotated video; without it
+            only the tracking results are produced
+        overlap (tuple): (local path of the next chunk, overlap frames)
+            read after the chunk's own frames, or None
+
+    Returns:
+        tuple: Tracking results, skipped frame IDs, number of frames and
+        per-stage timings in seconds
+    """
+    timings = {
+        'load_model': 0.0,
+        'decode': 0.0,
+        'detect': 0.0,
+        'track': 0.0,
+        'annotate': 0.0,
+        'encode': 0.0
+    }
+    start = time.perf_counter()
+    model = load_detector()
+    timings['load_model'] = time.perf_counter() - start
+
+    cap = open_capture(input_video_path, overlap)
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    # Timestamps use the integer frame rate, as the YOLO service does
+    timestamp_fps = int(fps) or 30
+    predict_args = {}
+    imgsz = detection_options.parse_imgsz(DETECT_IMGSZ)
+    if imgsz:
+        predict_args['imgsz'] = imgsz
+    classes = detection_options.parse_classes(DETECT_CLASSES, model.names)
+    if classes is not None:
+        predict_args['classes'] = classes
+    regions = detection_options.parse_regions(DETECT_ROI)
+    # The model runs on the regions of interest; tracking and annotation
+    # use the full frame
+    region_crop = (detection_options.RegionCrop(regions, (height, width))
+                   if regions else None)
+    output_video = (open_video_writer(TEMP_OUTPUT_VIDEO, fps,
+                                      (width, height)) if annotate else None)
+    tracker = bytetrack_engine.ByteTracker(frame_rate=timestamp_fps)
+    stride = max(1, int(DETECT_STRIDE or 1))
+
+    frame_queue = queue.Queue(maxsize=FUSED_QUEUE_SIZE)
+    stop_event = threading.Event()
+    errors = []
+    decoder = threading.Thread(target=decode_frames,
+                               args=(cap, frame_queue, stop_event, errors,
+                                     timings))
+    decoder.start()
+
+    final_results = []
+    skipped_frames = set()
+    detections = (np.zeros((0, 4)), np.zeros(0), np.zeros(0))
+    frame_id = 0
+    end_of_stream = False
+    try:
+        while not end_of_stream:
+            # Frames off the stride reuse the last detections, as in the
+            # YOLO service, so a batch holds FUSED_BATCH_SIZE inferred frames
+            batch = []
+            inferred = 0
+            while inferred < FUSED_BATCH_SIZE:
+                frame = frame_queue.get()
+                if frame is None:
+                    end_of_stream = True
+                    break
+                infer = (frame_id + len(batch)) % stride == 0
+                batch.append((frame, infer))
+                inferred += infer
+            if errors:
+                raise errors[0]
+
+            start = time.perf_counter()
+            frames = [frame for frame, infer in batch if infer]
+            if region_crop is not None:
+                frames = [region_crop.apply(frame) for frame in frames]
+            results = model.predict(source=frames,
+                                    conf=DETECTION_THRESHOLD,
+                                    task='detect',
+                                    batch=len(frames),
+                                    verbose=False,
+                                    **predict_args) if frames else []
+            if region_crop is not None:
+                for result in results:
+                    detection_options.shift_boxes(result, region_crop.offset)
+            results = iter(results)
+            timings['detect'] += time.perf_counter() - start
+
+            for frame, infer in batch:
+                start = time.perf_counter()
+                if infer:
+                    boxes = next(results).boxes
+                    detections = (boxes.xyxy.cpu().numpy(),
+                                  boxes.conf.cpu().numpy(),
+                                  boxes.cls.cpu().numpy())
+                else:
+                    skipped_frames.add(frame_id)
+                rows = bytetrack_engine.track_rows(
+                    tracker.update(*detections), frame_id,
+                    frame_id / timestamp_fps, REQUEST_ID, model.names)
+                timings['track'] += time.perf_counter() - start
+
+                for row in rows:
+                    if not infer:
+                        row['skipped'] = True
+                    if own_frames is not None and frame_id >= own_frames:
+                        row['overlap'] = True
+                final_results.extend(rows)
+
+                if annotate and (own_frames is None or
+                                 frame_id < own_frames):
+                    start = time.perf_counter()
+                    # Carried-over boxes are drawn in yellow, fresh
+                    # detections in green
+                    draw_tracks(frame, rows,
+                                (0, 255, 0) if infer else (0, 255, 255))
+                    timings['annotate'] += time.perf_counter() - start
+                    start = time.perf_counter()
+                    output_video.write(frame)
+                    timings['encode'] += time.perf_counter() - start
+                frame_id += 1
+    finally:
+        stop_event.set()
+        decoder.join()
+        if output_video is not None:
+            start = time.perf_counter()
+            output_video.release()
+            timings['encode'] += time.perf_counter() - start
+
+    return final_results, skipped_frames, frame_id, timings
+
+
+def metadata_object():
+    return f"{os.path.dirname(INPUT_VIDEO)}/{INPUT_METADATA}"
+
+
+def segment_metadata():
+    """
+    Segment metadata written by the split job, read on first use.
+
+    Returns:
+        dict: The chunk's metadata, or None without INPUT_METADATA
+    """
+    global _segment_metadata
+    if _segment_metadata is None and INPUT_METADATA:
+        _segment_metadata = object_store.read_json(INPUT_BUCKET,
+                                                   metadata_object())
+    return _segment_metadata
+
+
+def is_virtual_segment():
+    """
+    Whether the chunk is a virtual segment (SPLIT_MODE=virtual): a time
+    range of the original video with no chunk video of its own.
+    """
+    metadata = segment_metadata()
+    return bool(metadata and metadata.get('source'))
+
+
+def fetch_input_video():
+    """
+    Download the chunk video to TEMP_INPUT_VIDEO, or for a virtual segment
+    fetch its byte range of the original video and extract its frames.
+    """
+    if is_virtual_segment():
+        video_range.extract_segment(segment_metadata(), TEMP_INPUT_VIDEO)
+    else:
+        download_object(INPUT_BUCKET, INPUT_VIDEO, TEMP_INPUT_VIDEO)
+
+
+def next_segment_object():
+    """
+    Object name of the next chunk whose first overlap_frames frames this
+    chunk also tracks, or None. Virtual segments carry their overlap in
+    their own byte range.
+    """
+    metadata = segment_metadata()
+    if not metadata or not metadata.get('overlap_frames') or (
+            not metadata.get('next_segment_file')):
+        return None
+    return f"{os.path.dirname(INPUT_VIDEO)}/{metadata['next_segment_file']}"
+
+
+def download_overlap():
+    """
+    Download the next chunk for the overlap frames, if there are any.
+
+    Returns:
+        tuple: (local path of the next chunk, overlap frames), or None
+    """
+    next_object = next_segment_object()
+    if next_object is None:
+        return None
+    download_object(INPUT_BUCKET, next_object, TEMP_OVERLAP_VIDEO)
+    return TEMP_OVERLAP_VIDEO, segment_metadata()['overlap_frames']
+
+
+def download_own_frames():
+    """
+    Download the segment metadata and return how many frames belong to this
+    chunk.
+
+    Returns:
+        int: Frame count of the chunk without the trailing frames that
+        overlap the next chunk (tracked, but part of the next chunk's
+        video), or None when there is no overlap
+    """
+    metadata = segment_metadata()
+    if not metadata:
+        return None
+    if metadata.get('overlap_frames'):
+        return metadata['frame_count']
+    return None
+
+
+def output_objects():
+    """
+    Object names of the annotated video and results JSON of this chunk.
+    """
+    output_video_path = INPUT_VIDEO.replace('split_chunks', 'processed_chunks')
+    return output_video_path, output_video_path.rsplit('.', 1)[0] + '.json'
+
+
+def chunk_fingerprint():
+    """
+    Checkpoint fingerprint of this chunk: the split chunk and its metadata,
+    and the settings and model that shape the tracking results. A virtual
+    segment has only its metadata, which the split rewrites whenever the
+    original video changes.
+    """
+    inputs = [] if is_virtual_segment() else [INPUT_VIDEO]
+    if INPUT_METADATA:
+        inputs.append(metadata_object())
+    # The overlap frames come from the next chunk
+    if next_segment_object():
+        inputs.append(next_segment_object())
+    if PIPELINE_MODE == 'fused':
+        model = (checkpoint.file_digest(FUSED_MODEL_WEIGHTS)
+                 if os.path.exists(FUSED_MODEL_WEIGHTS) else
+                 FUSED_MODEL_WEIGHTS)
+    else:
+        model = DETECTION_MODEL_VERSION
+    return checkpoint.fingerprint(
+        INPUT_BUCKET, inputs, {
+            'pipeline_mode': PIPELINE_MODE,
+            'tracking_engine': TRACKING_ENGINE,
+            'detect_stride': DETECT_STRIDE,
+            'motion_threshold': MOTION_THRESHOLD,
+            'imgsz': DETECT_IMGSZ,
+            'classes': DETECT_CLASSES,
+            'roi': DETECT_ROI,
+            'annotate': ANNOTATE_CHUNKS,
+            'threshold': DETECTION_THRESHOLD,
+            'model': model
+        })
+
+
+def checkpoint_unit():
+    return f"track/{os.path.splitext(os.path.basename(INPUT_VIDEO))[0]}"
+
+
+def is_chunk_complete(unit_fingerprint):
+    if not checkpoint.is_complete(GCS_BUCKET_NAME, REQUEST_ID,
+                                  checkpoint_unit(), unit_fingerprint):
+        return False
+    print(f"{INPUT_VIDEO} is already processed with the same inputs and "
+          "settings, skipping")
+    return True
+
+
+def upload_outputs(unit_fingerprint):
+    """
+    Upload the annotated video (unless annotation is deferred to the merge
+    job) and the results JSON under processed_chunks/ and mark the chunk
+    complete.
+
+    Returns:
+        str: Object name of the uploaded JSON
+    """
+    output_video_path, output_json_path = output_objects()
+    transfers = [(TEMP_OUTPUT_JSON, output_json_path)]
+    if ANNOTATE_CHUNKS:
+        transfers.insert(0, (TEMP_OUTPUT_VIDEO, output_video_path))
+
+    object_store.upload_many(GCS_BUCKET_NAME, transfers)
+    for local_path, object_name in transfers:
+        print(f"Uploaded {local_path} to {object_name}")
+
+    if ANNOTATE_CHUNKS:
+        print(
+            f"Processing complete. Output video stored in GCS bucket: {GCS_BUCKET_NAME}/{output_video_path}/"
+        )
+    checkpoint.mark_complete(GCS_BUCKET_NAME, REQUEST_ID, checkpoint_unit(),
+                             unit_fingerprint,
+                             [object_name for _, object_name in transfers])
+    return output_json_path
+
+
+def timing_record_name():
+    """
+    Name of this chunk's timing record, e.g. track_output0000.
+    """
+    return f"track_{os.path.splitext(os.path.basename(INPUT_VIDEO))[0]}"
+
+
+def remove_temp_files():
+    for path in (TEMP_INPUT_VIDEO, TEMP_OUTPUT_VIDEO, TEMP_OUTPUT_JSON,
+                 TEMP_OVERLAP_VIDEO):
+        if os.path.exists(path):
+            os.remove(path)
+
+
 def process_video():
     """
     Handle request triggered by Cloud Workflow
@@ -151,50 +678,197 @@ def process_video():
         "object_name": INPUT_VIDEO,
         "metadata_file": INPUT_METADATA
     }
+    timer = StageTimer('track', REQUEST_ID, os.path.basename(INPUT_VIDEO))
+    if DETECT_STRIDE:
+        request_data['detect_stride'] = int(DETECT_STRIDE)
+    if MOTION_THRESHOLD:
+        request_data['motion_threshold'] = float(MOTION_THRESHOLD)
+    if DETECT_IMGSZ:
+        request_data['imgsz'] = int(DETECT_IMGSZ)
+    if DETECT_CLASSES:
+        request_data['classes'] = DETECT_CLASSES
+    if DETECT_ROI:
+        request_data['roi'] = json.loads(DETECT_ROI)
+    download_thread = None
 
     try:
+        unit_fingerprint = chunk_fingerprint()
+        if is_chunk_complete(unit_fingerprint):
+            return f"Processing complete. Output json already in GCS bucket: {GCS_BUCKET_NAME}/{output_objects()[1]}/"
         print(f"Processing video: {INPUT_VIDEO}")
 
-        # Step 1: Send video to YOLO service for detection
-        yolo_response = requests.post(f"{YOLO_SERVICE_ENDPOINT}/detect",
-                                      json=request_data)
+        with timer.stage('metadata'):
+            own_frames = download_own_frames()
+        # The YOLO service reads a virtual segment's byte range itself
+        if is_virtual_segment():
+            request_data['segment'] = segment_metadata()
+        # and the overlap frames from the head of the next chunk
+        if next_segment_object():
+            request_data['overlap'] = {
+                'object_name': next_segment_object(),
+                'frames': segment_metadata()['overlap_frames']
+            }
+
+        # Fetch the chunk for annotation while detection is running
+        download_errors = []
+
+        def download_input_video():
+            try:
+                with timer.stage('download'):
+                    fetch_input_video()
+            except Exception as e:
+                download_errors.append(e)
+
+        if ANNOTATE_CHUNKS:
+            download_thread = threading.Thread(target=download_input_video)
+            download_thread.start()
+
+        # Step 1: Send video to YOLO service for detection. Streamed and
+        # columnar detections tracked in process are tracked within this
+        # stage.
+        stage_start = time.perf_counter()
+        yolo_response = requests.post(
+            f"{YOLO_SERVICE_ENDPOINT}/detect",
+            json=request_data,
+            headers={'Accept': detection_accept_header()},
+            stream=DETECTION_FORMAT == 'ndjson')
         yolo_response.raise_for_status()
-        detection_results = yolo_response.json()
-
-        # Step 2: Send YOLO results to Bytetrack service for tracking
-        bytetrack_response = requests.post(
-            f"{BYTETRACK_SERVICE_ENDPOINT}/track", json=detection_results)
-        bytetrack_response.raise_for_status()
-        final_results = bytetrack_response.json()
+        content_type = yolo_response.headers.get('Content-Type', '')
+        local_tracking = TRACKING_ENGINE == 'local'
+        final_results = None
+        if content_type.startswith(COLUMNAR_MEDIA_TYPE):
+            columns = decode_columnar_detections(yolo_response)
+            skipped_frames = set(
+                np.flatnonzero(columns['frame_skipped']).tolist())
+            if local_tracking:
+                final_results = bytetrack_engine.track_columns(columns)
+            else:
+                detection_results = columns_to_track_request(columns)
+        elif content_type.startswith(NDJSON_MEDIA_TYPE):
+            skipped_frames = set()
+
+            def record_skipped(frame_results):
+                for frame_result in frame_results:
+                    if frame_result.get('skipped'):
+                        skipped_frames.add(frame_result['frame_id'])
+                    yield frame_result
+
+            frame_results = record_skipped(
+                iter_ndjson_detections(yolo_response))
+            if local_tracking:
+                # Track each frame as soon as it arrives
+                final_results = bytetrack_engine.track_detections(
+                    frame_results, REQUEST_ID)
+            else:
+                detection_results = list(frame_results)
+        else:
+            detection_results = yolo_response.json()
+            skipped_frames = {
+                result['frame_id']
+                for result in detection_results if result.get('skipped')
+            }
+        timer.add('detect', time.perf_counter() - stage_start)
+        if skipped_frames:
+            print(f"Detector skipped {len(skipped_frames)} frames, saved "
+                  f"{yolo_response.headers.get('X-Inference-Seconds-Saved')}s "
+                  "of inference")
+
+        stage_start = time.perf_counter()
+        # Step 2: Track the detections, in process or with the ByteTrack
+        # service (streamed and columnar input is already tracked above)
+        if final_results is None and local_tracking:
+            final_results = bytetrack_engine.track_detections(
+                detection_results, REQUEST_ID)
+        elif final_results is None:
+            bytetrack_response = requests.post(
+                f"{BYTETRACK_SERVICE_ENDPOINT}/track", json=detection_results)
+            bytetrack_response.raise_for_status()
+            final_results = bytetrack_response.json()
+        for result in final_results:
+            if result.get('frame_id') in skipped_frames:
+                result['skipped'] = True
+            if own_frames is not None and result['frame_id'] >= own_frames:
+                result['overlap'] = True
+        timer.add('track', time.perf_counter() - stage_start)
 
         # Save final results to JSON file
-        with open(TEMP_OUTPUT_JSON, 'w') as f:
-            json.dump(final_results, f, indent=2)
-
-        # Download input video from GCS
-        download_from_gcs(INPUT_BUCKET, INPUT_VIDEO, TEMP_INPUT_VIDEO)
-
-        # Step 3: Annotate video with final results
-        try:
-            annotate_video(TEMP_INPUT_VIDEO, final_results)
-            print(f"Request ID #{REQUEST_ID} Processing complete...\
+        with timer.stage('write_json'):
+            with open(TEMP_OUTPUT_JSON, 'w') as f:
+                json.dump(final_results, f, separators=(',', ':'))
+
+        # Step 3: Annotate video with final results, unless the merge job
+        # draws the overlay
+        if ANNOTATE_CHUNKS:
+            # Wait for the input video download started before detection
+            with timer.stage('wait_download'):
+                download_thread.join()
+            if download_errors:
+                raise download_errors[0]
+
+            try:
+                with timer.stage('annotate'):
+                    annotate_video(TEMP_INPUT_VIDEO, final_results,
+                                   skipped_frames, own_frames)
+                print(f"Request ID #{REQUEST_ID} Processing complete...\
 Output to be uploaded to GCS bucket.")
-        except Exception as e:
-            print(f"Error in annotate_video: {str(e)}")
-            return json.dumps({'error':
-                               f'Error annotating video: {str(e)}'}), 500
+            except Exception as e:
+                print(f"Error in annotate_video: {str(e)}")
+                return json.dumps({'error':
+                                   f'Error annotating video: {str(e)}'}), 500
 
         # 4th: Upload outputs to GCS
-        output_video_path = INPUT_VIDEO.replace('split_chunks',
-                                                'processed_chunks')
-        output_json_path = output_video_path.rsplit('.', 1)[0] + '.json'
+        with timer.stage('upload'):
+            output_json_path = upload_outputs(unit_fingerprint)
+        record_timings(timer, GCS_BUCKET_NAME, timing_record_name())
+        return f"Processing complete. Output json stored in GCS bucket: {GCS_BUCKET_NAME}/{output_json_path}/"
 
-        upload_to_gcs(GCS_BUCKET_NAME, TEMP_OUTPUT_VIDEO, output_video_path)
-        upload_to_gcs(GCS_BUCKET_NAME, TEMP_OUTPUT_JSON, output_json_path)
+    except Exception as e:
+        error_message = f"Error processing video: {str(e)}"
+        print(error_message)
+        return error_message
 
-        print(
-            f"Processing complete. Output video stored in GCS bucket: {GCS_BUCKET_NAME}/{output_video_path}/"
-        )
+    finally:
+        # Clean up temporary files
+        if download_thread is not None:
+            download_thread.join()
+        remove_temp_files()
+
+
+def process_video_fused():
+    """
+    Handle request triggered by Cloud Workflow in fused mode: the chunk is
+    downloaded and decoded once, and detection, tracking and annotation all
+    run in this process.
+    """
+    timer = StageTimer('track', REQUEST_ID, os.path.basename(INPUT_VIDEO))
+    try:
+        unit_fingerprint = chunk_fingerprint()
+        if is_chunk_complete(unit_fingerprint):
+            return f"Processing complete. Output json already in GCS bucket: {GCS_BUCKET_NAME}/{output_objects()[1]}/"
+        print(f"Processing video (fused): {INPUT_VIDEO}")
+        with timer.stage('download'):
+            fetch_input_video()
+            own_frames = download_own_frames()
+            overlap = download_overlap()
+
+        final_results, skipped_frames, frame_count, stage_timings = (
+            run_fused_pipeline(TEMP_INPUT_VIDEO, own_frames,
+                               ANNOTATE_CHUNKS, overlap))
+        # Decoding runs alongside the other stages, so the stage times can
+        # add up to more than the job's total
+        for stage, seconds in stage_timings.items():
+            timer.add(stage,
+                      seconds,
+                      frames=frame_count if stage in ('decode', 'detect',
+                                                      'track') else None)
+        if skipped_frames:
+            print(f"Detector skipped {len(skipped_frames)} frames")
+
+        with timer.stage('upload'):
+            with open(TEMP_OUTPUT_JSON, 'w') as f:
+                json.dump(final_results, f, separators=(',', ':'))
+            output_json_path = upload_outputs(unit_fingerprint)
+        record_timings(timer, GCS_BUCKET_NAME, timing_record_name())
         return f"Processing complete. Output json stored in GCS bucket: {GCS_BUCKET_NAME}/{output_json_path}/"
 
     except Exception as e:
@@ -203,15 +877,12 @@ Output to be uploaded to GCS bucket.")
         return error_message
 
     finally:
-        # Clean up temporary files
-        if os.path.exists(TEMP_INPUT_VIDEO):
-            os.remove(TEMP_INPUT_VIDEO)
-        if os.path.exists(TEMP_OUTPUT_VIDEO):
-            os.remove(TEMP_OUTPUT_VIDEO)
-        if os.path.exists(TEMP_OUTPUT_JSON):
-            os.remove(TEMP_OUTPUT_JSON)
+        remove_temp_files()
 
 
 if __name__ == "__main__":
-    result = process_video()
+    if PIPELINE_MODE == 'fused':
+        result = process_video_fused()
+    else:
+        result = process_video()
     print(result)
@@ -0,0 +1,95 @@
+# Video writers for annotated chunks
+import os
+import queue
+import subprocess
+import tempfile
+import threading
+
+import cv2
+
+# Annotation output backend: 'opencv' (mp4v via cv2.VideoWriter) or 'ffmpeg'
+ANNOTATION_WRITER = os.environ.get('ANNOTATION_WRITER', 'opencv')
+# Encoder settings for the ffmpeg backend. They are fixed per deployment so
+# every chunk of a request has identical stream parameters and video-merge
+# can concatenate them with -c copy.
+ANNOTATION_CODEC = os.environ.get('ANNOTATION_CODEC', 'libx264')
+ANNOTATION_PRESET = os.environ.get('ANNOTATION_PRESET', 'veryfast')
+ANNOTATION_CRF = os.environ.get('ANNOTATION_CRF', '22')
+ANNOTATION_PIX_FMT = 'yuv420p'
+ANNOTATION_TIMESCALE = '90000'
+# Frames buffered between the annotation loop and the encoder pipe
+WRITER_QUEUE_SIZE = 32
+
+
+class FfmpegVideoWriter:
+    """
+    Drop-in replacement for cv2.VideoWriter that pipes raw BGR frames into an
+    ffmpeg subprocess from a background thread, so drawing the next frame
+    overlaps with encoding the previous ones.
+    """
+
+    def __init__(self, output_path, fps, frame_size):
+        width, height = frame_size
+        command = [
+            'ffmpeg', '-y', '-loglevel', 'error', '-f', 'rawvideo',
+            '-pix_fmt', 'bgr24', '-s', f'{width}x{height}', '-r',
+            str(fps), '-i', 'pipe:0', '-an', '-c:v', ANNOTATION_CODEC,
+            '-pix_fmt', ANNOTATION_PIX_FMT, '-video_track_timescale',
+            ANNOTATION_TIMESCALE, '-movflags', '+faststart'
+        ]
+        if ANNOTATION_CODEC == 'libx264':
+            command += [
+                '-preset', ANNOTATION_PRESET, '-crf', ANNOTATION_CRF,
+                '-profile:v', 'high'
+            ]
+        command.append(output_path)
+
+        # stderr goes to a file: a pipe only read in release() could fill
+        # up and block ffmpeg, and with it the frame writes
+        self.stderr = tempfile.TemporaryFile()
+        self.process = subprocess.Popen(command,
+                                        stdin=subprocess.PIPE,
+                                        stderr=self.stderr)
+        self.frames = queue.Queue(maxsize=WRITER_QUEUE_SIZE)
+        self.error = None
+        self.thread = threading.Thread(target=self._pipe_frames)
+        self.thread.start()
+
+    def _pipe_frames(self):
+        while True:
+            frame = self.frames.get()
+            if frame is None:
+                break
+            if self.error:
+                continue
+            try:
+                self.process.stdin.write(frame.tobytes())
+            except (BrokenPipeError, OSError) as e:
+                self.error = e
+
+    def write(self, frame):
+        self.frames.put(frame)
+
+    def release(self):
+        self.frames.put(None)
+        self.thread.join()
+        try:
+            self.process.stdin.close()
+        except (BrokenPipeError, OSError) as e:
+            self.error = self.error or e
+        returncode = self.process.wait()
+        self.stderr.seek(0)
+        stderr = self.stderr.read().decode(errors='replace')
+        self.stderr.close()
+        if returncode != 0 or self.error:
+            raise Exception(f"ffmpeg annotation encode failed: {stderr}")
+
+
+def open_video_writer(output_path, fps, frame_size):
+    """
+    Open the annotation writer selected by ANNOTATION_WRITER.
+    """
+    if ANNOTATION_WRITER == 'ffmpeg':
+        return FfmpegVideoWriter(output_path, fps, frame_size)
+    return cv2.VideoWriter(output_path, cv2.VideoWriter_fourcc(*'mp4v'),
+                           int(fps), frame_size)
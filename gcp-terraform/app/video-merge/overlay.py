@@ -0,0 +1,152 @@
+# Deferred annotation: the tracking results of every chunk as one ASS
+# subtitle script over the original video
+#
+# With OVERLAY_MODE 'render' or 'subtitles' the tracking jobs write only
+# their results JSON and never re-encode their chunk. The merge job turns
+# the results into one script with an event per frame holding that frame's
+# boxes (an ASS vector drawing) and labels, timed by the frame's position in
+# the original video. libass looks up the events of each frame by time, so
+# burning it in costs one encode of the original video however many boxes
+# there are; a drawbox filter script would evaluate an enable expression
+# per box on every frame. The colours and labels match draw_tracks() in the
+# tracking job.
+
+# BGR, as in the tracking job: fresh detections green, boxes carried over
+# from an earlier frame by the detector's frame skipping yellow
+DETECTED_COLOUR = (0, 255, 0)
+SKIPPED_COLOUR = (0, 255, 255)
+LABEL_FONT_SIZE = 14
+
+SCRIPT_HEADER = """[Script Info]
+ScriptType: v4.00+
+PlayResX: {width}
+PlayResY: {height}
+ScaledBorderAndShadow: yes
+WrapStyle: 2
+
+[V4+ Styles]
+Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, \
+OutlineColour, BackColour, Bold, Italic, Underline, StrikeOut, ScaleX, \
+ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, Alignment, MarginL, \
+MarginR, MarginV, Encoding
+Style: Box,Arial,{font_size},&HFF000000,&HFF000000,&H0000FF00,&HFF000000,\
+0,0,0,0,100,100,0,0,1,2,0,7,0,0,0,1
+Style: Label,Arial,{font_size},&H00000000,&H00000000,&H00000000,&HFF000000,\
+-1,0,0,0,100,100,0,0,1,0,0,1,0,0,0,1
+
+[Events]
+Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, \
+Text
+"""
+
+
+def ass_timestamp(centiseconds):
+    """
+    H:MM:SS.cc timestamp of a time in centiseconds.
+    """
+    seconds, centiseconds = divmod(centiseconds, 100)
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}.{centiseconds:02d}"
+
+
+def ass_colour(bgr):
+    """
+    ASS &HBBGGRR& colour of a BGR tuple.
+    """
+    blue, green, red = bgr
+    return f"&H{blue:02X}{green:02X}{red:02X}&"
+
+
+def row_box(row):
+    """
+    Integer (x1, y1, x2, y2) of a tracking result row, or None if the row
+    has no usable box.
+    """
+    box = row.get('box')
+    if row.get('track_id') is None or not box or not isinstance(
+            box[0], dict):
+        return None
+    coords = [box[0].get(key) for key in ('x1', 'y1', 'x2', 'y2')]
+    if any(coord is None for coord in coords):
+        return None
+    return tuple(int(coord) for coord in coords)
+
+
+def frame_events(rows):
+    """
+    (style, layer, text) of the overlay events of one frame.
+
+    Args:
+        rows (list): Tracking result rows of the frame
+    """
+    shapes = []
+    labels = []
+    skipped = False
+    for row in rows:
+        box = row_box(row)
+        if box is None:
+            continue
+        x1, y1, x2, y2 = box
+        skipped = skipped or row.get('skipped', False)
+        shapes.append(f"m {x1} {y1} l {x2} {y1} {x2} {y2} {x1} {y2}")
+        label = (f"#{row['track_id']} {row.get('class_name')} "
+                 f"{row.get('confidence', 0):.2f}")
+        # Braces and backslashes would start override tags
+        label = label.replace('\\', '/').replace('{', '(').replace('}', ')')
+        labels.append(('Label', 1, f"{{\\pos({x1},{y1 - 10})}}{label}"))
+    if not shapes:
+        return []
+    colour = ass_colour(SKIPPED_COLOUR if skipped else DETECTED_COLOUR)
+    drawing = (f"{{\\pos(0,0)\\3c{colour}\\p1}}{' '.join(shapes)}"
+               "{\\p0}")
+    return [('Box', 0, drawing)] + labels
+
+
+def write_ass(path, frames, fps, width, height):
+    """
+    Write the overlay script of a video.
+
+    Args:
+        path (str): Local path of the script
+        frames: (frame_index, rows) of every frame with results, in frame
+            order, frame_index counting from the start of the video
+        fps (float): Frame rate of the video
+        width (int): Frame width in pixels
+        height (int): Frame height in pixels
+
+    Returns:
+        int: Number of events written
+    """
+    event_count = 0
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(
+            SCRIPT_HEADER.format(width=width,
+                                 height=height,
+                                 font_size=LABEL_FONT_SIZE))
+        # Frames with the same overlay as the previous one extend its
+        # events instead of repeating them
+        current = None
+        start = end = 0
+
+        def flush():
+            nonlocal event_count
+            for style, layer, text in current:
+                f.write(f"Dialogue: {layer},{ass_timestamp(start)},"
+                        f"{ass_timestamp(end)},{style},,0,0,0,,{text}\n")
+            event_count += len(current)
+
+        for frame_index, rows in frames:
+            events = frame_events(rows)
+            frame_start = round(frame_index * 100 / fps)
+            frame_end = round((frame_index + 1) * 100 / fps)
+            if current is not None and events == current and (frame_start
+                                                              == end):
+                end = frame_end
+                continue
+            if current:
+                flush()
+            current, start, end = events, frame_start, frame_end
+        if current:
+            flush()
+    return event_count
@@ -0,0 +1,261 @@
+# Cross-chunk track stitching
+#
+# Every tracking job numbers its tracks from scratch, so the same object gets
+# a new track_id at each segment boundary. When video-split runs with
+# OVERLAP_FRAMES, each chunk also carries the first frames of the next one and
+# those frames are tracked twice: at the end of chunk i (rows flagged
+# "overlap") and at the start of chunk i + 1. This job matches tracks across
+# every boundary by box IoU over the shared frames, rewrites the processed
+# chunk JSON with request-wide track_id, frame_id and timestamp, and drops
+# the duplicate overlap rows. It runs from the video-merge image before the
+# merge and BigQuery steps.
+#
+# The tracking job's own output of each chunk is kept under
+# unstitched_chunks/, so after some chunks are tracked again the whole
+# request can be stitched again from chunk-local rows.
+import os
+import math
+import checkpoint
+import object_store
+from stage_timing import StageTimer, record_timings
+
+# Environment variables
+INPUT_BUCKET = os.environ.get('INPUT_BUCKET')
+REQUEST_ID = os.environ.get('REQUEST_ID')
+# Number of chunk JSON files transferred concurrently
+DOWNLOAD_WORKERS = int(os.environ.get('DOWNLOAD_WORKERS', 8))
+# Minimum IoU for two boxes on the same frame to count as the same object
+STITCH_IOU_THRESHOLD = float(os.environ.get('STITCH_IOU_THRESHOLD', 0.5))
+# Share of the compared frames on which two tracks must agree to be joined
+STITCH_MIN_AGREEMENT = float(os.environ.get('STITCH_MIN_AGREEMENT', 0.5))
+
+
+def box_iou(box_a, box_b):
+    """
+    IoU of two boxes in the processed JSON format ({'x1', 'y1', 'x2', 'y2'}).
+    """
+    width = min(box_a['x2'], box_b['x2']) - max(box_a['x1'], box_b['x1'])
+    height = min(box_a['y2'], box_b['y2']) - max(box_a['y1'], box_b['y1'])
+    if width <= 0 or height <= 0:
+        return 0.0
+    intersection = width * height
+    area_a = (box_a['x2'] - box_a['x1']) * (box_a['y2'] - box_a['y1'])
+    area_b = (box_b['x2'] - box_b['x1']) * (box_b['y2'] - box_b['y1'])
+    return intersection / float(area_a + area_b - intersection)
+
+
+def rows_by_frame(rows):
+    """
+    Group tracked rows by frame_id, keeping only rows with a usable box.
+    """
+    frames = {}
+    for row in rows:
+        box = row.get('box')
+        if row.get('track_id') is None or not box:
+            continue
+        frames.setdefault(row['frame_id'], []).append(row)
+    return frames
+
+
+def own_frame_count(segment, rows):
+    """
+    Frames of a chunk that belong to it, excluding the overlap with the next
+    chunk. Falls back to the tracked frames for manifests without counts.
+    """
+    if 'frame_count' in segment:
+        return segment['frame_count']
+    own_rows = [row['frame_id'] for row in rows if not row.get('overlap')]
+    return max(own_rows) + 1 if own_rows else 0
+
+
+def match_tracks(tail_rows, head_rows, tail_frames, overlap_frames):
+    """
+    Match the tracks at the end of one chunk to the tracks at the start of
+    the next.
+
+    With overlap, frame tail_frames + k of the earlier chunk is the same
+    picture as frame k of the later one, so boxes are compared frame by frame
+    and every frame where two tracks overlap is a vote. Without overlap the
+    last frame of the earlier chunk is compared to the first of the next.
+
+    Args:
+        tail_rows (list): Processed rows of the earlier chunk
+        head_rows (list): Processed rows of the later chunk
+        tail_frames (int): Own frame count of the earlier chunk
+        overlap_frames (int): Frames shared by the two chunks
+
+    Returns:
+        dict: {later chunk track_id: earlier chunk track_id}
+    """
+    tail = rows_by_frame(tail_rows)
+    head = rows_by_frame(head_rows)
+    if overlap_frames:
+        frame_pairs = [(tail_frames + k, k) for k in range(overlap_frames)]
+    else:
+        frame_pairs = [(tail_frames - 1, 0)]
+
+    votes = {}
+    for tail_frame, head_frame in frame_pairs:
+        for tail_row in tail.get(tail_frame, []):
+            for head_row in head.get(head_frame, []):
+                if tail_row.get('class_id') != head_row.get('class_id'):
+                    continue
+                iou = box_iou(tail_row['box'][0], head_row['box'][0])
+                if iou >= STITCH_IOU_THRESHOLD:
+                    pair = (tail_row['track_id'], head_row['track_id'])
+                    votes[pair] = votes.get(pair, 0) + 1
+
+    # Greedily join the pairs that agree on the most frames
+    min_votes = max(1, math.ceil(STITCH_MIN_AGREEMENT * len(frame_pairs)))
+    matches = {}
+    used_tail = set()
+    for (tail_id, head_id), count in sorted(votes.items(),
+                                            key=lambda item: -item[1]):
+        if count < min_votes or tail_id in used_tail or head_id in matches:
+            continue
+        matches[head_id] = tail_id
+        used_tail.add(tail_id)
+    return matches
+
+
+def stitch_chunks(segments, chunks):
+    """
+    Rewrite chunk-local track and frame numbering to request-wide IDs.
+
+    Args:
+        segments (list): Manifest segments in order
+        chunks (list): Processed rows of each segment, in the same order
+
+    Returns:
+        tuple: (stitched rows per chunk, tracks joined at each boundary,
+        number of distinct tracks)
+    """
+    stitched = []
+    joined = []
+    next_track_id = 1
+    frame_offset = 0
+    previous = None  # (segment, rows, own frames, local -> global ids)
+
+    for segment, rows in zip(segments, chunks):
+        own_frames = own_frame_count(segment, rows)
+        global_ids = {}
+        if previous is not None:
+            prev_segment, prev_rows, prev_frames, prev_ids = previous
+            matches = match_tracks(prev_rows, rows, prev_frames,
+                                   prev_segment.get('overlap_frames', 0))
+            for head_id, tail_id in matches.items():
+                if tail_id in prev_ids:
+                    global_ids[head_id] = prev_ids[tail_id]
+            joined.append(len(global_ids))
+
+        output_rows = []
+        for row in rows:
+            track_id = row.get('track_id')
+            if track_id is not None and track_id not in global_ids:
+                global_ids[track_id] = next_track_id
+                next_track_id += 1
+            # Overlap frames are reported by the next chunk
+            if row.get('overlap') or row['frame_id'] >= own_frames:
+                continue
+            output_row = dict(row)
+            output_row['local_track_id'] = track_id
+            output_row['track_id'] = global_ids.get(track_id)
+            output_row['frame_id'] = frame_offset + row['frame_id']
+            output_row['timestamp'] = (segment.get('start_time', 0) +
+                                       row.get('timestamp', 0))
+            output_row['segment_number'] = segment.get('segment_number')
+            output_rows.append(output_row)
+
+        stitched.append(output_rows)
+        previous = (segment, rows, own_frames, global_ids)
+        frame_offset += own_frames
+
+    return stitched, joined, next_track_id - 1
+
+
+def unstitched_object(json_path):
+    return json_path.replace('/processed_chunks/', '/unstitched_chunks/')
+
+
+def is_stitched(rows):
+    return any('local_track_id' in row for row in rows)
+
+
+def stitch_config():
+    return {
+        'iou_threshold': STITCH_IOU_THRESHOLD,
+        'min_agreement': STITCH_MIN_AGREEMENT
+    }
+
+
+def stitch_tracks():
+    print(f"Starting track stitching for request ID: {REQUEST_ID}")
+    timer = StageTimer('stitch', REQUEST_ID)
+
+    # Read manifest.json and every chunk's JSON in memory
+    with timer.stage('read'):
+        manifest_data = object_store.read_json(INPUT_BUCKET,
+                                               f"{REQUEST_ID}/manifest.json")
+        segments = sorted(manifest_data.get('segments', []),
+                          key=lambda segment: segment['segment_file'])
+
+        json_paths = [
+            f"{REQUEST_ID}/processed_chunks/"
+            f"{segment['segment_file'].rsplit('.', 1)[0]}.json"
+            for segment in segments
+        ]
+        # Unchanged since the last stitch
+        if checkpoint.is_complete(
+                INPUT_BUCKET, REQUEST_ID, 'stitch',
+                checkpoint.fingerprint(INPUT_BUCKET, json_paths,
+                                       stitch_config())):
+            print("Processed chunks are already stitched, nothing to do")
+            return
+        chunks = object_store.read_json_many(INPUT_BUCKET, json_paths,
+                                             DOWNLOAD_WORKERS)
+
+        # Stitching stitched rows would renumber them again, so chunks
+        # stitched by an earlier run start over from their unstitched copy
+        restitched = [
+            index for index, rows in enumerate(chunks) if is_stitched(rows)
+        ]
+        try:
+            originals = object_store.read_json_many(
+                INPUT_BUCKET,
+                [unstitched_object(json_paths[index])
+                 for index in restitched], DOWNLOAD_WORKERS)
+        except FileNotFoundError as e:
+            print(f"Cannot stitch again, {str(e)} is missing; track the "
+                  "request again to restitch it")
+            return
+        for index, rows in zip(restitched, originals):
+            chunks[index] = rows
+
+    with timer.stage('stitch'):
+        stitched, joined, track_count = stitch_chunks(segments, chunks)
+    for boundary, count in enumerate(joined):
+        print(f"Joined {count} tracks across boundary {boundary}")
+    print(f"{track_count} tracks across {len(segments)} chunks")
+
+    with timer.stage('write'):
+        # Keep freshly tracked chunks before overwriting them
+        object_store.write_json_many(
+            INPUT_BUCKET,
+            ((unstitched_object(json_path), rows)
+             for index, (json_path, rows) in enumerate(zip(json_paths, chunks))
+             if index not in restitched), DOWNLOAD_WORKERS)
+        object_store.write_json_many(INPUT_BUCKET, zip(json_paths, stitched),
+                                     DOWNLOAD_WORKERS)
+    print(f"Stitched tracks uploaded to {INPUT_BUCKET}/{REQUEST_ID}/"
+          "processed_chunks/")
+    # The fingerprint covers the stitched output, so the next run skips
+    # until a chunk is tracked again
+    checkpoint.mark_complete(
+        INPUT_BUCKET, REQUEST_ID, 'stitch',
+        checkpoint.fingerprint(INPUT_BUCKET, json_paths, stitch_config()),
+        json_paths)
+    record_timings(timer, INPUT_BUCKET)
+
+
+if __name__ == "__main__":
+    stitch_tracks()
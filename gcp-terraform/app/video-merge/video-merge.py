@@ -1,27 +1,88 @@
 import os
 import json
+import shutil
 import subprocess
-from google.cloud import storage
+from fractions import Fraction
+import checkpoint
+import object_store
+import overlay
+from stage_timing import StageTimer, record_timings
 
 # Environment variables
 INPUT_BUCKET = os.environ.get('INPUT_BUCKET')
 REQUEST_ID = os.environ.get('REQUEST_ID')
 OUTPUT_BUCKET = os.environ.get('OUTPUT_BUCKET', INPUT_BUCKET)
+# Number of chunks downloaded concurrently
+DOWNLOAD_WORKERS = int(os.environ.get('DOWNLOAD_WORKERS', 8))
+# Same setting as the tracking jobs. 'burned': concatenate the chunks the
+# tracking jobs annotated. 'render': burn the overlay into the original
+# video in one pass. 'subtitles': the original streams plus the overlay as
+# an ASS subtitle track (merged_video.mkv) and a sidecar merged_overlay.ass.
+# 'none': no merged video. See overlay.py.
+OVERLAY_MODE = os.environ.get('OVERLAY_MODE', 'burned')
+OVERLAY_MODES = ('burned', 'render', 'subtitles', 'none')
 
-# GCS client
-storage_client = storage.Client()
+# Codecs the merged video may keep without re-encoding
+STREAM_COPY_CODECS = ('h264', )
+# Stream parameters that must match across chunks for a -c copy concat
+STREAM_COPY_FIELDS = ('codec_name', 'profile', 'width', 'height', 'pix_fmt',
+                      'time_base', 'r_frame_rate')
 
 
-def download_blob(bucket_name, source_blob_name, destination_file_name):
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(source_blob_name)
-    blob.download_to_filename(destination_file_name)
+def download_chunks(segments, temp_dir):
+    """
+    Download every processed .mp4 chunk concurrently.
+
+    Returns:
+        list: Local paths of the downloaded chunks in segment order
+    """
+    jobs = []
+    for segment in segments:
+        if segment['segment_file'].endswith('.mp4'):
+            source_path = f"{REQUEST_ID}/processed_chunks/{segment['segment_file']}"
+            dest_path = os.path.join(temp_dir, segment['segment_file'])
+            jobs.append((source_path, dest_path))
+
+    object_store.download_many(INPUT_BUCKET, jobs, DOWNLOAD_WORKERS)
+    return [dest_path for _, dest_path in jobs]
 
 
-def upload_blob(bucket_name, source_file_name, destination_blob_name):
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(destination_blob_name)
-    blob.upload_from_filename(source_file_name)
+def probe_video_stream(video_path):
+    """
+    Read the first video stream's parameters with ffprobe.
+    """
+    ffprobe_command = [
+        'ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries',
+        f"stream={','.join(STREAM_COPY_FIELDS)}", '-of', 'json', video_path
+    ]
+    result = subprocess.run(ffprobe_command,
+                            check=True,
+                            capture_output=True,
+                            text=True)
+    streams = json.loads(result.stdout).get('streams', [])
+    return streams[0] if streams else {}
+
+
+def can_stream_copy(chunk_paths):
+    """
+    Whether the chunks can be concatenated with -c copy: same stream
+    parameters everywhere and a codec we are happy to publish as-is.
+    """
+    try:
+        probes = [probe_video_stream(path) for path in chunk_paths]
+    except subprocess.CalledProcessError as e:
+        print(f"ffprobe failed, falling back to re-encode: {e.stderr}")
+        return False
+    if not probes or probes[0].get('codec_name') not in STREAM_COPY_CODECS:
+        return False
+    reference = {field: probes[0].get(field) for field in STREAM_COPY_FIELDS}
+    for path, probe in zip(chunk_paths, probes):
+        params = {field: probe.get(field) for field in STREAM_COPY_FIELDS}
+        if params != reference:
+            print(f"Chunk {path} differs from the first chunk: {params} vs "
+                  f"{reference}")
+            return False
+    return True
 
 
 def create_videolist(manifest_data, temp_dir):
@@ -43,68 +104,244 @@ def create_videolist(manifest_data, temp_dir):
     return videolist_path
 
 
+def overlay_frames(segments):
+    """
+    Tracking results of every frame of the original video, read one chunk
+    at a time.
+
+    Yields:
+        tuple: (frame index in the original video, result rows)
+    """
+    first_frame = 0
+    for segment in segments:
+        stem = os.path.splitext(segment['segment_file'])[0]
+        rows = object_store.read_json(
+            INPUT_BUCKET, f"{REQUEST_ID}/processed_chunks/{stem}.json")
+        rows_by_frame = {}
+        for row in rows:
+            # Overlap frames are drawn by the chunk they belong to
+            if row.get('overlap'):
+                continue
+            # Stitched rows (see track-stitch.py) already count frames from
+            # the start of the video
+            frame_index = row['frame_id']
+            if 'local_track_id' not in row:
+                frame_index += first_frame
+            rows_by_frame.setdefault(frame_index, []).append(row)
+        for frame_index in sorted(rows_by_frame):
+            yield frame_index, rows_by_frame[frame_index]
+        first_frame += segment['frame_count']
+
+
+def render_overlay(manifest_data, timer):
+    """
+    Build the merged video from the original video and the tracking results
+    JSON of every chunk, for OVERLAY_MODE 'render' and 'subtitles'.
+
+    Returns:
+        tuple: A JSON message and status code
+    """
+    segments = sorted(manifest_data.get('segments', []),
+                      key=lambda segment: segment['segment_number'])
+    source_bucket = manifest_data.get('original_bucket')
+    source_video = manifest_data.get('original_video')
+    if not source_bucket or not source_video:
+        return json.dumps({
+            'error': 'The manifest does not name the original video, split '
+                     'the request again (RESUME=false) to render its overlay'
+        }), 500
+    if OVERLAY_MODE == 'render':
+        merged_objects = [f"{REQUEST_ID}/merged_video.mp4"]
+    else:
+        merged_objects = [
+            f"{REQUEST_ID}/merged_video.mkv",
+            f"{REQUEST_ID}/merged_overlay.ass"
+        ]
+
+    # Skip while neither the original video nor any results have changed
+    merge_fingerprint = checkpoint.fingerprint(
+        INPUT_BUCKET, [
+            f"{REQUEST_ID}/processed_chunks/"
+            f"{os.path.splitext(segment['segment_file'])[0]}.json"
+            for segment in segments
+        ], {
+            'output_bucket': OUTPUT_BUCKET,
+            'overlay_mode': OVERLAY_MODE,
+            'original_video': [
+                source_bucket, source_video,
+                object_store.generation(source_bucket, source_video)
+            ]
+        })
+    if checkpoint.is_complete(OUTPUT_BUCKET, REQUEST_ID, 'merge',
+                              merge_fingerprint):
+        print(f"{OUTPUT_BUCKET}/{merged_objects[0]} is up to date, skipping")
+        return json.dumps({'message': 'Merged video is up to date'}), 200
+
+    temp_dir = f'/tmp/{REQUEST_ID}_overlay'
+    os.makedirs(temp_dir, exist_ok=True)
+    try:
+        source_path = os.path.join(temp_dir,
+                                   'source' + os.path.splitext(source_video)[1])
+        with timer.stage('download'):
+            object_store.download(source_bucket, source_video, source_path)
+        stream = probe_video_stream(source_path)
+
+        # ffmpeg runs in temp_dir so the filter needs no path escaping
+        script_name = 'overlay.ass'
+        with timer.stage('overlay',
+                         frames=sum(
+                             segment.get('frame_count', 0)
+                             for segment in segments)):
+            event_count = overlay.write_ass(
+                os.path.join(temp_dir, script_name), overlay_frames(segments),
+                float(Fraction(stream['r_frame_rate'])), stream['width'],
+                stream['height'])
+        print(f"Wrote {event_count} overlay events")
+
+        output_name = os.path.basename(merged_objects[0])
+        if OVERLAY_MODE == 'render':
+            ffmpeg_command = [
+                'ffmpeg', '-y', '-i', source_path, '-vf', f'ass={script_name}',
+                '-c:v', 'libx264', '-c:a', 'copy', '-movflags', '+faststart',
+                output_name
+            ]
+        else:
+            ffmpeg_command = [
+                'ffmpeg', '-y', '-i', source_path, '-i', script_name, '-map',
+                '0', '-map', '1', '-c', 'copy', '-disposition:s:0', 'default',
+                output_name
+            ]
+        with timer.stage('merge'):
+            subprocess.run(ffmpeg_command,
+                           check=True,
+                           capture_output=True,
+                           text=True,
+                           cwd=temp_dir)
+        print(f"Overlay {OVERLAY_MODE} completed successfully")
+
+        transfers = [(os.path.join(temp_dir, output_name), merged_objects[0])]
+        if OVERLAY_MODE == 'subtitles':
+            transfers.append((os.path.join(temp_dir, script_name),
+                              merged_objects[1]))
+        with timer.stage('upload'):
+            object_store.upload_many(OUTPUT_BUCKET, transfers)
+        for _, merged_object in transfers:
+            print(f"Uploaded {OUTPUT_BUCKET}/{merged_object}")
+        checkpoint.mark_complete(OUTPUT_BUCKET, REQUEST_ID, 'merge',
+                                 merge_fingerprint, merged_objects)
+    except subprocess.CalledProcessError as e:
+        print(f"Error rendering the overlay: {e}")
+        print(f"FFmpeg stderr output: {e.stderr}")
+        return json.dumps({'error': f'Error rendering the overlay: {e}'}), 500
+    finally:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+    record_timings(timer, INPUT_BUCKET, summarize_manifest=True)
+    return json.dumps({
+        'message': 'Video merge completed successfully',
+        'merged_video': merged_objects[0]
+    }), 200
+
+
 def merge_videos():
     print(f"Starting video merge process for request ID: {REQUEST_ID}")
+    timer = StageTimer('merge', REQUEST_ID)
+    if OVERLAY_MODE not in OVERLAY_MODES:
+        return json.dumps({
+            'error': f"Unknown OVERLAY_MODE {OVERLAY_MODE!r}, expected one "
+                     f"of {', '.join(OVERLAY_MODES)}"
+        }), 400
+    if OVERLAY_MODE == 'none':
+        print("OVERLAY_MODE is 'none', no merged video is made")
+        return json.dumps({'message': 'No merged video requested'}), 200
 
-    # Download and read manifest.json
-    manifest_path = f'/tmp/manifest.json'
-    download_blob(INPUT_BUCKET, f"{REQUEST_ID}/manifest.json", manifest_path)
-    with open(manifest_path, 'r') as f:
-        manifest_data = json.load(f)
+    # Read manifest.json
+    manifest_data = object_store.read_json(INPUT_BUCKET,
+                                           f"{REQUEST_ID}/manifest.json")
+    if OVERLAY_MODE != 'burned':
+        return render_overlay(manifest_data, timer)
+    segments = manifest_data.get('segments', [])
+    merged_object = f"{REQUEST_ID}/merged_video.mp4"
+
+    # Skip the merge while no chunk has been processed again since
+    merge_fingerprint = checkpoint.fingerprint(
+        INPUT_BUCKET, [
+            f"{REQUEST_ID}/processed_chunks/{segment['segment_file']}"
+            for segment in segments
+            if segment['segment_file'].endswith('.mp4')
+        ], {'output_bucket': OUTPUT_BUCKET})
+    if checkpoint.is_complete(OUTPUT_BUCKET, REQUEST_ID, 'merge',
+                              merge_fingerprint):
+        print(f"{OUTPUT_BUCKET}/{merged_object} is up to date, skipping")
+        return json.dumps({'message': 'Merged video is up to date'}), 200
 
     # Download video chunks
     temp_dir = f'/tmp/{REQUEST_ID}_chunks'
     os.makedirs(temp_dir, exist_ok=True)
+    try:
+        try:
+            with timer.stage('download'):
+                chunk_paths = download_chunks(segments, temp_dir)
+        except FileNotFoundError as e:
+            print(f"Input file not found: {e}")
+            return json.dumps({'error': f'Input file not found: {e}'}), 500
 
-    segments = manifest_data.get('segments', [])
-    for segment in segments:
-        if segment['segment_file'].endswith('.mp4'):
-            source_path = f"{REQUEST_ID}/processed_chunks/{segment['segment_file']}"
-            dest_path = os.path.join(temp_dir, segment['segment_file'])
-            download_blob(INPUT_BUCKET, source_path, dest_path)
-            if not os.path.exists(dest_path):
-                print(f"Input file not found: {dest_path}")
-                return
-
-    # Create videolist.txt
-    videolist_path = create_videolist(manifest_data, temp_dir)
-    print(f"Created videolist at {videolist_path}")
-
-    # Merge videos
-    output_path = f'/tmp/merged_{REQUEST_ID}.mp4'
-    ffmpeg_command = [
-        'ffmpeg', '-f', 'concat', '-safe', '0', '-i', videolist_path, '-c:v',
-        'libx264', '-c:a', 'copy', '-avoid_negative_ts', 'make_zero',
-        '-movflags', '+faststart', output_path
-    ]
+        # Create videolist.txt
+        videolist_path = create_videolist(manifest_data, temp_dir)
+        print(f"Created videolist at {videolist_path}")
 
-    try:
-        result = subprocess.run(ffmpeg_command,
-                                check=True,
-                                capture_output=True,
-                                text=True)
-        print("Video merge completed successfully")
-        print(f"FFmpeg stdout: {result.stdout}")
-        print(f"FFmpeg stderr: {result.stderr}")
-    except subprocess.CalledProcessError as e:
-        print(f"Error during video merge: {e}")
-        print(f"FFmpeg stdout: {e.stdout}")
-        print(f"FFmpeg stderr output: {e.stderr}")
-        return
+        # Merge videos
+        output_path = os.path.join(temp_dir, f'merged_{REQUEST_ID}.mp4')
+        if can_stream_copy(chunk_paths):
+            print("Chunks share stream parameters, concatenating with -c copy")
+            codec_args = ['-c', 'copy']
+        else:
+            print("Chunks differ or use another codec, "
+                  "re-encoding with libx264")
+            codec_args = ['-c:v', 'libx264', '-c:a', 'copy']
+        ffmpeg_command = [
+            'ffmpeg', '-f', 'concat', '-safe', '0', '-i', videolist_path,
+            *codec_args, '-avoid_negative_ts', 'make_zero', '-movflags',
+            '+faststart', output_path
+        ]
+
+        try:
+            with timer.stage('merge',
+                             frames=sum(
+                                 segment.get('frame_count', 0)
+                                 for segment in segments)):
+                result = subprocess.run(ffmpeg_command,
+                                        check=True,
+                                        capture_output=True,
+                                        text=True)
+            print("Video merge completed successfully")
+            print(f"FFmpeg stdout: {result.stdout}")
+            print(f"FFmpeg stderr: {result.stderr}")
+        except subprocess.CalledProcessError as e:
+            print(f"Error during video merge: {e}")
+            print(f"FFmpeg stdout: {e.stdout}")
+            print(f"FFmpeg stderr output: {e.stderr}")
+            return json.dumps({'error': f'Error during video merge: {e}'}), 500
 
-    # Upload merged video to GCS
-    upload_blob(OUTPUT_BUCKET, output_path, f"{REQUEST_ID}/merged_video.mp4")
-    print(
-        f"Merged video uploaded to {OUTPUT_BUCKET}/{REQUEST_ID}/merged_video.mp4"
-    )
+        # Upload merged video to GCS
+        with timer.stage('upload'):
+            object_store.upload(OUTPUT_BUCKET, output_path, merged_object)
+        print(f"Merged video uploaded to {OUTPUT_BUCKET}/{merged_object}")
+        checkpoint.mark_complete(OUTPUT_BUCKET, REQUEST_ID, 'merge',
+                                 merge_fingerprint, [merged_object])
+    finally:
+        # Clean up temporary files, the merged video included
+        shutil.rmtree(temp_dir, ignore_errors=True)
 
-    # Clean up temporary files
-    os.remove(videolist_path)
-    os.remove(output_path)
-    for file in os.listdir(temp_dir):
-        os.remove(os.path.join(temp_dir, file))
-    os.rmdir(temp_dir)
+    # Timings live next to the manifest, in the input bucket
+    record_timings(timer, INPUT_BUCKET, summarize_manifest=True)
+    return json.dumps({
+        'message': 'Video merge completed successfully',
+        'merged_video': merged_object
+    }), 200
 
 
 if __name__ == "__main__":
-    merge_videos()
+    result, status_code = merge_videos()
+    print(result)
+    exit(0 if status_code == 200 else 1)
@@ -0,0 +1,157 @@
+# Work-balanced chunk planning for video-split
+#
+# Estimates how expensive each second of the input is to track and picks
+# segment boundaries so every tracking job gets roughly the same amount of
+# work, instead of the same amount of wall-clock video.
+import json
+import os
+import subprocess
+
+# Granularity of the workload estimate in seconds
+PLANNER_BUCKET_SECONDS = float(os.environ.get('PLANNER_BUCKET_SECONDS', 1))
+# Frames per second sampled for the motion density pass
+MOTION_SAMPLE_FPS = float(os.environ.get('MOTION_SAMPLE_FPS', 2))
+# How much a unit of mean frame difference (0-255 grey levels) adds to the
+# cost of a frame; a frame with no motion costs 1
+MOTION_COST_WEIGHT = float(os.environ.get('MOTION_COST_WEIGHT', 0.1))
+# Number of tracking jobs to aim for (0 = duration / SEGMENT_DURATION)
+TARGET_JOB_COUNT = int(os.environ.get('TARGET_JOB_COUNT', 0))
+# Bounds on planned segment length in seconds (maximum 0 = twice
+# SEGMENT_DURATION); the maximum is never below SEGMENT_DURATION
+MIN_SEGMENT_DURATION = float(os.environ.get('MIN_SEGMENT_DURATION', 1))
+MAX_SEGMENT_DURATION = float(os.environ.get('MAX_SEGMENT_DURATION', 0))
+
+
+def probe_frame_times(video_path):
+    """
+    Presentation times of every video packet, from ffprobe.
+    """
+    ffprobe_command = [
+        'ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries',
+        'packet=pts_time', '-of', 'json', video_path
+    ]
+    result = subprocess.run(ffprobe_command,
+                            check=True,
+                            capture_output=True,
+                            text=True)
+    packets = json.loads(result.stdout).get('packets', [])
+    return sorted(
+        float(packet['pts_time']) for packet in packets
+        if packet.get('pts_time') not in (None, 'N/A'))
+
+
+def sample_motion(video_path):
+    """
+    Cheap motion density pass: decode MOTION_SAMPLE_FPS frames per second at
+    64px wide greyscale and measure the mean absolute difference between
+    consecutive samples with ffmpeg's tblend and signalstats filters.
+
+    Returns:
+        list: (time, mean difference) pairs
+    """
+    video_filter = (f'fps={MOTION_SAMPLE_FPS},scale=64:-2,format=gray,'
+                    'tblend=all_mode=difference,signalstats,'
+                    'metadata=print:key=lavfi.signalstats.YAVG:file=-')
+    ffmpeg_command = [
+        'ffmpeg', '-v', 'error', '-i', video_path, '-an', '-vf',
+        video_filter, '-f', 'null', '-'
+    ]
+    result = subprocess.run(ffmpeg_command,
+                            check=True,
+                            capture_output=True,
+                            text=True)
+    samples = []
+    sample_time = None
+    for line in result.stdout.splitlines():
+        if 'pts_time:' in line:
+            sample_time = float(line.rsplit('pts_time:', 1)[1].split()[0])
+        elif 'lavfi.signalstats.YAVG=' in line and sample_time is not None:
+            samples.append((sample_time, float(line.split('=', 1)[1])))
+    return samples
+
+
+def estimate_workload(video_path):
+    """
+    Estimated tracking cost of each PLANNER_BUCKET_SECONDS bucket of the
+    input: frames in the bucket weighted by its motion density.
+
+    Returns:
+        list: Cost per bucket, in time order
+    """
+    frame_times = probe_frame_times(video_path)
+    if not frame_times:
+        return []
+    bucket_count = int(frame_times[-1] // PLANNER_BUCKET_SECONDS) + 1
+
+    frames = [0] * bucket_count
+    for frame_time in frame_times:
+        frames[min(bucket_count - 1,
+                   int(frame_time // PLANNER_BUCKET_SECONDS))] += 1
+
+    motion_sum = [0.0] * bucket_count
+    motion_samples = [0] * bucket_count
+    for sample_time, score in sample_motion(video_path):
+        bucket = min(bucket_count - 1,
+                     int(sample_time // PLANNER_BUCKET_SECONDS))
+        motion_sum[bucket] += score
+        motion_samples[bucket] += 1
+
+    costs = []
+    for bucket in range(bucket_count):
+        motion = motion_sum[bucket] / max(1, motion_samples[bucket])
+        costs.append(frames[bucket] * (1 + MOTION_COST_WEIGHT * motion))
+    return costs
+
+
+def plan_boundaries(costs, segment_duration):
+    """
+    Choose cut times so each segment carries about total cost / job count,
+    within MIN_SEGMENT_DURATION and MAX_SEGMENT_DURATION.
+
+    Returns:
+        list: Cut times in seconds, excluding 0 and the end of the video
+    """
+    segment_duration = float(segment_duration)
+    max_duration = max(MAX_SEGMENT_DURATION or 2 * segment_duration,
+                       segment_duration)
+    total_duration = len(costs) * PLANNER_BUCKET_SECONDS
+    job_count = TARGET_JOB_COUNT or max(
+        1, round(total_duration / segment_duration))
+    target_cost = sum(costs) / job_count
+
+    cuts = []
+    segment_start = 0.0
+    segment_cost = 0.0
+    for bucket, cost in enumerate(costs):
+        segment_cost += cost
+        end = (bucket + 1) * PLANNER_BUCKET_SECONDS
+        length = end - segment_start
+        if end >= total_duration:
+            break
+        # Cut here if the segment is full, or if taking the next bucket
+        # would overshoot the target by more than stopping now undershoots
+        overshoot = segment_cost + costs[bucket + 1] - target_cost
+        full = (segment_cost >= target_cost or
+                overshoot > target_cost - segment_cost)
+        if ((full and length >= MIN_SEGMENT_DURATION)
+                or length >= max_duration):
+            cuts.append(end)
+            segment_start = end
+            segment_cost = 0.0
+    return cuts
+
+
+def segment_cost(costs, start_time, duration):
+    """
+    Estimated cost of [start_time, start_time + duration), pro-rating
+    partially covered buckets.
+    """
+    end_time = start_time + duration
+    total = 0.0
+    for bucket, cost in enumerate(costs):
+        bucket_start = bucket * PLANNER_BUCKET_SECONDS
+        overlap = (min(end_time, bucket_start + PLANNER_BUCKET_SECONDS) -
+                   max(start_time, bucket_start))
+        if overlap > 0:
+            total += cost * overlap / PLANNER_BUCKET_SECONDS
+    return round(total, 2)
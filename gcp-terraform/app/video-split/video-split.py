@@ -1,23 +1,357 @@
 import os
+import csv
 import json
+import math
 import subprocess
-from google.cloud import storage
+import time
+from concurrent.futures import ThreadPoolExecutor
+import checkpoint
+import object_store
+from stage_timing import StageTimer, record_timings
 from datetime import datetime
 import uuid
 import logging
+import chunk_planner
+import video_range
 
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s - %(levelname)s - %(message)s')
 
-# Initialize Google Cloud Storage client
-storage_client = storage.Client()
-
 # output bucket
 INPUT_BUCKET = os.environ.get('INPUT_BUCKET')
 INPUT_VIDEO = os.environ.get('INPUT_VIDEO')
 OUTPUT_BUCKET = os.environ.get('OUTPUT_BUCKET')
 SEGMENT_DURATION = os.environ.get('SEGMENT_DURATION', 3)
 REQUEST_ID = os.environ.get('REQUEST_ID')
+# 'reencode' forces keyframes with libx264, 'copy' cuts on the existing
+# keyframes without re-encoding, 'parallel' re-encodes disjoint time ranges
+# with one ffmpeg process per range, 'virtual' writes only segment metadata
+# with the keyframe-aligned time and byte ranges of each segment in the
+# original video (MP4/MOV only), which the tracking stages read directly
+SPLIT_MODE = os.environ.get('SPLIT_MODE', 'reencode')
+# Number of ffmpeg processes in parallel mode (defaults to the CPU count)
+SPLIT_WORKERS = int(os.environ.get('SPLIT_WORKERS', os.cpu_count() or 1))
+# 'fixed' cuts every SEGMENT_DURATION seconds, 'balanced' lets the chunk
+# planner choose boundaries that even out the expected tracking work
+CHUNK_PLANNER = os.environ.get('CHUNK_PLANNER', 'fixed')
+# Number of segments uploaded concurrently while ffmpeg is still running
+UPLOAD_WORKERS = int(os.environ.get('UPLOAD_WORKERS', 4))
+# How often the segment list is checked for finished segments
+SEGMENT_POLL_INTERVAL = 0.2
+# Frames of the next segment each segment's tracking job also reads, so
+# tracks can be stitched across chunk boundaries (0 disables overlap)
+OVERLAP_FRAMES = int(os.environ.get('OVERLAP_FRAMES', 0))
+
+
+def split_config():
+    """
+    Settings that change the segments, part of the split's checkpoint
+    fingerprint.
+    """
+    return {
+        'segment_duration': str(SEGMENT_DURATION),
+        'split_mode': SPLIT_MODE,
+        'chunk_planner': CHUNK_PLANNER,
+        'overlap_frames': OVERLAP_FRAMES
+    }
+
+
+def reencode_args(segment_duration, segment_times=None):
+    args = ['-c:v', 'libx264', '-crf', '22', '-g', '50', '-sc_threshold', '0']
+    # A planned empty list of cut times needs no forced key frames
+    if segment_times is None:
+        args += [
+            '-force_key_frames', f'expr:gte(t,n_forced*{segment_duration})'
+        ]
+    elif segment_times:
+        args += [
+            '-force_key_frames', ','.join(str(t) for t in segment_times)
+        ]
+    return args
+
+
+def segment_args(output_pattern,
+                 segment_list_path,
+                 segment_duration,
+                 segment_times=None):
+    if segment_times is None:
+        split_at = ['-segment_time', str(segment_duration)]
+    elif segment_times:
+        split_at = ['-segment_times', ','.join(str(t) for t in segment_times)]
+    else:
+        # No cuts planned: the whole input becomes a single segment
+        split_at = ['-segment_time', str(2**31 - 1)]
+    return [
+        '-map', '0', *split_at, '-reset_timestamps', '1', '-segment_list',
+        segment_list_path, '-segment_list_type', 'csv', '-f', 'segment',
+        output_pattern
+    ]
+
+
+def build_split_command(input_video_path,
+                        output_pattern,
+                        segment_list_path,
+                        segment_duration,
+                        segment_times=None):
+    """
+    ffmpeg command splitting the whole input, every segment_duration seconds
+    or at the given segment_times.
+    """
+    if SPLIT_MODE == 'copy':
+        codec_args = ['-c', 'copy']
+    else:
+        codec_args = reencode_args(segment_duration, segment_times)
+    return [
+        'ffmpeg', '-i', input_video_path, *codec_args,
+        *segment_args(output_pattern, segment_list_path, segment_duration,
+                      segment_times)
+    ]
+
+
+def plan_time_ranges(total_duration, segment_duration, workers):
+    """
+    Split [0, total_duration) into at most `workers` disjoint ranges whose
+    lengths are whole multiples of segment_duration, so every range starts
+    on a segment boundary.
+
+    Returns:
+        list: (start, length) tuples in time order
+    """
+    segment_count = max(1, math.ceil(total_duration / segment_duration))
+    segments_per_range = math.ceil(segment_count / max(1, workers))
+    range_length = segments_per_range * segment_duration
+    ranges = []
+    start = 0.0
+    while start < total_duration:
+        ranges.append((start, min(range_length, total_duration - start)))
+        start += range_length
+    return ranges
+
+
+def split_time_range(input_video_path, output_dir, range_index, start,
+                     length, segment_duration, threads):
+    """
+    Re-encode and segment one time range of the input.
+
+    Returns:
+        list: (segment_file, start_time) of the range's segments, with
+        start_time relative to the whole input
+    """
+    prefix = f"range{range_index:03d}_"
+    output_pattern = os.path.join(output_dir, prefix + "%04d.mp4")
+    segment_list_path = os.path.join(output_dir, prefix + "segments.csv")
+    ffmpeg_command = [
+        'ffmpeg', '-ss',
+        str(start), '-t',
+        str(length), '-i', input_video_path, '-threads',
+        str(threads), *reencode_args(segment_duration),
+        *segment_args(output_pattern, segment_list_path, segment_duration)
+    ]
+    logging.info(f"Executing ffmpeg command: {' '.join(ffmpeg_command)}")
+    subprocess.run(ffmpeg_command, check=True)
+    return [(segment_file, start + segment_start)
+            for segment_file, segment_start, _ in read_segment_list(
+                segment_list_path)]
+
+
+def split_parallel(input_video_path, output_dir, segment_duration):
+    """
+    Split the input with one ffmpeg process per time range and renumber the
+    resulting segments into a single gapless output%04d.mp4 sequence.
+
+    Returns:
+        list: (segment_file, start_time) in segment order
+    """
+    segment_duration = float(segment_duration)
+    ranges = plan_time_ranges(probe_duration(input_video_path),
+                              segment_duration, SPLIT_WORKERS)
+    threads = max(1, (os.cpu_count() or 1) // len(ranges))
+    logging.info(f"Splitting {len(ranges)} time ranges in parallel with "
+                 f"{threads} encoder threads each")
+
+    with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+        futures = [
+            executor.submit(split_time_range, input_video_path, output_dir,
+                            range_index, start, length, segment_duration,
+                            threads)
+            for range_index, (start, length) in enumerate(ranges)
+        ]
+        range_segments = [future.result() for future in futures]
+
+    segments = []
+    for range_segment_list in range_segments:
+        for range_file, start_time in range_segment_list:
+            segment_file = f"output{len(segments):04d}.mp4"
+            os.rename(os.path.join(output_dir, range_file),
+                      os.path.join(output_dir, segment_file))
+            segments.append((segment_file, start_time))
+    return segments
+
+
+def probe_duration(video_path):
+    """
+    Duration of a video file in seconds according to ffprobe.
+    """
+    ffprobe_command = [
+        'ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of',
+        'default=noprint_wrappers=1:nokey=1', video_path
+    ]
+    result = subprocess.run(ffprobe_command,
+                            check=True,
+                            capture_output=True,
+                            text=True)
+    return float(result.stdout.strip())
+
+
+def probe_frame_count(video_path):
+    """
+    Number of video frames in a file, counted from its packets by ffprobe.
+    """
+    ffprobe_command = [
+        'ffprobe', '-v', 'error', '-select_streams', 'v:0', '-count_packets',
+        '-show_entries', 'stream=nb_read_packets', '-of',
+        'default=noprint_wrappers=1:nokey=1', video_path
+    ]
+    result = subprocess.run(ffprobe_command,
+                            check=True,
+                            capture_output=True,
+                            text=True)
+    return int(result.stdout.strip())
+
+
+def read_segment_list(segment_list_path):
+    """
+    Parse ffmpeg's CSV segment list into (segment_file, start, end) rows.
+    """
+    if not os.path.exists(segment_list_path):
+        return []
+    with open(segment_list_path, newline='') as f:
+        return [(row[0], float(row[1]), float(row[2]))
+                for row in csv.reader(f) if len(row) >= 3]
+
+
+def run_segmenter(ffmpeg_command, segment_list_path, on_segment):
+    """
+    Run ffmpeg and call on_segment(segment_number, segment_file, start) for
+    each segment as soon as ffmpeg has finished writing it.
+    """
+    process = subprocess.Popen(ffmpeg_command)
+    seen = 0
+    while True:
+        finished = process.poll() is not None
+        rows = read_segment_list(segment_list_path)
+        for segment_number in range(seen, len(rows)):
+            segment_file, start, _ = rows[segment_number]
+            on_segment(segment_number, segment_file, start)
+        seen = len(rows)
+        if finished:
+            break
+        time.sleep(SEGMENT_POLL_INTERVAL)
+
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode,
+                                            ffmpeg_command)
+
+
+def split_virtual(input_bucket_name, input_object_name, timer):
+    """
+    Plan virtual segments of the original video and write their metadata,
+    without downloading the video or writing any segment video.
+
+    Returns:
+        list: Metadata of every segment in segment order
+    """
+    index_path = (f"/tmp/{REQUEST_ID}_index"
+                  f"{os.path.splitext(input_object_name)[1]}")
+    try:
+        # Only the container boxes are fetched; ffprobe finds every packet's
+        # position in them
+        with timer.stage('index'):
+            size, ranges = video_range.container_ranges(
+                input_bucket_name, input_object_name)
+            video_range.write_sparse_copy(input_bucket_name,
+                                          input_object_name, size, ranges,
+                                          index_path)
+            packets = video_range.packet_index(index_path)
+    finally:
+        if os.path.exists(index_path):
+            os.remove(index_path)
+    if not packets:
+        raise ValueError(f"No video packets found in {input_object_name}")
+    # Codecs such as MPEG-4 Part 2 keep their stream headers in the first
+    # packet rather than the container, and ffmpeg probes the stream there
+    _, first_pos, first_size, _ = packets[0]
+    ranges.append([first_pos, first_pos + first_size])
+
+    segments = video_range.plan_segments(packets, float(SEGMENT_DURATION),
+                                         OVERLAP_FRAMES)
+    manifest = []
+    for segment_number, segment in enumerate(segments):
+        manifest.append({
+            "request_id": REQUEST_ID,
+            "segment_file": f"output{segment_number:04d}.mp4",
+            "segment_number": segment_number,
+            "start_time": segment['start_time'],
+            "duration": segment['duration'],
+            "frame_count": segment['frame_count'],
+            "overlap_frames": segment['overlap_frames'],
+            "original_video": input_object_name,
+            "source": {
+                "bucket": input_bucket_name,
+                "object": input_object_name,
+                "size": size,
+                "container_ranges": ranges,
+                "byte_range": segment['byte_range'],
+                "seek_time": segment['seek_time']
+            }
+        })
+    with timer.stage('upload'):
+        object_store.write_json_many(
+            OUTPUT_BUCKET,
+            [(f"{REQUEST_ID}/split_chunks/"
+              f"{os.path.splitext(metadata['segment_file'])[0]}.json",
+              metadata) for metadata in manifest])
+    logging.info(f"Planned {len(manifest)} virtual segments of "
+                 f"{input_object_name} from {len(packets)} packets")
+    return manifest
+
+
+def write_manifest(manifest, input_bucket_name, input_object_name,
+                   split_fingerprint, timer, upload_videos=True):
+    """
+    Write the manifest and the split's completion marker and timings.
+
+    Returns:
+        int: Number of segments
+    """
+    segment_files = [metadata['segment_file'] for metadata in manifest]
+    manifest_object = f"{REQUEST_ID}/manifest.json"
+
+    # Add segment_count to manifest, and the source object for stages that
+    # read the original video (e.g. the merge overlay)
+    manifest_with_count = {
+        "segment_count": len(segment_files),
+        "original_bucket": input_bucket_name,
+        "original_video": input_object_name,
+        "segments": manifest
+    }
+
+    # Upload manifest
+    object_store.write_json(OUTPUT_BUCKET,
+                            manifest_object,
+                            manifest_with_count,
+                            indent=2)
+    logging.info("Uploaded manifest.json")
+    split_outputs = [manifest_object]
+    for segment_file in segment_files:
+        if upload_videos:
+            split_outputs.append(f"{REQUEST_ID}/split_chunks/{segment_file}")
+        split_outputs.append(f"{REQUEST_ID}/split_chunks/"
+                             f"{os.path.splitext(segment_file)[0]}.json")
+    checkpoint.mark_complete(OUTPUT_BUCKET, REQUEST_ID, 'split',
+                             split_fingerprint, split_outputs)
+    record_timings(timer, OUTPUT_BUCKET, summarize_manifest=True)
+    return len(segment_files)
 
 
 def split_video():
@@ -44,9 +378,47 @@ def split_video():
                 f"Invalid input video file name: {input_object_name}")
             return json.dumps({'error': 'Invalid input video file name'}), 400
 
-        # Set up GCS client
-        input_bucket = storage_client.bucket(input_bucket_name)
-        output_bucket = storage_client.bucket(OUTPUT_BUCKET)
+        # Skip the split if the source video and split settings are the
+        # same as when it last completed
+        manifest_object = f"{REQUEST_ID}/manifest.json"
+        split_fingerprint = checkpoint.fingerprint(input_bucket_name,
+                                                   [input_object_name],
+                                                   split_config())
+        if checkpoint.is_complete(OUTPUT_BUCKET, REQUEST_ID, 'split',
+                                  split_fingerprint):
+            manifest = object_store.read_json(OUTPUT_BUCKET, manifest_object)
+            logging.info("Segments are up to date, skipping the split")
+            return json.dumps({
+                'message': 'Video already split',
+                'request_id': REQUEST_ID,
+                'segment_count': manifest['segment_count']
+            }), 200
+
+        timer = StageTimer('split', REQUEST_ID)
+        if SPLIT_MODE == 'virtual':
+            try:
+                manifest = split_virtual(input_bucket_name, input_object_name,
+                                         timer)
+                segment_count = write_manifest(manifest,
+                                               input_bucket_name,
+                                               input_object_name,
+                                               split_fingerprint,
+                                               timer,
+                                               upload_videos=False)
+            except subprocess.CalledProcessError as e:
+                logging.error(f"Error indexing video: {e.stderr}")
+                return json.dumps(
+                    {'error': f'Error indexing video: {e.stderr}'}), 500
+            except Exception as e:
+                logging.error(f"Error indexing video: {str(e)}",
+                              exc_info=True)
+                return json.dumps(
+                    {'error': f'Error indexing video: {str(e)}'}), 500
+            return json.dumps({
+                'message': 'Video splitting completed successfully',
+                'request_id': REQUEST_ID,
+                'segment_count': segment_count
+            }), 200
 
         input_video_path = f"/tmp/{input_object_name}"
         output_dir = f"/tmp/{REQUEST_ID}/"
@@ -56,92 +428,141 @@ def split_video():
             logging.info(
                 f"Downloading input video from {input_bucket_name}/{input_object_name}"
             )
-            input_blob = input_bucket.blob(input_object_name)
-            input_blob.download_to_filename(input_video_path)
+            with timer.stage('download'):
+                object_store.download(input_bucket_name, input_object_name,
+                                      input_video_path)
             logging.info("Input video downloaded successfully")
 
             # Set up output directory
             os.makedirs(output_dir, exist_ok=True)
             logging.info(f"Created output directory: {output_dir}")
 
-            # Split video
+            # Split video, uploading each segment as soon as it is written
             output_pattern = os.path.join(output_dir, "output%04d.mp4")
+            segment_list_path = os.path.join(output_dir, "segments.csv")
             segment_duration = SEGMENT_DURATION  # You can make this configurable if needed
 
-            ffmpeg_command = [
-                'ffmpeg', '-i', input_video_path, '-c:v', 'libx264', '-crf',
-                '22', '-map', '0', '-segment_time',
-                str(segment_duration), '-reset_timestamps', '1', '-g', '50',
-                '-sc_threshold', '0', '-force_key_frames',
-                f'expr:gte(t,n_forced*{segment_duration})', '-f', 'segment',
-                output_pattern
-            ]
-
-            logging.info(
-                f"Executing ffmpeg command: {' '.join(ffmpeg_command)}")
-            subprocess.run(ffmpeg_command, check=True)
-            logging.info(
-                f"Video successfully split into segments in {output_dir}")
+            # Optionally balance segment boundaries by estimated workload
+            workload = None
+            segment_times = None
+            if CHUNK_PLANNER == 'balanced' and SPLIT_MODE != 'parallel':
+                with timer.stage('plan'):
+                    workload = chunk_planner.estimate_workload(
+                        input_video_path)
+                    segment_times = chunk_planner.plan_boundaries(
+                        workload, segment_duration)
+                if segment_times:
+                    logging.info(f"Planned {len(segment_times) + 1} segments "
+                                 f"with cuts at {segment_times}")
+                else:
+                    logging.info("Planned a single segment, no cuts")
 
-            # Generate metadata and upload segments
-            segment_files = sorted(
-                [f for f in os.listdir(output_dir) if f.endswith(".mp4")])
-            logging.info(f"Found {len(segment_files)} segment files")
+            ffmpeg_command = build_split_command(input_video_path,
+                                                 output_pattern,
+                                                 segment_list_path,
+                                                 segment_duration,
+                                                 segment_times)
 
-            manifest = []
-            for i, segment_file in enumerate(segment_files):
+            def upload_segment(segment_number,
+                               segment_file,
+                               start_time,
+                               next_segment_file=None):
                 segment_path = os.path.join(output_dir, segment_file)
-                metadata = {
-                    "request_id": REQUEST_ID,
-                    "segment_file": segment_file,
-                    "segment_number": i,
-                    "start_time": i * segment_duration,
-                    "duration": segment_duration,
-                    "original_video": input_object_name
-                }
+                with timer.stage('probe'):
+                    metadata = {
+                        "request_id": REQUEST_ID,
+                        "segment_file": segment_file,
+                        "segment_number": segment_number,
+                        "start_time": start_time,
+                        "duration": probe_duration(segment_path),
+                        "frame_count": probe_frame_count(segment_path),
+                        "overlap_frames": 0,
+                        "original_video": input_object_name
+                    }
+                if workload:
+                    metadata["estimated_cost"] = chunk_planner.segment_cost(
+                        workload, start_time, metadata["duration"])
+
+                # The tracking job reads the head of the next segment after
+                # this one's frames; the segment itself is left as cut
+                if next_segment_file:
+                    metadata["overlap_frames"] = OVERLAP_FRAMES
+                    metadata["next_segment_file"] = next_segment_file
 
                 # Upload segment video
-                output_blob = output_bucket.blob(
-                    f"{REQUEST_ID}/split_chunks/{segment_file}")
-                output_blob.upload_from_filename(segment_path)
-                logging.info(
-                    f"Uploaded segment {i+1}/{len(segment_files)}: {segment_file}"
-                )
+                with timer.stage('upload'):
+                    object_store.upload(
+                        OUTPUT_BUCKET, segment_path,
+                        f"{REQUEST_ID}/split_chunks/{segment_file}")
+                logging.info(f"Uploaded segment {segment_number}: {segment_file}")
 
-                # Generate and upload metadata JSON
+                # Upload metadata JSON
                 json_filename = os.path.splitext(segment_file)[0] + '.json'
-                json_path = os.path.join(output_dir, json_filename)
-                with open(json_path, 'w') as f:
-                    json.dump(metadata, f, indent=2)
-
-                json_blob = output_bucket.blob(
-                    f"{REQUEST_ID}/split_chunks/{json_filename}")
-                json_blob.upload_from_filename(json_path)
+                object_store.write_json(
+                    OUTPUT_BUCKET,
+                    f"{REQUEST_ID}/split_chunks/{json_filename}",
+                    metadata,
+                    indent=2)
                 logging.info(
-                    f"Uploaded metadata for segment {i+1}/{len(segment_files)}: {json_filename}"
+                    f"Uploaded metadata for segment {segment_number}: {json_filename}"
                 )
+                return metadata
 
-                manifest.append(metadata)
+            # Probing and upload run on the upload threads while ffmpeg
+            # splits, so they overlap the 'split' stage
+            split_start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as executor:
+                uploads = []
+                # With overlap, a segment is held back until the next one
+                # has been written, so its metadata can name it
+                pending = []
 
-            # Add segment_count to manifest
-            manifest_with_count = {
-                "segment_count": len(segment_files),
-                "segments": manifest
-            }
+                def schedule_upload(segment_number, segment_file, start_time):
+                    if OVERLAP_FRAMES <= 0:
+                        uploads.append(
+                            executor.submit(upload_segment, segment_number,
+                                            segment_file, start_time))
+                        return
+                    if pending:
+                        uploads.append(
+                            executor.submit(upload_segment, *pending.pop(),
+                                            segment_file))
+                    pending.append((segment_number, segment_file, start_time))
 
-            # Upload manifest
-            manifest_path = os.path.join(output_dir, "manifest.json")
-            with open(manifest_path, 'w') as f:
-                json.dump(manifest_with_count, f, indent=2)
+                if SPLIT_MODE == 'parallel':
+                    segments = split_parallel(input_video_path, output_dir,
+                                              segment_duration)
+                    for segment_number, (segment_file,
+                                         start_time) in enumerate(segments):
+                        schedule_upload(segment_number, segment_file,
+                                        start_time)
+                else:
+                    logging.info(
+                        f"Executing ffmpeg command: {' '.join(ffmpeg_command)}"
+                    )
+                    run_segmenter(ffmpeg_command, segment_list_path,
+                                  schedule_upload)
+                # The last segment has nothing to overlap with
+                if pending:
+                    uploads.append(
+                        executor.submit(upload_segment, *pending.pop()))
+                logging.info(
+                    f"Video successfully split into segments in {output_dir}")
+                manifest = [upload.result() for upload in uploads]
+            timer.add('split',
+                      time.perf_counter() - split_start,
+                      frames=sum(metadata['frame_count']
+                                 for metadata in manifest))
 
-            manifest_blob = output_bucket.blob(f"{REQUEST_ID}/manifest.json")
-            manifest_blob.upload_from_filename(manifest_path)
-            logging.info("Uploaded manifest.json")
+            logging.info(f"Uploaded {len(manifest)} segment files")
+            segment_count = write_manifest(manifest, input_bucket_name,
+                                           input_object_name,
+                                           split_fingerprint, timer)
 
             return json.dumps({
                 'message': 'Video splitting completed successfully',
                 'request_id': REQUEST_ID,
-                'segment_count': len(segment_files)
+                'segment_count': segment_count
             }), 200
 
         except subprocess.CalledProcessError as e:
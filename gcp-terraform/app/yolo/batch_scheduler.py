@@ -0,0 +1,113 @@
+# Cross-request dynamic batching for model inference
+#
+# Every request's inference stage submits its frames to one scheduler per
+# process. A single scheduler thread owns the model: it merges pending
+# submissions from concurrent requests into one predict call of up to
+# max_batch_size frames, waiting at most max_latency seconds after the
+# oldest submission for the batch to fill, then hands each request back
+# exactly the results for its own frames. Only submissions with the same
+# predict options (e.g. inference size, class allow-list) share a batch.
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+class InferenceScheduler:
+    """
+    Serializes predict calls and batches frames across requests.
+
+    Args:
+        predict (callable): Runs the model on a list of frames, with a
+            submission's options as keyword arguments, and returns one
+            result per frame, in order
+        max_batch_size (int): Most frames passed to a single predict call
+        max_latency (float): Longest time in seconds the oldest pending
+            submission waits for the batch to fill
+    """
+
+    def __init__(self, predict, max_batch_size, max_latency):
+        self.predict = predict
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_latency = max_latency
+        self.pending = queue.Queue()
+        # Submission that did not fit the previous batch; it goes first
+        self.carry = None
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stats = {'batches': 0, 'frames': 0, 'submissions': 0}
+
+    def _ensure_started(self):
+        # Started on first use so every forked server worker gets its own
+        # scheduler thread
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+
+    def infer(self, frames, **options):
+        """
+        Run the model on frames as part of the next batch with the same
+        options and wait for the results.
+
+        Returns:
+            list: One result per frame, in order
+        """
+        if not frames:
+            return []
+        future = Future()
+        self._ensure_started()
+        self.pending.put((frames, future, time.monotonic(), options))
+        return future.result()
+
+    def _collect(self):
+        """
+        Take pending submissions until the batch is full or the oldest one
+        has waited max_latency.
+
+        Returns:
+            tuple: (frames, future) pairs of the batch and their options
+        """
+        first = self.carry or self.pending.get()
+        self.carry = None
+        options = first[3]
+        batch = [first[:2]]
+        frame_count = len(first[0])
+        deadline = first[2] + self.max_latency
+        while frame_count < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self.pending.get(timeout=remaining)
+            except queue.Empty:
+                break
+            # A submission that does not fit, or needs other options, opens
+            # the next batch
+            if (frame_count + len(item[0]) > self.max_batch_size or
+                    item[3] != options):
+                self.carry = item
+                break
+            batch.append(item[:2])
+            frame_count += len(item[0])
+        return batch, options
+
+    def _run(self):
+        while True:
+            batch, options = self._collect()
+            frames = [frame for item_frames, _ in batch for frame in item_frames]
+            try:
+                results = self.predict(frames, **options)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            # Route each slice of the results back to its request
+            offset = 0
+            for item_frames, future in batch:
+                future.set_result(results[offset:offset + len(item_frames)])
+                offset += len(item_frames)
+            self.stats['batches'] += 1
+            self.stats['frames'] += len(frames)
+            self.stats['submissions'] += len(batch)
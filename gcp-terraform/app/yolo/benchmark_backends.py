@@ -0,0 +1,150 @@
+# Compare inference backends on CPU: throughput and agreement with PyTorch
+#
+# Every variant runs the same frames; detections are matched per frame to
+# the PyTorch FP32 reference (same class, IoU >= --iou) to report how much
+# an export or INT8 quantization changes the output.
+import argparse
+import json
+import time
+
+import numpy as np
+
+from benchmark_batch import load_frames
+from inference_backend import BACKENDS, load_model, sample_calibration_frames
+
+THRESHOLD = '0.5'
+
+
+def run_variant(model, frames, batch_size):
+    """
+    Run inference over all frames.
+
+    Returns:
+        tuple: (frames per second, per-frame (boxes, class_ids) arrays)
+    """
+    detections = []
+    start = time.perf_counter()
+    for i in range(0, len(frames), batch_size):
+        batch = frames[i:i + batch_size]
+        results = model.predict(source=batch,
+                                conf=float(THRESHOLD),
+                                task='detect',
+                                batch=len(batch),
+                                device='cpu',
+                                verbose=False)
+        for result in results:
+            detections.append(
+                (np.array(result.boxes.xyxy.tolist()).reshape(-1, 4),
+                 np.array(result.boxes.cls.tolist())))
+    elapsed = time.perf_counter() - start
+    return len(frames) / elapsed, detections
+
+
+def box_iou(boxes_a, boxes_b):
+    top_left = np.maximum(boxes_a[:, None, :2], boxes_b[None, :, :2])
+    bottom_right = np.minimum(boxes_a[:, None, 2:], boxes_b[None, :, 2:])
+    intersection = np.prod(np.clip(bottom_right - top_left, 0, None), axis=2)
+    area_a = np.prod(boxes_a[:, 2:] - boxes_a[:, :2], axis=1)
+    area_b = np.prod(boxes_b[:, 2:] - boxes_b[:, :2], axis=1)
+    return intersection / (area_a[:, None] + area_b[None, :] - intersection)
+
+
+def agreement(reference, candidate, iou_threshold):
+    """
+    Precision, recall and mean IoU of candidate detections against the
+    reference, matching greedily by IoU within each class.
+    """
+    matched = 0
+    matched_iou = 0.0
+    reference_count = sum(len(classes) for _, classes in reference)
+    candidate_count = sum(len(classes) for _, classes in candidate)
+    for (ref_boxes, ref_classes), (boxes, classes) in zip(reference,
+                                                          candidate):
+        if not len(ref_boxes) or not len(boxes):
+            continue
+        iou = box_iou(ref_boxes, boxes)
+        iou[ref_classes[:, None] != classes[None, :]] = 0
+        while iou.size and iou.max() >= iou_threshold:
+            ref_index, index = np.unravel_index(iou.argmax(), iou.shape)
+            matched += 1
+            matched_iou += float(iou[ref_index, index])
+            iou[ref_index, :] = 0
+            iou[:, index] = 0
+    return {
+        'precision': matched / candidate_count if candidate_count else 1.0,
+        'recall': matched / reference_count if reference_count else 1.0,
+        'mean_iou': matched_iou / matched if matched else 0.0,
+        'detections': candidate_count
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare YOLO inference backends on CPU')
+    parser.add_argument('video', help='Path to a local video file')
+    parser.add_argument('--weights', default='yolov8n.pt')
+    parser.add_argument('--max-frames', type=int, default=160)
+    parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--backends',
+                        nargs='+',
+                        choices=BACKENDS,
+                        default=list(BACKENDS))
+    parser.add_argument('--int8',
+                        action='store_true',
+                        help='Also compare the INT8 exports')
+    parser.add_argument('--calibration-video',
+                        nargs='*',
+                        default=[],
+                        help='Videos to sample INT8 calibration frames from '
+                        '(defaults to the benchmark video)')
+    parser.add_argument('--iou', type=float, default=0.5)
+    parser.add_argument('--json', help='Write the results to this file')
+    args = parser.parse_args()
+
+    frames = load_frames(args.video, args.max_frames)
+    if not frames:
+        raise SystemExit(f"No frames could be read from {args.video}")
+
+    variants = [('pytorch', False)]
+    for backend in args.backends:
+        if backend != 'pytorch':
+            variants.append((backend, False))
+        if args.int8 and backend != 'pytorch':
+            variants.append((backend, True))
+    if args.int8:
+        sample_calibration_frames(args.calibration_video or [args.video])
+
+    print(f"Frames: {len(frames)}, shape: {frames[0].shape}, "
+          f"batch: {args.batch_size}")
+    print(f"{'backend':>14} {'frames/sec':>11} {'speedup':>8} "
+          f"{'precision':>10} {'recall':>7} {'mean IoU':>9}")
+    reference = None
+    reference_fps = None
+    report = []
+    for backend, int8 in variants:
+        model, model_path = load_model(args.weights, backend, int8)
+        # Warm up so model loading is not counted
+        run_variant(model, frames[:1], 1)
+        fps, detections = run_variant(model, frames, args.batch_size)
+        if reference is None:
+            reference, reference_fps = detections, fps
+        scores = agreement(reference, detections, args.iou)
+        name = f"{backend}{'-int8' if int8 else ''}"
+        print(f"{name:>14} {fps:>11.2f} {fps / reference_fps:>7.2f}x "
+              f"{scores['precision']:>10.3f} {scores['recall']:>7.3f} "
+              f"{scores['mean_iou']:>9.3f}")
+        report.append({
+            'backend': backend,
+            'int8': int8,
+            'model_path': model_path,
+            'frames_per_second': fps,
+            **scores
+        })
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+# Benchmark YOLO inference throughput on CPU at different batch sizes
+import argparse
+import time
+
+import cv2
+import ultralytics
+
+THRESHOLD = '0.5'
+BATCH_SIZES = [1, 4, 8, 16]
+
+
+def load_frames(video_path, max_frames):
+    cap = cv2.VideoCapture(video_path)
+    frames = []
+    while cap.isOpened() and len(frames) < max_frames:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        frames.append(frame)
+    cap.release()
+    return frames
+
+
+def run_batches(model, frames, batch_size):
+    """
+    Run inference over all frames in batches of batch_size.
+
+    Returns:
+        float: Frames per second
+    """
+    start = time.perf_counter()
+    for i in range(0, len(frames), batch_size):
+        batch = frames[i:i + batch_size]
+        results = model.predict(source=batch,
+                                conf=float(THRESHOLD),
+                                task='detect',
+                                batch=len(batch),
+                                device='cpu',
+                                verbose=False)
+        # Include the same postprocessing the service does
+        for result in results:
+            result.boxes.xyxy.tolist()
+            result.boxes.conf.tolist()
+            result.boxes.cls.tolist()
+    elapsed = time.perf_counter() - start
+    return len(frames) / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare YOLO frames/sec across batch sizes on CPU')
+    parser.add_argument('video', help='Path to a local video file')
+    parser.add_argument('--weights', default='yolov8n.pt')
+    parser.add_argument('--max-frames', type=int, default=160)
+    parser.add_argument('--batch-sizes',
+                        type=int,
+                        nargs='+',
+                        default=BATCH_SIZES)
+    args = parser.parse_args()
+
+    frames = load_frames(args.video, args.max_frames)
+    if not frames:
+        raise SystemExit(f"No frames could be read from {args.video}")
+
+    model = ultralytics.YOLO(args.weights)
+    # Warm up so model loading is not counted in the first measurement
+    run_batches(model, frames[:1], 1)
+
+    print(f"Frames: {len(frames)}, shape: {frames[0].shape}")
+    print(f"{'batch':>6} {'frames/sec':>12}")
+    for batch_size in args.batch_sizes:
+        fps = run_batches(model, frames, batch_size)
+        print(f"{batch_size:>6} {fps:>12.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+# Content-addressed cache of detection results
+#
+# Entries are keyed by a SHA-256 of the segment bytes, the model weights,
+# the confidence threshold and every request option that changes the
+# output, so a re-run workflow or re-submitted footage is answered without
+# decoding or inferring. Swapping the weights changes the key, and /cache
+# can drop old entries explicitly.
+import hashlib
+import json
+import os
+import threading
+
+import object_store
+from checkpoint import file_digest
+
+# Cache backend: '' (disabled), 'disk', a gs://bucket/prefix URI or a
+# file:///dir URI for a directory shared by every process
+DETECTION_CACHE = os.environ.get('DETECTION_CACHE', '')
+DETECTION_CACHE_DIR = os.environ.get('DETECTION_CACHE_DIR',
+                                     '/tmp/detection-cache')
+# Size the disk cache is trimmed to, least recently used entries first
+DETECTION_CACHE_MAX_MB = int(os.environ.get('DETECTION_CACHE_MAX_MB', 512))
+# Bump to invalidate every entry without touching the weights
+DETECTION_CACHE_VERSION = os.environ.get('DETECTION_CACHE_VERSION', '1')
+
+
+class LocalDiskCache:
+    """
+    Entries stored as files in a directory, evicted least recently used
+    first once the directory grows past max_bytes.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            # Access time for LRU ordering
+            os.utime(path)
+            return data
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, data):
+        path = self._path(key)
+        temp_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(data)
+        os.replace(temp_path, path)
+        self._evict()
+
+    def _evict(self):
+        with self.lock:
+            entries = []
+            for name in os.listdir(self.directory):
+                if name.endswith('.tmp'):
+                    continue
+                try:
+                    stat = os.stat(self._path(name))
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+            total = sum(size for _, size, _ in entries)
+            for _, size, name in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(self._path(name))
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+    def clear(self):
+        removed = 0
+        for name in os.listdir(self.directory):
+            try:
+                os.remove(self._path(name))
+                removed += 1
+            except FileNotFoundError:
+                pass
+        return removed
+
+
+class ObjectStoreCache:
+    """
+    Entries stored as objects under a bucket prefix, shared by every
+    replica. Expiry is left to the bucket's lifecycle rules.
+    """
+
+    def __init__(self, uri):
+        scheme, _, path = uri.partition('://')
+        if scheme == 'file':
+            # The whole path is the bucket directory
+            self.bucket_name, self.prefix = uri, 'detections'
+        else:
+            bucket, _, prefix = path.partition('/')
+            self.bucket_name = f'{scheme}://{bucket}'
+            self.prefix = prefix.rstrip('/')
+
+    def _object_name(self, key):
+        return f'{self.prefix}/{key}'
+
+    def get(self, key):
+        try:
+            return object_store.read_bytes(self.bucket_name,
+                                           self._object_name(key))
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, data):
+        object_store.write_bytes(self.bucket_name, self._object_name(key),
+                                 data)
+
+    def clear(self):
+        object_names = object_store.list_objects(self.bucket_name,
+                                                 f'{self.prefix}/')
+        for object_name in object_names:
+            object_store.delete(self.bucket_name, object_name)
+        return len(object_names)
+
+
+class DetectionCache:
+    """
+    Maps (segment bytes, model, threshold, options) to stored results and
+    counts hits and misses.
+    """
+
+    def __init__(self, backend, model_digest, threshold):
+        self.backend = backend
+        self.model_digest = model_digest
+        self.threshold = threshold
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, video_path, options):
+        """
+        Cache key of a segment file for the given request options.
+        """
+        digest = hashlib.sha256()
+        digest.update(file_digest(video_path).encode())
+        digest.update(self.model_digest.encode())
+        digest.update(json.dumps(
+            {
+                'threshold': self.threshold,
+                'version': DETECTION_CACHE_VERSION,
+                **options
+            },
+            sort_keys=True).encode())
+        return digest.hexdigest()
+
+    def get(self, key):
+        data = self.backend.get(key)
+        with self.lock:
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return data
+
+    def put(self, key, data):
+        self.backend.put(key, data)
+
+    def clear(self):
+        return self.backend.clear()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'backend': type(self.backend).__name__,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0
+            }
+
+
+def open_detection_cache(model_path, threshold):
+    """
+    Build the cache selected by DETECTION_CACHE, or None when disabled.
+    """
+    if not DETECTION_CACHE:
+        return None
+    if os.path.exists(model_path):
+        model_digest = file_digest(model_path)
+    else:
+        model_digest = model_path
+    if '://' in DETECTION_CACHE:
+        backend = ObjectStoreCache(DETECTION_CACHE)
+    else:
+        backend = LocalDiskCache(DETECTION_CACHE_DIR,
+                                 DETECTION_CACHE_MAX_MB * 1024 * 1024)
+    return DetectionCache(backend, model_digest, threshold)
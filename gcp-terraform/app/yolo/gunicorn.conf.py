@@ -0,0 +1,34 @@
+# Production serving config for the YOLO service:
+#   gunicorn -c gunicorn.conf.py yolov8_service:app
+#
+# Each worker process loads its own model and runs one inference scheduler
+# that batches frames across the requests its threads are handling, so
+# more threads per worker means more cross-request batching.
+import os
+import shutil
+import tempfile
+
+from prometheus_client import multiprocess
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+workers = int(os.environ.get('GUNICORN_WORKERS', 1))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+# A request covers a whole chunk, including download and inference
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 600))
+
+# Workers write their metrics to files here and /metrics aggregates them;
+# set before the workers import prometheus_client
+metrics_dir = os.environ.setdefault(
+    'PROMETHEUS_MULTIPROC_DIR',
+    os.path.join(tempfile.gettempdir(), 'yolo-metrics'))
+
+
+def on_starting(server):
+    # Files of a previous server would be aggregated too
+    shutil.rmtree(metrics_dir, ignore_errors=True)
+    os.makedirs(metrics_dir)
+
+
+def child_exit(server, worker):
+    multiprocess.mark_process_dead(worker.pid)
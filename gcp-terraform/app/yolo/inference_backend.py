@@ -0,0 +1,233 @@
+# Selectable inference backends for the YOLO service
+#
+# 'pytorch' runs the .pt weights as before. 'onnx' (ONNX Runtime) and
+# 'openvino' run an export of the same weights through ultralytics'
+# AutoBackend, so model.predict() still returns ultralytics Results and the
+# per-frame result dicts do not change. With INFERENCE_INT8 the export is
+# post-training quantized, calibrated on frames sampled from our footage.
+#
+# Exports are created on first use and kept in MODEL_EXPORT_DIR; run
+#   python inference_backend.py onnx --int8 --calibration-video sample.mp4
+# at image build time to avoid exporting on startup.
+import argparse
+import glob
+import os
+import shutil
+
+import cv2
+import numpy as np
+import ultralytics
+
+# Inference backend: 'pytorch', 'onnx' or 'openvino'
+INFERENCE_BACKEND = os.environ.get('INFERENCE_BACKEND', 'pytorch')
+# Use the INT8-quantized export of the selected backend
+INFERENCE_INT8 = os.environ.get('INFERENCE_INT8', 'false').lower() in ('1',
+                                                                      'true')
+MODEL_EXPORT_DIR = os.environ.get('MODEL_EXPORT_DIR', 'exported_models')
+# Directory of sample frames used to calibrate INT8 quantization
+INT8_CALIBRATION_DIR = os.environ.get('INT8_CALIBRATION_DIR',
+                                      'calibration_frames')
+INT8_CALIBRATION_FRAMES = int(os.environ.get('INT8_CALIBRATION_FRAMES', 300))
+# Input size of exported models
+EXPORT_IMGSZ = int(os.environ.get('EXPORT_IMGSZ', 640))
+
+BACKENDS = ('pytorch', 'onnx', 'openvino')
+LETTERBOX_COLOR = (114, 114, 114)
+
+
+def sample_calibration_frames(video_paths,
+                              output_dir=INT8_CALIBRATION_DIR,
+                              frame_count=INT8_CALIBRATION_FRAMES):
+    """
+    Save frames spread evenly over the given videos as calibration images.
+
+    Returns:
+        list: Paths of the written images
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    per_video = max(1, frame_count // max(1, len(video_paths)))
+    image_paths = []
+    for video_index, video_path in enumerate(video_paths):
+        cap = cv2.VideoCapture(video_path)
+        total = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        step = max(1, total // per_video)
+        for frame_index in range(0, max(total, 1), step)[:per_video]:
+            cap.set(cv2.CAP_PROP_POS_FRAMES, frame_index)
+            ret, frame = cap.read()
+            if not ret:
+                break
+            image_path = os.path.join(
+                output_dir, f'calib_{video_index:03d}_{frame_index:06d}.jpg')
+            cv2.imwrite(image_path, frame)
+            image_paths.append(image_path)
+        cap.release()
+    return image_paths
+
+
+def calibration_images(calibration_dir=INT8_CALIBRATION_DIR):
+    image_paths = sorted(
+        glob.glob(os.path.join(calibration_dir, '*.jpg')) +
+        glob.glob(os.path.join(calibration_dir, '*.png')))
+    if not image_paths:
+        raise ValueError(
+            f"INT8 calibration needs sample frames in {calibration_dir}")
+    return image_paths
+
+
+def letterbox(image, imgsz=EXPORT_IMGSZ):
+    """
+    Preprocess a BGR frame the way ultralytics does before inference:
+    resize keeping the aspect ratio, pad to imgsz x imgsz, RGB, CHW, 0-1.
+    """
+    height, width = image.shape[:2]
+    scale = min(imgsz / height, imgsz / width)
+    resized = cv2.resize(image, (round(width * scale), round(height * scale)),
+                         interpolation=cv2.INTER_LINEAR)
+    top = (imgsz - resized.shape[0]) // 2
+    left = (imgsz - resized.shape[1]) // 2
+    padded = cv2.copyMakeBorder(resized,
+                                top,
+                                imgsz - resized.shape[0] - top,
+                                left,
+                                imgsz - resized.shape[1] - left,
+                                cv2.BORDER_CONSTANT,
+                                value=LETTERBOX_COLOR)
+    tensor = padded[:, :, ::-1].transpose(2, 0, 1).astype(np.float32) / 255
+    return np.ascontiguousarray(tensor[np.newaxis])
+
+
+def exported_model_path(weights, backend, int8):
+    stem = os.path.splitext(os.path.basename(weights))[0]
+    if int8:
+        stem += '_int8'
+    if backend == 'onnx':
+        return os.path.join(MODEL_EXPORT_DIR, f'{stem}.onnx')
+    # AutoBackend recognises OpenVINO models by the directory suffix
+    return os.path.join(MODEL_EXPORT_DIR, f'{stem}_openvino_model')
+
+
+def quantize_onnx(model_path, output_path, calibration_dir):
+    """
+    Statically quantize an ONNX model to INT8 (QDQ), calibrated on the
+    frames in calibration_dir, keeping the ultralytics metadata.
+    """
+    import onnx
+    from onnxruntime.quantization import (CalibrationDataReader, QuantFormat,
+                                          QuantType, quantize_static)
+
+    model = onnx.load(model_path)
+    input_name = model.graph.input[0].name
+    image_paths = calibration_images(calibration_dir)
+
+    class FrameReader(CalibrationDataReader):
+
+        def __init__(self):
+            self.paths = iter(image_paths)
+
+        def get_next(self):
+            path = next(self.paths, None)
+            if path is None:
+                return None
+            return {input_name: letterbox(cv2.imread(path))}
+
+    quantize_static(model_path,
+                    output_path,
+                    FrameReader(),
+                    quant_format=QuantFormat.QDQ,
+                    activation_type=QuantType.QUInt8,
+                    weight_type=QuantType.QInt8)
+
+    # Class names, stride and imgsz live in the metadata AutoBackend reads
+    quantized = onnx.load(output_path)
+    del quantized.metadata_props[:]
+    quantized.metadata_props.extend(model.metadata_props)
+    onnx.save(quantized, output_path)
+
+
+def export_model(weights, backend, int8, calibration_dir=INT8_CALIBRATION_DIR):
+    """
+    Export weights for an ONNX Runtime or OpenVINO backend.
+
+    Returns:
+        str: Path of the exported model
+    """
+    output_path = exported_model_path(weights, backend, int8)
+    os.makedirs(MODEL_EXPORT_DIR, exist_ok=True)
+    model = ultralytics.YOLO(weights)
+
+    if backend == 'onnx':
+        # Dynamic axes so the service can send batches of YOLO_BATCH_SIZE
+        exported = model.export(format='onnx',
+                                imgsz=EXPORT_IMGSZ,
+                                dynamic=True)
+        if int8:
+            quantize_onnx(exported, output_path, calibration_dir)
+            os.remove(exported)
+        else:
+            shutil.move(exported, output_path)
+        return output_path
+
+    export_args = {'format': 'openvino', 'imgsz': EXPORT_IMGSZ, 'dynamic': True}
+    if int8:
+        # ultralytics calibrates OpenVINO INT8 with NNCF on a dataset yaml
+        calibration_yaml = os.path.join(MODEL_EXPORT_DIR, 'calibration.yaml')
+        calibration_images(calibration_dir)
+        with open(calibration_yaml, 'w') as f:
+            f.write(f"path: {os.path.abspath(calibration_dir)}\n"
+                    "train: .\nval: .\nnames:\n")
+            for class_id, name in model.names.items():
+                f.write(f"  {class_id}: {name}\n")
+        export_args.update(int8=True, data=calibration_yaml)
+    exported = model.export(**export_args)
+    if os.path.exists(output_path):
+        shutil.rmtree(output_path)
+    shutil.move(exported, output_path)
+    return output_path
+
+
+def load_model(weights,
+               backend=INFERENCE_BACKEND,
+               int8=INFERENCE_INT8,
+               calibration_dir=INT8_CALIBRATION_DIR):
+    """
+    Load the detection model for a backend, exporting it first if needed.
+
+    Returns:
+        tuple: (ultralytics.YOLO, path of the weights or export in use)
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown inference backend {backend!r}, expected "
+                         f"one of {', '.join(BACKENDS)}")
+    if backend == 'pytorch':
+        return ultralytics.YOLO(weights), weights
+    model_path = exported_model_path(weights, backend, int8)
+    if not os.path.exists(model_path):
+        print(f"Exporting {weights} for {backend}"
+              f"{' (INT8)' if int8 else ''} to {model_path}")
+        model_path = export_model(weights, backend, int8, calibration_dir)
+    return ultralytics.YOLO(model_path, task='detect'), model_path
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Export YOLO weights for an inference backend')
+    parser.add_argument('backend', choices=BACKENDS[1:])
+    parser.add_argument('--weights', default='yolov8n.pt')
+    parser.add_argument('--int8', action='store_true')
+    parser.add_argument('--calibration-video',
+                        nargs='*',
+                        default=[],
+                        help='Videos to sample INT8 calibration frames from')
+    parser.add_argument('--calibration-dir', default=INT8_CALIBRATION_DIR)
+    args = parser.parse_args()
+
+    if args.calibration_video:
+        image_paths = sample_calibration_frames(args.calibration_video,
+                                                args.calibration_dir)
+        print(f"Sampled {len(image_paths)} calibration frames")
+    print(export_model(args.weights, args.backend, args.int8,
+                       args.calibration_dir))
+
+
+if __name__ == '__main__':
+    main()
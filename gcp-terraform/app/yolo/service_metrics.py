@@ -0,0 +1,68 @@
+# Prometheus metrics of the YOLO service, served on /metrics
+#
+# Under gunicorn every worker process records into its own files in
+# PROMETHEUS_MULTIPROC_DIR (set up by gunicorn.conf.py) and /metrics
+# aggregates them, so a scrape sees the whole pod whichever worker answers.
+import os
+
+from prometheus_client import (CONTENT_TYPE_LATEST, CollectorRegistry,
+                               Counter, Gauge, Histogram, generate_latest,
+                               multiprocess)
+
+# Per-frame stage latencies range from sub-millisecond decodes to
+# CPU inference of a large frame
+FRAME_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                 0.5, 1.0, 2.5)
+# A request covers a whole chunk, including download and inference
+REQUEST_BUCKETS = (0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600)
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+
+frame_stage_seconds = Histogram(
+    'yolo_frame_stage_seconds',
+    'Seconds spent on one frame by each detection pipeline stage',
+    ['stage'],
+    buckets=FRAME_BUCKETS)
+frames_total = Counter('yolo_frames_total',
+                       'Frames handled by the detection pipeline',
+                       ['result'])
+inference_batch_frames = Histogram('yolo_inference_batch_frames',
+                                   'Frames per model predict call',
+                                   buckets=BATCH_BUCKETS)
+request_seconds = Histogram('yolo_request_seconds',
+                            'Latency of /detect requests, streaming included',
+                            ['status'],
+                            buckets=REQUEST_BUCKETS)
+requests_in_flight = Gauge('yolo_requests_in_flight',
+                           '/detect requests being handled',
+                           multiprocess_mode='livesum')
+frames_per_second = Gauge(
+    'yolo_frames_per_second',
+    'Frames per second of the most recent detection pipeline run',
+    multiprocess_mode='mostrecent')
+
+
+def observe_frames(stage, seconds, frame_count):
+    """
+    Record a stage's time over frame_count frames as frame_count
+    observations of the per-frame average.
+    """
+    if frame_count <= 0:
+        return
+    per_frame = seconds / frame_count
+    histogram = frame_stage_seconds.labels(stage=stage)
+    for _ in range(frame_count):
+        histogram.observe(per_frame)
+
+
+def render():
+    """
+    Current metrics in the Prometheus text format.
+
+    Returns:
+        tuple: Response body and content type
+    """
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -0,0 +1,160 @@
+# Columnar binary wire format for detection results
+#
+# A msgpack map holding one struct-of-arrays per chunk instead of one JSON
+# dict per frame. Every array is a raw little-endian NumPy buffer:
+#
+#   format          "columnar-v1"
+#   request_id      str
+#   fps             int
+#   shape           "height,width,channels" of the frames
+#   frame_count     number of frames in the chunk
+#   frame_skipped   uint8[frame_count], 1 where the detector skipped a frame
+#   frame_id        int32[n], frame of each detection
+#   box             float32[n * 4], x1, y1, x2, y2 of each detection
+#   confidence      float32[n]
+#   class_id        int16[n]
+#   class_names     {class_id: class_name} for the ids present
+#
+# The payload may be compressed as a whole with gzip or zstd; the response
+# media type carries the compression as a parameter so HTTP clients do not
+# try to decode it transparently.
+import gzip
+
+import msgpack
+import numpy as np
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COLUMNAR_MEDIA_TYPE = 'application/x-detections+msgpack'
+FORMAT_VERSION = 'columnar-v1'
+
+
+def negotiate(accept_header):
+    """
+    Pick the response format from an Accept header.
+
+    Returns:
+        tuple: (columnar, compression) where compression is None, 'gzip' or
+        'zstd'
+    """
+    for media_range in (accept_header or '').split(','):
+        parts = [part.strip() for part in media_range.split(';')]
+        if parts[0] != COLUMNAR_MEDIA_TYPE:
+            continue
+        params = dict(
+            part.split('=', 1) for part in parts[1:] if '=' in part)
+        compression = params.get('compression')
+        if compression == 'zstd' and zstandard is None:
+            compression = 'gzip'
+        if compression not in ('gzip', 'zstd'):
+            compression = None
+        return True, compression
+    return False, None
+
+
+def media_type(compression=None):
+    if compression:
+        return f'{COLUMNAR_MEDIA_TYPE}; compression={compression}'
+    return COLUMNAR_MEDIA_TYPE
+
+
+def compress(payload, compression):
+    if compression == 'zstd':
+        return zstandard.ZstdCompressor().compress(payload)
+    if compression == 'gzip':
+        return gzip.compress(payload, compresslevel=5)
+    return payload
+
+
+def with_request_id(payload, request_id):
+    """
+    Copy of an uncompressed columnar payload with a different request_id,
+    used when the same detections answer another request.
+    """
+    data = msgpack.unpackb(payload, raw=False, strict_map_key=False)
+    data['request_id'] = request_id
+    return msgpack.packb(data, use_bin_type=True)
+
+
+class ColumnarDetections:
+    """
+    Accumulates per-frame detections as column chunks and encodes them into
+    the columnar wire format.
+    """
+
+    def __init__(self, request_id, fps):
+        self.request_id = request_id
+        self.fps = fps
+        self.shape = None
+        self.frame_skipped = []
+        self.frame_ids = []
+        self.boxes = []
+        self.confidences = []
+        self.class_ids = []
+        self.class_names = {}
+        self._last = None
+
+    def __len__(self):
+        return len(self.frame_skipped)
+
+    def append_result(self, result, frame_id, frame_shape):
+        """
+        Add the detections of one ultralytics result.
+        """
+        if self.shape is None:
+            self.shape = ','.join(str(dim) for dim in frame_shape)
+        boxes = result.boxes.xyxy.cpu().numpy().astype(np.float32)
+        boxes = boxes.reshape(-1, 4)
+        confidences = result.boxes.conf.cpu().numpy().astype(np.float32)
+        class_ids = result.boxes.cls.cpu().numpy().astype(np.int16)
+        for class_id in np.unique(class_ids):
+            self.class_names[int(class_id)] = result.names[int(class_id)]
+        self._last = (boxes, confidences, class_ids)
+        self._append(frame_id, boxes, confidences, class_ids, skipped=False)
+
+    def append_skipped(self, frame_id):
+        """
+        Add a frame the detector skipped, reusing the last detections.
+        """
+        if self._last is None:
+            self._last = (np.empty((0, 4), np.float32),
+                          np.empty(0, np.float32), np.empty(0, np.int16))
+        self._append(frame_id, *self._last, skipped=True)
+
+    def _append(self, frame_id, boxes, confidences, class_ids, skipped):
+        self.frame_skipped.append(1 if skipped else 0)
+        self.frame_ids.append(np.full(len(boxes), frame_id, np.int32))
+        self.boxes.append(boxes)
+        self.confidences.append(confidences)
+        self.class_ids.append(class_ids)
+
+    def encode(self, compression=None):
+        """
+        Serialize to (optionally compressed) msgpack bytes.
+        """
+
+        def buffer(chunks, dtype):
+            if not chunks:
+                return b''
+            return np.concatenate(chunks).astype(dtype.newbyteorder('<'),
+                                                 copy=False).tobytes()
+
+        payload = msgpack.packb(
+            {
+                'format': FORMAT_VERSION,
+                'request_id': self.request_id,
+                'fps': self.fps,
+                'shape': self.shape,
+                'frame_count': len(self.frame_skipped),
+                'frame_skipped': bytes(self.frame_skipped),
+                'frame_id': buffer(self.frame_ids, np.dtype(np.int32)),
+                'box': buffer(self.boxes, np.dtype(np.float32)),
+                'confidence': buffer(self.confidences, np.dtype(np.float32)),
+                'class_id': buffer(self.class_ids, np.dtype(np.int16)),
+                'class_names': self.class_names
+            },
+            use_bin_type=True)
+        return compress(payload, compression)
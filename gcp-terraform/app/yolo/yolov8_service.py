@@ -1,14 +1,568 @@
 import flask
-import ultralytics
 import cv2
+import gzip
+import json
 import os
-from google.cloud import storage
+import queue
+import tempfile
+import threading
+import time
+import detection_options
+import object_store
+from checkpoint import file_digest
+from overlap_capture import open_capture
+import service_metrics
+import video_range
+from batch_scheduler import InferenceScheduler
+from detection_cache import open_detection_cache
+from inference_backend import EXPORT_IMGSZ, INFERENCE_BACKEND, load_model
+from wire_format import (ColumnarDetections, compress, media_type, negotiate,
+                         with_request_id)
 
 app = flask.Flask(__name__)
-model = ultralytics.YOLO('yolov8n.pt')
+MODEL_WEIGHTS = 'yolov8n.pt'
+# PyTorch weights or their ONNX Runtime / OpenVINO export, see
+# inference_backend.py
+model, MODEL_PATH = load_model(MODEL_WEIGHTS)
 THRESHOLD = '0.5'
+# Number of frames passed to a single model.predict call
+YOLO_BATCH_SIZE = int(os.environ.get('YOLO_BATCH_SIZE', 1))
+# Max number of batches buffered between pipeline stages
+PIPELINE_QUEUE_SIZE = int(os.environ.get('PIPELINE_QUEUE_SIZE', 4))
+# Run the model on every Nth frame only (1 = every frame)
+DETECT_STRIDE = int(os.environ.get('DETECT_STRIDE', 1))
+# Skip inference when the mean grey-level difference to the last inferred
+# frame is below this value (0 = motion gating disabled)
+MOTION_THRESHOLD = float(os.environ.get('MOTION_THRESHOLD', 0))
+# Width frames are downscaled to before computing the motion score
+MOTION_SAMPLE_WIDTH = 64
+# Defaults of the per-request detection options, see detection_options.py:
+# inference size (0 = model default), comma-separated class allow-list and
+# JSON list of regions of interest
+DETECT_IMGSZ = os.environ.get('DETECT_IMGSZ', '0')
+DETECT_CLASSES = os.environ.get('DETECT_CLASSES', '')
+DETECT_ROI = os.environ.get('DETECT_ROI', '')
+# Most frames, across all concurrent requests, in one model.predict call
+SCHEDULER_MAX_BATCH = int(
+    os.environ.get('SCHEDULER_MAX_BATCH', max(16, YOLO_BATCH_SIZE)))
+# Longest a request's frames wait for other requests to fill a batch
+SCHEDULER_MAX_LATENCY_MS = float(
+    os.environ.get('SCHEDULER_MAX_LATENCY_MS', 10))
+# Directory for per-request copies of the input video
+TEMP_DIR = os.environ.get('TEMP_DIR', tempfile.gettempdir())
 
-storage_client = storage.Client()
+NDJSON_MEDIA_TYPE = 'application/x-ndjson'
+
+# Marks the end of a pipeline stage's output
+_END_OF_STREAM = object()
+
+detection_cache = open_detection_cache(MODEL_PATH, THRESHOLD)
+
+
+def run_model(frames, imgsz=None, classes=None):
+    service_metrics.inference_batch_frames.observe(len(frames))
+    predict_args = {}
+    if imgsz:
+        predict_args['imgsz'] = imgsz
+    if classes is not None:
+        predict_args['classes'] = classes
+    return list(
+        model.predict(source=frames,
+                      conf=float(THRESHOLD),
+                      task='detect',
+                      batch=len(frames),
+                      verbose=False,
+                      **predict_args))
+
+
+# Shared by every request handled by this process
+inference_scheduler = InferenceScheduler(run_model, SCHEDULER_MAX_BATCH,
+                                         SCHEDULER_MAX_LATENCY_MS / 1000)
+
+
+def build_frame_result(result, request_id, frame_id, fps, frame_shape):
+    """
+    Convert a single ultralytics result into the per-frame result dict.
+    """
+    height, width, channels = frame_shape
+    boxes = result.boxes.xyxy.tolist()
+    confidences = result.boxes.conf.tolist()
+    class_ids = result.boxes.cls.tolist()
+    class_names = [result.names[int(id)] for id in class_ids]
+
+    return {
+        "request_id": request_id,
+        "frame_id": frame_id,
+        "timestamp": frame_id / fps,
+        'shape': f"{height},{width},{channels}",
+        'box': boxes,
+        'confidence': confidences,
+        'class_id': class_ids,
+        'class_name': class_names
+    }
+
+
+def parse_detection_options(request_data):
+    """
+    Per-request model options and regions of interest, falling back to the
+    service defaults.
+
+    Returns:
+        tuple: (options passed to run_model, parsed regions or None)
+
+    Raises:
+        ValueError: If an option is invalid
+    """
+    imgsz = detection_options.parse_imgsz(
+        request_data.get('imgsz', DETECT_IMGSZ))
+    # Exported models have a fixed input size
+    if imgsz and INFERENCE_BACKEND != 'pytorch' and imgsz != EXPORT_IMGSZ:
+        raise ValueError(f"imgsz must be {EXPORT_IMGSZ} with the "
+                         f"{INFERENCE_BACKEND} backend")
+    classes = detection_options.parse_classes(
+        request_data.get('classes', DETECT_CLASSES), model.names)
+    regions = detection_options.parse_regions(
+        request_data.get('roi', DETECT_ROI))
+    return {'imgsz': imgsz, 'classes': classes}, regions
+
+
+class PipelineError(Exception):
+    """Raised by a pipeline stage; the message is returned to the caller."""
+
+
+def _put(stage_queue, item, stop_event):
+    """
+    Put an item on a bounded queue, giving up if another stage has failed.
+    """
+    while not stop_event.is_set():
+        try:
+            stage_queue.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _get(stage_queue, stop_event):
+    """
+    Get an item from a queue, returning _END_OF_STREAM if another stage has
+    failed.
+    """
+    while not stop_event.is_set():
+        try:
+            return stage_queue.get(timeout=0.1)
+        except queue.Empty:
+            continue
+    return _END_OF_STREAM
+
+
+def motion_sample(frame):
+    """
+    Downscaled greyscale copy of a frame used for cheap motion scoring.
+    """
+    height, width = frame.shape[:2]
+    sample_height = max(1, int(height * MOTION_SAMPLE_WIDTH / width))
+    grey = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+    return cv2.resize(grey, (MOTION_SAMPLE_WIDTH, sample_height),
+                      interpolation=cv2.INTER_AREA)
+
+
+def motion_score(sample, reference_sample):
+    """
+    Mean absolute grey-level difference between two motion samples.
+    """
+    return float(cv2.absdiff(sample, reference_sample).mean())
+
+
+def decode_stage(cap, frame_queue, stop_event, errors, stride,
+                 motion_threshold, region_crop):
+    """
+    Read frames from the capture and queue them in batches of up to
+    YOLO_BATCH_SIZE frames to infer.
+
+    Each batch is a list of (frame_id, shape, frame) entries, where shape is
+    the full frame's and frame is cropped to the regions of interest when
+    region_crop is set. Frames that are skipped by the stride or motion gate
+    are queued with frame set to None so the later stages can keep the
+    output in frame order.
+    """
+    try:
+        frame_count = 0
+        batch = []
+        batch_inferred = 0
+        reference_sample = None
+        while cap.isOpened() and not stop_event.is_set():
+            start = time.perf_counter()
+            ret, frame = cap.read()
+            if not ret:
+                break
+            shape = frame.shape
+            if region_crop is not None:
+                # Motion outside the regions does not wake the detector
+                frame = region_crop.apply(frame)
+
+            infer = frame_count % stride == 0
+            if infer and motion_threshold > 0:
+                sample = motion_sample(frame)
+                if (reference_sample is not None and
+                        motion_score(sample, reference_sample) <
+                        motion_threshold):
+                    infer = False
+                else:
+                    reference_sample = sample
+
+            batch.append((frame_count, shape, frame if infer else None))
+            service_metrics.frame_stage_seconds.labels(stage='decode').observe(
+                time.perf_counter() - start)
+            frame_count += 1
+            if infer:
+                batch_inferred += 1
+            if batch_inferred < YOLO_BATCH_SIZE:
+                continue
+
+            if not _put(frame_queue, batch, stop_event):
+                return
+            batch = []
+            batch_inferred = 0
+
+        # Flush the last, partially filled batch
+        if batch:
+            if not _put(frame_queue, batch, stop_event):
+                return
+        _put(frame_queue, _END_OF_STREAM, stop_event)
+    except Exception as e:
+        errors.append(f'Error processing video: {str(e)}')
+        stop_event.set()
+    finally:
+        cap.release()
+
+
+def inference_stage(frame_queue, result_queue, stop_event, errors, stats,
+                    predict_options, region_crop):
+    """
+    Run model inference on the frames of each queued batch that were not
+    skipped, batched with other requests' frames by the inference scheduler,
+    and map boxes on cropped frames back to full-frame coordinates.
+    """
+    try:
+        while True:
+            batch = _get(frame_queue, stop_event)
+            if batch is _END_OF_STREAM:
+                break
+            frames = [frame for _, _, frame in batch if frame is not None]
+            batch_results = []
+            if frames:
+                start = time.perf_counter()
+                batch_results = inference_scheduler.infer(
+                    frames, **predict_options)
+                elapsed = time.perf_counter() - start
+                if region_crop is not None:
+                    for result in batch_results:
+                        detection_options.shift_boxes(result,
+                                                      region_crop.offset)
+                stats['inference_seconds'] += elapsed
+                stats['frames_inferred'] += len(frames)
+                # Includes the wait for other requests' frames to batch with
+                service_metrics.observe_frames('inference', elapsed,
+                                               len(frames))
+                service_metrics.frames_total.labels(result='inferred').inc(
+                    len(frames))
+            stats['frames_skipped'] += len(batch) - len(frames)
+            service_metrics.frames_total.labels(result='skipped').inc(
+                len(batch) - len(frames))
+            # Drop the decoded frames so only shapes travel further
+            entries = [(frame_id, shape, frame is None)
+                       for frame_id, shape, frame in batch]
+            if not _put(result_queue, (entries, batch_results), stop_event):
+                return
+        _put(result_queue, _END_OF_STREAM, stop_event)
+    except Exception as e:
+        errors.append(f'Model inference failed: {str(e)}')
+        stop_event.set()
+
+
+def postprocess_stage(result_queue, request_id, fps, detection_results,
+                      stop_event, errors):
+    """
+    Convert each batch of model results into per-frame result dicts.
+
+    Skipped frames reuse the detections of the last inferred frame and are
+    marked with 'skipped': True. When detection_results is a
+    ColumnarDetections the results are appended as arrays instead.
+    """
+    try:
+        columnar = isinstance(detection_results, ColumnarDetections)
+        last_result = None
+        while True:
+            item = _get(result_queue, stop_event)
+            if item is _END_OF_STREAM:
+                break
+            entries, batch_results = item
+            start = time.perf_counter()
+            results = iter(batch_results)
+            for frame_id, shape, skipped in entries:
+                if columnar and skipped:
+                    detection_results.append_skipped(frame_id)
+                    continue
+                if columnar:
+                    detection_results.append_result(next(results), frame_id,
+                                                    shape)
+                    continue
+
+                if skipped and last_result is not None:
+                    frame_result = dict(last_result,
+                                        frame_id=frame_id,
+                                        timestamp=frame_id / fps,
+                                        skipped=True)
+                elif skipped:
+                    height, width, channels = shape
+                    frame_result = {
+                        "request_id": request_id,
+                        "frame_id": frame_id,
+                        "timestamp": frame_id / fps,
+                        'shape': f"{height},{width},{channels}",
+                        'box': [],
+                        'confidence': [],
+                        'class_id': [],
+                        'class_name': [],
+                        'skipped': True
+                    }
+                else:
+                    frame_result = build_frame_result(next(results),
+                                                      request_id, frame_id,
+                                                      fps, shape)
+                    last_result = frame_result
+                detection_results.append(frame_result)
+            # A streaming sink's append also waits for the client
+            service_metrics.observe_frames('postprocess',
+                                           time.perf_counter() - start,
+                                           len(entries))
+    except Exception as e:
+        errors.append(f'Error processing detection results: {str(e)}')
+        stop_event.set()
+
+
+def run_detection_pipeline(video_path,
+                           request_id,
+                           stride=DETECT_STRIDE,
+                           motion_threshold=MOTION_THRESHOLD,
+                           columnar=False,
+                           sink=None,
+                           stop_event=None,
+                           predict_options=None,
+                           regions=None,
+                           overlap=None):
+    """
+    Detect objects in a video with decode, inference and postprocess running
+    as concurrent stages connected by bounded queues.
+
+    Args:
+        video_path (str): Local path of the video chunk
+        request_id (str): Request ID copied into every result
+        stride (int): Only run the model on every Nth frame
+        motion_threshold (float): Skip frames whose motion score against
+            the last inferred frame is below this value (0 disables)
+        columnar (bool): Collect results as a ColumnarDetections instead of
+            a list of per-frame dicts
+        sink: Object with an append method that receives each frame result
+            as soon as it is ready, used instead of building a list
+        stop_event (threading.Event): Lets the caller cancel the pipeline
+        predict_options (dict): Options passed to run_model (imgsz,
+            classes)
+        regions (list): Regions of interest the model is limited to, see
+            detection_options.parse_regions
+        overlap (tuple): (local path of the next chunk, frames) whose first
+            frames are detected after the chunk's own, or None
+
+    Returns:
+        tuple: Per-frame detection results and a dict of inference stats
+
+    Raises:
+        PipelineError: If any stage fails
+    """
+    pipeline_start = time.perf_counter()
+    cap = open_capture(video_path, overlap)
+    fps = int(cap.get(cv2.CAP_PROP_FPS))
+    region_crop = None
+    if regions:
+        try:
+            region_crop = detection_options.RegionCrop(
+                regions, (int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+                          int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))))
+        except ValueError as e:
+            cap.release()
+            raise PipelineError(str(e))
+
+    frame_queue = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    result_queue = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE)
+    stop_event = stop_event or threading.Event()
+    errors = []
+    if sink is not None:
+        detection_results = sink
+    elif columnar:
+        detection_results = ColumnarDetections(request_id, fps)
+    else:
+        detection_results = []
+    stats = {
+        'frames_inferred': 0,
+        'frames_skipped': 0,
+        'inference_seconds': 0.0
+    }
+
+    stages = [
+        threading.Thread(target=decode_stage,
+                         args=(cap, frame_queue, stop_event, errors,
+                               max(1, stride), motion_threshold,
+                               region_crop)),
+        threading.Thread(target=inference_stage,
+                         args=(frame_queue, result_queue, stop_event, errors,
+                               stats, predict_options or {}, region_crop)),
+        threading.Thread(target=postprocess_stage,
+                         args=(result_queue, request_id, fps,
+                               detection_results, stop_event, errors)),
+    ]
+    for stage in stages:
+        stage.start()
+    for stage in stages:
+        stage.join()
+
+    if errors:
+        raise PipelineError(errors[0])
+
+    # Estimate the time saved from the average cost of an inferred frame
+    per_frame = stats['inference_seconds'] / max(1, stats['frames_inferred'])
+    stats['inference_seconds_saved'] = per_frame * stats['frames_skipped']
+    frame_count = stats['frames_inferred'] + stats['frames_skipped']
+    stats['frames_per_second'] = frame_count / max(
+        1e-9,
+        time.perf_counter() - pipeline_start)
+    service_metrics.frames_per_second.set(stats['frames_per_second'])
+    return detection_results, stats
+
+
+class ResultStream:
+    """
+    Bounded buffer between the detection pipeline and a streaming response.
+
+    The postprocess stage appends frame results while the response
+    generator iterates over them, so a slow client applies backpressure to
+    the whole pipeline.
+    """
+
+    def __init__(self):
+        self.queue = queue.Queue(maxsize=PIPELINE_QUEUE_SIZE *
+                                 max(1, YOLO_BATCH_SIZE))
+        self.stop_event = threading.Event()
+        self.done = threading.Event()
+        self.error = None
+        self.stats = None
+
+    def append(self, frame_result):
+        _put(self.queue, frame_result, self.stop_event)
+
+    def run(self, video_path, request_id, stride, motion_threshold,
+            predict_options, regions, overlap):
+        try:
+            _, self.stats = run_detection_pipeline(
+                video_path,
+                request_id,
+                stride,
+                motion_threshold,
+                sink=self,
+                stop_event=self.stop_event,
+                predict_options=predict_options,
+                regions=regions,
+                overlap=overlap)
+        except Exception as e:
+            self.error = str(e)
+        finally:
+            self.done.set()
+
+    def __iter__(self):
+        while True:
+            try:
+                yield self.queue.get(timeout=0.1)
+            except queue.Empty:
+                if self.done.is_set() and self.queue.empty():
+                    return
+
+
+def encode_cached_frames(frame_results):
+    return gzip.compress(
+        json.dumps(frame_results, separators=(',', ':')).encode())
+
+
+def decode_cached_frames(data, request_id):
+    frame_results = json.loads(gzip.decompress(data))
+    for frame_result in frame_results:
+        frame_result['request_id'] = request_id
+    return frame_results
+
+
+def cache_put(cache_key, data):
+    """
+    Store a cache entry; a failing cache never fails the request.
+    """
+    try:
+        detection_cache.put(cache_key, data)
+    except Exception as e:
+        print(f"Failed to store detection cache entry {cache_key}: {str(e)}")
+
+
+def stream_detections(video_path,
+                      request_id,
+                      stride,
+                      motion_threshold,
+                      cache_key=None,
+                      predict_options=None,
+                      regions=None,
+                      overlap=None):
+    """
+    Run detection in the background and return a generator of NDJSON lines,
+    one per frame, in frame order.
+
+    Headers are already sent when a stage fails, so errors are reported as a
+    final {"error": ...} line. With a cache_key, the results of a completed
+    stream are stored in the detection cache.
+    """
+    stream = ResultStream()
+    worker = threading.Thread(target=stream.run,
+                              args=(video_path, request_id, stride,
+                                    motion_threshold, predict_options,
+                                    regions, overlap))
+    worker.start()
+
+    def generate():
+        frame_results = []
+        try:
+            for frame_result in stream:
+                if cache_key:
+                    frame_results.append(frame_result)
+                yield json.dumps(frame_result) + '\n'
+            if stream.error:
+                yield json.dumps({'error': stream.error}) + '\n'
+            elif stream.stats:
+                if cache_key:
+                    cache_put(cache_key, encode_cached_frames(frame_results))
+                print(f"Request {request_id}: streamed "
+                      f"{stream.stats['frames_inferred']} inferred frames, "
+                      f"skipped {stream.stats['frames_skipped']}")
+        finally:
+            # Also runs when the client disconnects mid-stream
+            stream.stop_event.set()
+            worker.join()
+            remove_temp_videos(video_path, overlap)
+
+    return generate()
+
+
+def remove_temp_videos(video_path, overlap=None):
+    """
+    Remove a request's temporary chunk and next chunk, if any.
+    """
+    for path in (video_path, overlap[0] if overlap else None):
+        if path and os.path.exists(path):
+            os.remove(path)
 
 
 @app.route('/')
@@ -16,6 +570,79 @@ def home():
     return "YOLOv8 service is running", 200
 
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    body, content_type = service_metrics.render()
+    return flask.Response(body, mimetype=content_type)
+
+
+@app.before_request
+def start_request_timer():
+    if flask.request.endpoint == 'detect':
+        flask.g.request_start = time.perf_counter()
+        service_metrics.requests_in_flight.inc()
+
+
+@app.after_request
+def observe_request(response):
+    start = flask.g.pop('request_start', None)
+    if start is None:
+        return response
+    status = str(response.status_code)
+
+    # Streaming responses are still being produced here, so the request
+    # ends when the server closes the response
+    def request_closed():
+        service_metrics.requests_in_flight.dec()
+        service_metrics.request_seconds.labels(status=status).observe(
+            time.perf_counter() - start)
+
+    response.call_on_close(request_closed)
+    return response
+
+
+def cached_response(data, request_id, streaming, columnar, compression):
+    """
+    Build the /detect response for a detection cache hit.
+    """
+    if streaming:
+        frame_results = decode_cached_frames(data, request_id)
+        response = flask.Response(
+            (json.dumps(frame_result) + '\n' for frame_result in frame_results),
+            mimetype=NDJSON_MEDIA_TYPE)
+    elif columnar:
+        response = flask.Response(compress(with_request_id(data, request_id),
+                                           compression),
+                                  mimetype=media_type(compression))
+    else:
+        response = flask.jsonify(decode_cached_frames(data, request_id))
+    response.headers['X-Detection-Cache'] = 'hit'
+    response.headers['X-Frames-Inferred'] = '0'
+    return response
+
+
+@app.route('/cache', methods=['GET'])
+def cache_stats():
+    if detection_cache is None:
+        return flask.jsonify({'enabled': False}), 200
+    return flask.jsonify({'enabled': True, **detection_cache.stats()}), 200
+
+
+@app.route('/cache', methods=['DELETE'])
+def invalidate_cache():
+    """
+    Drop every cached result, e.g. after swapping the model.
+    """
+    if detection_cache is None:
+        return flask.jsonify({'enabled': False, 'removed': 0}), 200
+    try:
+        removed = detection_cache.clear()
+    except Exception as e:
+        return flask.jsonify(
+            {'error': f'Failed to invalidate detection cache: {str(e)}'}), 500
+    return flask.jsonify({'enabled': True, 'removed': removed}), 200
+
+
 @app.route('/detect', methods=['POST'])
 def detect():
     try:
@@ -31,91 +658,137 @@ def detect():
         bucket_name = request_data.get('bucket_name')
         object_name = request_data.get('object_name')
         request_id = request_data.get('request_id')
-        temp_input_video = '/tmp/input.mp4'
+        try:
+            stride = int(request_data.get('detect_stride', DETECT_STRIDE))
+            if stride < 1:
+                raise ValueError(f'detect_stride must be at least 1, '
+                                 f'got {stride}')
+            motion_threshold = float(
+                request_data.get('motion_threshold', MOTION_THRESHOLD))
+            predict_options, regions = parse_detection_options(request_data)
+        except (ValueError, TypeError) as e:
+            return flask.jsonify(
+                {'error': f'Invalid detection options: {str(e)}'}), 400
+        # Each request gets its own copy so concurrent requests never share
+        # a file
+        fd, temp_input_video = tempfile.mkstemp(suffix='.mp4', dir=TEMP_DIR)
+        os.close(fd)
+        accept = flask.request.headers.get('Accept', '')
+        columnar, compression = negotiate(accept)
+        streaming = NDJSON_MEDIA_TYPE in accept
+
+        # With overlap, the first frames of the next chunk are detected
+        # after the chunk's own
+        overlap = None
+        if request_data.get('overlap'):
+            fd, temp_overlap_video = tempfile.mkstemp(suffix='.mp4',
+                                                      dir=TEMP_DIR)
+            os.close(fd)
+            overlap = (temp_overlap_video,
+                       int(request_data['overlap']['frames']))
 
-        # Download video from GCS
+        # Download video from GCS; a virtual segment (SPLIT_MODE=virtual)
+        # is extracted from its byte range of the original video
         try:
-            bucket = storage_client.bucket(bucket_name)
-            blob = bucket.blob(object_name)
-            blob.download_to_filename(temp_input_video)
+            segment = request_data.get('segment')
+            if segment and segment.get('source'):
+                video_range.extract_segment(segment, temp_input_video)
+            else:
+                object_store.download(bucket_name, object_name,
+                                      temp_input_video)
+            if overlap:
+                object_store.download(bucket_name,
+                                      request_data['overlap']['object_name'],
+                                      overlap[0])
             if not os.path.exists(temp_input_video):
+                remove_temp_videos(temp_input_video, overlap)
                 return flask.jsonify(
                     {'error': 'Failed to download video from GCS'}), 500
         except Exception as e:
+            remove_temp_videos(temp_input_video, overlap)
             return flask.jsonify(
                 {'error':
                  f'Failed to download video from GCS: {str(e)}.'}), 500
 
-        try:
-            # Process video
-            cap = cv2.VideoCapture(temp_input_video)
-
-            # Get video properties
-            width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
-            height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
-            fps = int(cap.get(cv2.CAP_PROP_FPS))
-
-            # Initialize list to store detection results
-            detection_results = []
-
-            frame_count = 0
-            while cap.isOpened():
-                ret, frame = cap.read()
-                if not ret:
-                    break
-
-                # Get the full shape of the frame
-                height, width, channels = frame.shape
-
-                # Model inference
-                try:
-                    detection_results_frame = model.predict(
-                        source=frame, conf=float(THRESHOLD), task='detect')
-                    # print(f"det_results****: {detection_results_frame}")
-                except Exception as e:
-                    return flask.jsonify(
-                        {'error': f'Model inference failed: {str(e)}'}), 500
-
-                # Process results
-                try:
-                    boxes = detection_results_frame[0].boxes.xyxy.tolist()
-                    confidences = detection_results_frame[0].boxes.conf.tolist(
-                    )
-                    class_ids = detection_results_frame[0].boxes.cls.tolist()
-                    class_names = [
-                        detection_results_frame[0].names[int(id)]
-                        for id in class_ids
-                    ]
-
-                    # Append detection results for current frame
-                    detection_results.append({
-                        "request_id": request_id,
-                        "frame_id": frame_count,
-                        "timestamp": frame_count / fps,
-                        'shape': f"{height},{width},{channels}",
-                        'box': boxes,
-                        'confidence': confidences,
-                        'class_id': class_ids,
-                        'class_name': class_names
+        # Answer repeated segments from the detection cache
+        cache_key = None
+        if detection_cache is not None:
+            try:
+                cache_key = detection_cache.key(
+                    temp_input_video, {
+                        'detect_stride': stride,
+                        'motion_threshold': motion_threshold,
+                        **predict_options,
+                        'roi': detection_options.regions_to_list(regions),
+                        'overlap': ([file_digest(overlap[0]), overlap[1]]
+                                    if overlap else None),
+                        'format': ('columnar' if columnar and not streaming
+                                   else 'frames')
                     })
-                except Exception as e:
-                    return flask.jsonify({
-                        'error':
-                        f'Error processing detection results: {str(e)}'
-                    }), 500
+                cached = detection_cache.get(cache_key)
+            except Exception as e:
+                print(f"Detection cache lookup failed: {str(e)}")
+                cached = None
+            if cached is not None:
+                print(f"Request {request_id}: detection cache hit")
+                remove_temp_videos(temp_input_video, overlap)
+                return cached_response(cached, request_id, streaming,
+                                       columnar, compression)
 
-                frame_count += 1
+        if streaming:
+            # The generator owns the temporary file from here on
+            frame_lines = stream_detections(temp_input_video, request_id,
+                                            stride, motion_threshold,
+                                            cache_key, predict_options,
+                                            regions, overlap)
+            response = flask.Response(frame_lines,
+                                      mimetype=NDJSON_MEDIA_TYPE)
+            if cache_key:
+                response.headers['X-Detection-Cache'] = 'miss'
+            return response
 
-            cap.release()
+        try:
+            # Process video
+            detection_results, stats = run_detection_pipeline(
+                temp_input_video,
+                request_id,
+                stride,
+                motion_threshold,
+                columnar,
+                predict_options=predict_options,
+                regions=regions,
+                overlap=overlap)
+        except PipelineError as e:
+            return flask.jsonify({'error': str(e)}), 500
         except Exception as e:
             return flask.jsonify(
                 {'error': f'Error processing video: {str(e)}'}), 500
         finally:
             # Clean up temporary files
-            if os.path.exists(temp_input_video):
-                os.remove(temp_input_video)
+            remove_temp_videos(temp_input_video, overlap)
 
-        return flask.jsonify(detection_results)
+        print(f"Request {request_id}: inferred {stats['frames_inferred']} "
+              f"frames, skipped {stats['frames_skipped']}, saved "
+              f"~{stats['inference_seconds_saved']:.2f}s of inference")
+        if columnar:
+            payload = detection_results.encode()
+            if cache_key:
+                cache_put(cache_key, payload)
+            response = flask.Response(compress(payload, compression),
+                                      mimetype=media_type(compression))
+        else:
+            if cache_key:
+                cache_put(cache_key, encode_cached_frames(detection_results))
+            response = flask.jsonify(detection_results)
+        if cache_key:
+            response.headers['X-Detection-Cache'] = 'miss'
+        response.headers['X-Frames-Inferred'] = str(stats['frames_inferred'])
+        response.headers['X-Frames-Skipped'] = str(stats['frames_skipped'])
+        response.headers['X-Inference-Seconds'] = (
+            f"{stats['inference_seconds']:.3f}")
+        response.headers['X-Inference-Seconds-Saved'] = (
+            f"{stats['inference_seconds_saved']:.3f}")
+        return response
 
     except Exception as e:
         return flask.jsonify(
@@ -143,10 +143,11 @@ resource "google_cloud_run_v2_job" "tracking_job" {
         containers {
           image = "${var.region}-docker.pkg.dev/${var.project_id}/tracking-job/tracking-job-image:latest"
 
+          # Fused mode runs the detection model inside the job
           resources {
             limits = {
-              cpu    = "1"
-              memory = "512Mi"
+              cpu    = var.tracking_pipeline_mode == "fused" ? "4" : "1"
+              memory = var.tracking_pipeline_mode == "fused" ? "4Gi" : "512Mi"
             }
           }
 
@@ -166,6 +167,10 @@ resource "google_cloud_run_v2_job" "tracking_job" {
             name  = "INPUT_BUCKET"
             value = google_storage_bucket.upload_bucket.name
           }
+          env {
+            name  = "PIPELINE_MODE"
+            value = var.tracking_pipeline_mode
+          }
         }
         vpc_access {
           network_interfaces {
@@ -25,6 +25,8 @@ resource "google_cloudfunctions2_function" "bigquery_upload" {
       PROJECT_ID      = var.project_id
       DATASET_ID      = google_bigquery_dataset.tracking_results.dataset_id
       TABLE_ID        = google_bigquery_table.tracking_results_table.table_id
+      BQ_LOAD_MODE    = var.bigquery_load_mode
+      LOAD_FILE_FORMAT = var.bigquery_load_file_format
     }
   }
 
@@ -36,6 +38,58 @@ resource "google_cloudfunctions2_function" "bigquery_upload" {
     ]
 }
 
+# Cloud Function - per-chunk BigQuery load on processed chunk upload
+resource "google_cloudfunctions2_function" "bigquery_chunk_loader" {
+  count       = var.bigquery_load_mode == "event" ? 1 : 0
+  name        = "bigquery-chunk-loader"
+  location    = var.region
+  description = "Function to load each processed chunk into BigQuery as it lands"
+
+  build_config {
+    runtime     = "python311"
+    entry_point = "load_chunk_to_bigquery"
+    source {
+      storage_source {
+        bucket = google_storage_bucket.bq_upload_function_bucket.name
+        object = google_storage_bucket_object.function_code.name
+      }
+    }
+  }
+
+  service_config {
+    max_instance_count = 1
+    available_memory   = "256M"
+    timeout_seconds    = 60
+    service_account_email = google_service_account.tracking_service_sa.email
+    environment_variables = {
+      GCS_BUCKET_NAME = google_storage_bucket.tracking_bucket.name
+      PROJECT_ID      = var.project_id
+      DATASET_ID      = google_bigquery_dataset.tracking_results.dataset_id
+      TABLE_ID        = google_bigquery_table.tracking_results_table.table_id
+      BQ_LOAD_MODE    = var.bigquery_load_mode
+      LOAD_FILE_FORMAT = var.bigquery_load_file_format
+    }
+  }
+
+  event_trigger {
+    event_type            = "google.cloud.storage.object.v1.finalized"
+    retry_policy          = "RETRY_POLICY_RETRY"
+    service_account_email = google_service_account.tracking_service_sa.email
+    event_filters {
+      attribute = "bucket"
+      value     = google_storage_bucket.tracking_bucket.name
+    }
+  }
+
+  depends_on = [
+    google_project_service.gcp_services["cloudfunctions.googleapis.com"],
+    google_project_service.gcp_services["eventarc.googleapis.com"],
+    google_storage_bucket.tracking_bucket,
+    google_bigquery_table.tracking_results_table,
+    google_storage_bucket.bq_upload_function_bucket
+    ]
+}
+
 resource "google_storage_bucket" "bq_upload_function_bucket" {
   name                        = "gcf-source-${var.project_id}-${var.region}" # Every bucket name must be globally unique
   location                    = var.region
@@ -44,8 +98,24 @@ resource "google_storage_bucket" "bq_upload_function_bucket" {
 
 data "archive_file" "bq_upload_function_code" {
   type        = "zip"
-  source_dir  = "${path.module}/app/bigquery"
   output_path = "${path.module}/bigquery-upload-function.zip"
+
+  dynamic "source" {
+    for_each = fileset("${path.module}/app/bigquery", "*.{py,txt}")
+    content {
+      content  = file("${path.module}/app/bigquery/${source.value}")
+      filename = source.value
+    }
+  }
+
+  # Shared modules, next to main.py as in the container images
+  dynamic "source" {
+    for_each = fileset("${path.module}/app/common", "*.py")
+    content {
+      content  = file("${path.module}/app/common/${source.value}")
+      filename = source.value
+    }
+  }
 }
 
 # Upload function code to bucket
@@ -84,6 +154,7 @@ resource "google_bigquery_table" "tracking_results_table" {
       {name: "y1", type: "INTEGER", mode: "NULLABLE"},
       {name: "x2", type: "INTEGER", mode: "NULLABLE"},
       {name: "y2", type: "INTEGER", mode: "NULLABLE"}
-    ]}
+    ]},
+    {name: "segment_file", type: "STRING", mode: "NULLABLE"}
   ])
 }
\ No newline at end of file
@@ -45,6 +45,9 @@ resource "google_workflows_workflow" "video_processing_workflow" {
     output_bucket = "${google_storage_bucket.tracking_bucket.name}",
     video_split_job_name = "${google_cloud_run_v2_job.video_split_job.name}",
     segment_duration = "3",
+    overlap_frames = "0",
+    stitch_tracks = "false",
+    overlay_mode = "burned",
     tracking_job_name = "${google_cloud_run_v2_job.tracking_job.name}",
     video_merge_job_name = "${google_cloud_run_v2_job.video_merge_job.name}",
     bigquery_function_url = "${google_cloudfunctions2_function.bigquery_upload.url}"
@@ -64,6 +67,9 @@ main:
           - object_name: $${event.data.name}
           - video_split_job_name: $${sys.get_env("video_split_job_name")}
           - segment_duration: $${sys.get_env("segment_duration")}
+          - overlap_frames: $${default(sys.get_env("overlap_frames"), "0")}
+          - stitch_tracks: $${default(sys.get_env("stitch_tracks"), "false")}
+          - overlay_mode: $${default(sys.get_env("overlay_mode"), "burned")}
           - tracking_job_name: $${sys.get_env("tracking_job_name")}
           - video_merge_job_name: $${sys.get_env("video_merge_job_name")}
           - job_location: asia-southeast1
@@ -119,6 +125,8 @@ main:
                         value: $${object_name}
                       - name: REQUEST_ID
                         value: $${request_id}
+                      - name: OVERLAP_FRAMES
+                        value: $${overlap_frames}
           result: splitting_result
         except:
           as: e
@@ -236,6 +244,7 @@ main:
                           output_bucket_name: $${output_bucket_name}
                           request_id: $${request_id}
                           manifest: $${manifest_content}
+                          overlay_mode: $${overlay_mode}
                         result: tracking_job_results
             - check_tracking_jobs_status:
                 steps:
@@ -248,6 +257,31 @@ main:
                           tracking_job_name: $${tracking_job_name}
                         result: all_jobs_completed
 
+    - stitch_tracks_across_chunks:
+        switch:
+          - condition: $${stitch_tracks == "true"}
+            steps:
+              - trigger_track_stitch:
+                  call: googleapis.run.v1.namespaces.jobs.run
+                  args:
+                    name: $${"namespaces/" + project_id + "/jobs/" + video_merge_job_name}
+                    location: $${job_location}
+                    body:
+                      overrides:
+                        containerOverrides:
+                          - args: ["python", "track-stitch.py"]
+                            env:
+                              - name: INPUT_BUCKET
+                                value: $${output_bucket_name}
+                              - name: REQUEST_ID
+                                value: $${request_id}
+                  result: stitch_job_result
+              - log_stitch_result:
+                  call: sys.log
+                  args:
+                    text: '$${"Track stitch job result: " + json.encode_to_string(stitch_job_result)}'
+                    severity: INFO
+
     - parallel_processing:
         parallel:
           branches:
@@ -266,6 +300,8 @@ main:
                                       value: $${output_bucket_name}
                                     - name: REQUEST_ID
                                       value: $${request_id}
+                                    - name: OVERLAY_MODE
+                                      value: $${overlay_mode}
                         result: merge_job_result
                     - log_merge_result:
                         call: sys.log
@@ -340,7 +376,7 @@ check_new_uploads:
         return: $${new_object_count}
 
 run_tracking_jobs:
-  params: [project_id, job_location, tracking_job_name, output_bucket_name, request_id, manifest]
+  params: [project_id, job_location, tracking_job_name, output_bucket_name, request_id, manifest, overlay_mode: "burned"]
   steps:
     - init_tracking_jobs:
         assign:
@@ -370,6 +406,8 @@ run_tracking_jobs:
                                 value: $${text.replace_all(chunk.segment_file, ".mp4", ".json")}
                               - name: REQUEST_ID
                                 value: $${request_id}
+                              - name: OVERLAY_MODE
+                                value: $${overlay_mode}
                   result: job_result
               - create_job_info:
                   assign:
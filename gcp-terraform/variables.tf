@@ -45,4 +45,19 @@ variable "storage_bucket_name" {
 variable "upload_bucket_name" {
   description = "Name of the GCS bucket for video upload"
   default     = "upload-video-bucket"
+}
+
+variable "bigquery_load_mode" {
+  description = "batch: load all chunks after tracking; event: load each chunk as its processed JSON lands"
+  default     = "batch"
+}
+
+variable "bigquery_load_file_format" {
+  description = "Load file format for the BigQuery writer: json or parquet"
+  default     = "parquet"
+}
+
+variable "tracking_pipeline_mode" {
+  description = "services: detect with the YOLO service; fused: detect, track and annotate in the tracking job with a single decode"
+  default     = "services"
 }
\ No newline at end of file